@@ -1,96 +1,2410 @@
 from agentsociety.agent import IndividualAgentBase 
-from typing import Any, List, Dict
+from typing import Any, List, Dict, Optional
+from array import array
+from collections import OrderedDict, deque
+from collections.abc import Sequence
+from itertools import accumulate
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+import asyncio
+import atexit
+import contextvars
+import hashlib
+import inspect
 import json
+import logging
+import logging.handlers
 import math
+import queue
+import random
 import re
+import sqlite3
+import string
+import sys
+import threading
+import time
+import urllib.parse
+import zlib
+
+try:
+    import numpy as np
+except ImportError:  # 未安装numpy时用户画像统计退回纯Python实现
+    np = None
+
+logger = logging.getLogger("mygo")
+prompt_logger = logging.getLogger("mygo.prompts")  # 完整提示词，按任务抽样输出
+
+_MISSING = object()
+_WORD_RE = re.compile(r'\b[a-zA-Z]+\b')
+_CJK_RE = re.compile(r'[\u3000-\u303f\u4e00-\u9fff\uff00-\uffef]')
+
+# 启发式排序各信号的权重，可通过heuristic_weights选项覆盖
+DEFAULT_HEURISTIC_WEIGHTS = {
+    "category": 3.0,      # 用户在该类别的访问占比
+    "category_rating": 1.0,  # 用户在该类别的平均评分
+    "rating_fit": 1.5,    # 场所评分与用户常去场所平均评分的接近程度
+    "quality": 1.0,       # 场所评分相对用户评分习惯的高低
+    "popularity": 1.0,    # 评论数（对数归一化）
+    "mention": 2.0,       # 场所评论中提及了用户名
+}
+
+# 候选预筛选规则（按顺序执行），可通过prefilter_rules选项替换；默认只保留原有的低评分过滤
+DEFAULT_PREFILTER_RULES = [
+    {"rule": "min_rating", "value": 1.5},
+]
+
+# 各阶段输出中后续流程实际用到的顶层键；流式调用时这些键读完即可终止生成
+STAGE_REQUIRED_KEYS = {
+    "intent": ("user_profile", "primary_need", "secondary_need", "potential_need"),
+    "screening": ("selected_venues",),
+    "final": ("final_recommendations",),
+    "secondary": ("recommended_venues",),
+    "fast": ("user_profile", "primary_need", "secondary_need", "potential_need", "primary_recommendations", "secondary_recommendations"),
+    "review": ("stars", "review"),
+    "review_batch": ("reviews",),
+}
+
+# LLM调用策略（可按阶段覆盖）：timeout为单次调用超时秒数（不含排队），retries为失败/超时/空响应后的重试次数，
+# 重试间隔按backoff指数增长（上限backoff_max）并乘以0.5~1的随机抖动；hedge_after秒未返回时再发一个相同请求
+DEFAULT_LLM_POLICY = {"timeout": None, "retries": 0, "backoff": 0.5, "backoff_max": 8.0, "hedge_after": None}
+
+# 各阶段提示词分段的token预算（None表示不限制），可通过prompt_budgets选项按阶段覆盖
+DEFAULT_PROMPT_BUDGETS = {
+    "intent": {"reviews": 4000},
+    "screening": {"reviews": 1500, "venues": 8000},
+    "secondary": {"venues": 8000},
+    "review": {"reviews": 1000},
+    "fast": {"reviews": 1500, "venues": 8000},
+}
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算token数：中文字符约1个token，其余字符约4个字符1个token"""
+    if not text: return 0
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def _estimate_size(obj) -> int:
+    """粗略估算对象占用的内存字节数（递归统计dict/list/str）"""
+    if isinstance(obj, CompactReviewList): return obj.nbytes
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_estimate_size(k) + _estimate_size(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(_estimate_size(v) for v in obj)
+    return size
+
+
+_JSON_STRUCTURAL_RE = re.compile(r'[{}\[\],:"/]')
+_JSON_STRING_SPECIAL_RE = re.compile(r'["\\]')
+_JSON_FENCE = "```json"  # 输出中出现该围栏时只解析其后的内容
+
+
+class IncrementalJSONExtractor:
+    """增量、容错的JSON提取器：逐块喂入LLM输出，找到第一个能解析的顶层JSON对象。
+    只在字符串外部删除//与/* */注释和尾随逗号（不会破坏字符串里的URL）；
+    给定required_keys时，这些顶层键的值全部读完即可提前结束，缺少必需键的对象先记下并继续寻找下一个对象；
+    给定fence时（如```json），一旦在输出中出现就丢弃此前的内容，从围栏之后重新解析；失败时error记录原因"""
+    
+    def __init__(self, required_keys=(), fence: Optional[str] = None):
+        self.required_keys = frozenset(required_keys)
+        self.fence = fence
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.done = False
+        self.consumed = 0          # 已读取的输入字符数（提前结束时之后的输入不再读取）
+        self._text = ""
+        self._fence_tail = ""      # 未找到围栏时保留的输入尾部，用于识别跨块的围栏
+        self._incomplete: Optional[Dict[str, Any]] = None  # 第一个缺少必需键的对象，找不到完整对象时返回它
+        self._reset_object()
+    
+    def _reset_object(self):
+        self._out: List[str] = []  # 清理后的当前对象文本
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._comment = None       # None | 'line' | 'block'
+        self._expect_key = False   # 顶层是否正等待下一个键
+        self._pending_key: Optional[str] = None
+        self._key_start = 0
+        self._completed_keys = set()
+        self._boundary = 0         # 最后一个完整顶层键值对之后的位置（用于截断时补全）
+    
+    def feed(self, chunk: str) -> bool:
+        """喂入一段输出；返回True表示已得到结果，调用方可以停止读取"""
+        if self.done or not chunk: return self.done
+        if self.fence is not None:
+            window = self._fence_tail + chunk
+            pos = window.find(self.fence)
+            if pos < 0:
+                self._fence_tail = window[-(len(self.fence) - 1):]
+            else:
+                # 围栏之前的内容（包括已扫描的对象）全部丢弃，之后不再查找围栏
+                start = pos + len(self.fence)
+                self.consumed += len(self._text) + start - len(self._fence_tail)
+                self.fence, self._text, self._incomplete, self.error = None, "", None, None
+                self._reset_object()
+                chunk = window[start:]
+        self._text += chunk
+        self._scan()
+        return self.done
+    
+    def _scan(self):
+        text, i, n = self._text, 0, len(self._text)
+        out = self._out
+        while i < n and not self.done:
+            if self._depth == 0:
+                start = text.find('{', i)
+                if start < 0:
+                    i = n
+                    break
+                out.append('{')
+                self._depth, self._expect_key, self._boundary = 1, True, 1
+                i = start + 1
+                continue
+            if self._comment == 'line':
+                end = text.find('\n', i)
+                if end < 0: i = n; break
+                self._comment, i = None, end
+                continue
+            if self._comment == 'block':
+                end = text.find('*/', i)
+                if end < 0: i = max(i, n - 1); break
+                self._comment, i = None, end + 2
+                continue
+            if self._in_string:
+                match = _JSON_STRING_SPECIAL_RE.search(text, i)
+                if match is None:
+                    out.append(text[i:]); i = n
+                    break
+                pos = match.start()
+                if text[pos] == '\\':
+                    if pos + 1 >= n:
+                        out.append(text[i:pos]); i = pos
+                        break
+                    out.append(text[i:pos + 2]); i = pos + 2
+                    continue
+                out.append(text[i:pos + 1]); i = pos + 1
+                self._in_string = False
+                if self._depth == 1 and self._expect_key:
+                    self._pending_key = "".join(out[self._key_start:])
+                    self._expect_key = False
+                continue
+            match = _JSON_STRUCTURAL_RE.search(text, i)
+            if match is None:
+                out.append(text[i:]); i = n
+                break
+            pos = match.start()
+            if pos > i: out.append(text[i:pos])
+            ch = text[pos]
+            i = pos + 1
+            if ch == '"':
+                out.append(ch)
+                self._in_string = True
+                if self._depth == 1 and self._expect_key: self._key_start = len(out)
+            elif ch == '/':
+                if pos + 1 >= n:
+                    i = pos
+                    break
+                if text[pos + 1] == '/': self._comment, i = 'line', pos + 2
+                elif text[pos + 1] == '*': self._comment, i = 'block', pos + 2
+                else: out.append(ch)
+            elif ch in '{[':
+                out.append(ch)
+                self._depth += 1
+            elif ch in '}]':
+                self._strip_trailing_comma()
+                out.append(ch)
+                self._depth -= 1
+                if self._depth == 0:
+                    self._close_object()
+                    out = self._out
+            elif ch == ',':
+                if self._depth == 1:
+                    if self._pending_key is not None: self._completed_keys.add(self._pending_key[:-1])
+                    self._boundary = len(out)
+                    self._expect_key, self._pending_key = True, None
+                    if self.required_keys and self.required_keys <= self._completed_keys:
+                        self._finish_partial("required_keys")
+                        break
+                out.append(ch)
+            else:
+                out.append(ch)
+        # 只保留未扫描的尾部，逐token喂入时不会反复复制整段输出
+        self.consumed += i
+        self._text = text[i:]
+    
+    def _strip_trailing_comma(self):
+        out = self._out
+        k = len(out) - 1
+        while k >= 0 and not out[k].strip(): k -= 1
+        if k >= 0:
+            stripped = out[k].rstrip()
+            if stripped.endswith(','): out[k] = stripped[:-1]
+    
+    def _close_object(self):
+        """一个顶层对象闭合：能解析则完成，否则记录原因并继续寻找下一个对象"""
+        try:
+            result = json.loads("".join(self._out))
+        except json.JSONDecodeError as e:
+            self.error = f"invalid_json: {e.msg} at char {e.pos}"
+            self._reset_object()
+            return
+        if not isinstance(result, dict):
+            self._reset_object()
+            return
+        missing = self.required_keys - set(result)
+        if missing:
+            # 例如输出格式说明里的示例对象：记下后继续寻找包含全部必需键的对象
+            if self._incomplete is None: self._incomplete = result
+            self.error = f"missing_keys: {sorted(missing)}"
+            self._reset_object()
+            return
+        self._set_result(result)
+    
+    def _finish_partial(self, reason: str) -> bool:
+        """在最后一个完整的顶层键值对处补上右括号并解析"""
+        text = "".join(self._out[:self._boundary]).rstrip().rstrip(',') + '}'
+        try:
+            result = json.loads(text)
+        except json.JSONDecodeError as e:
+            self.error = f"{reason}: {e.msg}"
+            return False
+        self._set_result(result)
+        if reason != "required_keys": self.error = reason
+        return True
+    
+    def _set_result(self, result: Dict[str, Any]):
+        self.result, self.done = result, True
+        missing = self.required_keys - set(result)
+        self.error = f"missing_keys: {sorted(missing)}" if missing else None
+    
+    def finish(self) -> Dict[str, Any]:
+        """输入结束：返回解析结果；未闭合的对象尽量按已完成的键值对截断补全，其次返回缺少必需键的对象，仍失败时返回{}"""
+        if self.done: return self.result
+        if self._depth > 0:
+            if self._boundary > 1 and self._finish_partial("truncated"): return self.result
+            self.error = "truncated: unterminated JSON object"
+        if self._incomplete is not None:
+            self._set_result(self._incomplete)
+            return self.result
+        if self.error is None:
+            self.error = "no_json_object"
+        return {}
+
+
+class OpenAIStreamClient:
+    """仅依赖标准库的OpenAI兼容流式（SSE）客户端；提前关闭stream()生成器会断开连接，服务端随即停止生成"""
+    
+    def __init__(self, base_url: str, model: str, api_key: Optional[str] = None, timeout: float = 60.0, extra_body: Optional[Dict[str, Any]] = None):
+        parsed = urllib.parse.urlsplit(base_url)
+        self.use_ssl = parsed.scheme == "https"
+        self.host = parsed.hostname
+        self.port = parsed.port or (443 if self.use_ssl else 80)
+        self.path = parsed.path.rstrip("/") + "/chat/completions"
+        self.model, self.api_key, self.timeout = model, api_key, timeout
+        self.extra_body = extra_body or {}
+    
+    async def stream(self, messages: List[Dict], **params):
+        """逐段产出生成的文本"""
+        body = json.dumps({"model": self.model, "messages": messages, "stream": True, **self.extra_body, **params}).encode("utf-8")
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port, ssl=True if self.use_ssl else None), self.timeout)
+        try:
+            headers = [f"POST {self.path} HTTP/1.1", f"Host: {self.host}:{self.port}", "Content-Type: application/json",
+                       "Accept: text/event-stream", f"Content-Length: {len(body)}", "Connection: close"]
+            if self.api_key: headers.append(f"Authorization: Bearer {self.api_key}")
+            writer.write(("\r\n".join(headers) + "\r\n\r\n").encode("latin-1") + body)
+            await writer.drain()
+            
+            status_line = await asyncio.wait_for(reader.readline(), self.timeout)
+            status = int(status_line.split()[1]) if len(status_line.split()) > 1 else 0
+            response_headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""): break
+                name, _, value = line.decode("latin-1").partition(":")
+                response_headers[name.strip().lower()] = value.strip().lower()
+            chunked = "chunked" in response_headers.get("transfer-encoding", "")
+            if status != 200:
+                error_body = b"".join([data async for data in self._iter_body(reader, chunked)])
+                raise RuntimeError(f"LLM流式请求失败: HTTP {status} {error_body[:200].decode('utf-8', 'ignore')}")
+            
+            buffer = b""
+            async for data in self._iter_body(reader, chunked):
+                buffer += data
+                while b"\n" in buffer:
+                    line, buffer = buffer.split(b"\n", 1)
+                    line = line.strip()
+                    if not line.startswith(b"data:"): continue
+                    payload = line[5:].strip()
+                    if payload == b"[DONE]": return
+                    choices = json.loads(payload).get("choices") or []
+                    piece = (choices[0].get("delta") or {}).get("content") if choices else None
+                    if piece: yield piece
+        finally:
+            writer.close()
+            try: await writer.wait_closed()
+            except Exception: pass
+    
+    async def _iter_body(self, reader: asyncio.StreamReader, chunked: bool):
+        if not chunked:
+            while True:
+                data = await asyncio.wait_for(reader.read(65536), self.timeout)
+                if not data: return
+                yield data
+        while True:
+            size_line = await asyncio.wait_for(reader.readline(), self.timeout)
+            size = int(size_line.split(b";")[0].strip() or b"0", 16)
+            if size == 0: return
+            data = await reader.readexactly(size)
+            await reader.readline()
+            yield data
+
+
+_REVIEW_DATE_RE = re.compile(r'^(\d{4})-(\d{2})-(\d{2}) (\d{2}):(\d{2}):(\d{2})$')
+_REVIEW_ID_FIELDS = ("review_id", "user_id")
+
+
+class CompactReviewList(Sequence):
+    """紧凑的场所评论列表：stars/useful/日期等数值字段存放在定长数组中，正文与ID分别按UTF-8拼接进共享缓冲区并记录偏移，
+    所有评论相同的字段（如item_id）只存一份；按下标或切片访问时才构造评论dict（与原dict内容相同）"""
+    
+    __slots__ = ("item_id", "_columns", "_constants", "_date_columns", "_texts", "_text_offsets", "_ids", "_id_offsets", "_keys", "_length")
+    
+    @classmethod
+    def from_reviews(cls, reviews) -> Optional["CompactReviewList"]:
+        """把评论dict列表转换为紧凑形式；字段不规则（键不一致、日期格式不同、类型混杂且取值不唯一）时返回None"""
+        if not isinstance(reviews, list) or not reviews or not all(isinstance(r, dict) for r in reviews): return None
+        try:
+            return cls._build(reviews)
+        except (OverflowError, TypeError, UnicodeError):
+            return None
+    
+    @classmethod
+    def _build(cls, reviews: List[Dict]) -> Optional["CompactReviewList"]:
+        keys = tuple(reviews[0])
+        if any(tuple(r) != keys for r in reviews): return None
+        if not all(field in keys for field in ("item_id", "text", *_REVIEW_ID_FIELDS)): return None
+        
+        self = cls.__new__(cls)
+        self._columns, self._constants, self._date_columns = {}, {}, frozenset()
+        for key in keys:
+            if key in ("text", *_REVIEW_ID_FIELDS): continue
+            values = [r[key] for r in reviews]
+            if key == "date" and all(isinstance(v, str) for v in values):
+                parsed = [_REVIEW_DATE_RE.match(v) for v in values]
+                if not all(parsed): return None
+                self._columns[key] = array('q', (int("".join(m.groups())) for m in parsed))
+                self._date_columns |= {key}  # 只有从日期字符串解析的列在读取时还原为字符串
+            elif all(v == values[0] for v in values):
+                self._constants[key] = values[0]
+            elif all(type(v) is int for v in values):
+                self._columns[key] = array('q', values)
+            elif all(type(v) is float for v in values):
+                self._columns[key] = array('d', values)
+            else:
+                return None
+        if "item_id" not in self._constants: return None
+        
+        texts = [r["text"] for r in reviews]
+        ids = [r[field] for r in reviews for field in _REVIEW_ID_FIELDS]
+        if not all(isinstance(v, str) for v in texts) or not all(isinstance(v, str) for v in ids): return None
+        self._texts, self._text_offsets = cls._pack(texts)
+        self._ids, self._id_offsets = cls._pack(ids)
+        self.item_id, self._keys, self._length = self._constants["item_id"], keys, len(reviews)
+        return self
+    
+    @staticmethod
+    def _pack(strings: List[str]):
+        encoded = [v.encode("utf-8") for v in strings]
+        return b"".join(encoded), array('q', accumulate(map(len, encoded), initial=0))
+    
+    def __len__(self) -> int:
+        return self._length
+    
+    def text(self, index: int) -> str:
+        return self._texts[self._text_offsets[index]:self._text_offsets[index + 1]].decode("utf-8")
+    
+    def _value(self, key: str, index: int):
+        if key in self._constants: return self._constants[key]
+        if key == "text": return self.text(index)
+        if key in _REVIEW_ID_FIELDS:
+            slot = index * len(_REVIEW_ID_FIELDS) + _REVIEW_ID_FIELDS.index(key)
+            return self._ids[self._id_offsets[slot]:self._id_offsets[slot + 1]].decode("utf-8")
+        if key in self._date_columns:
+            d = f"{self._columns[key][index]:014d}"
+            return f"{d[0:4]}-{d[4:6]}-{d[6:8]} {d[8:10]}:{d[10:12]}:{d[12:14]}"
+        return self._columns[key][index]
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._length))]
+        if index < 0: index += self._length
+        if not 0 <= index < self._length: raise IndexError("review index out of range")
+        return {key: self._value(key, index) for key in self._keys}
+    
+    def texts(self):
+        """逐条产出评论正文，不构造评论dict"""
+        for index in range(self._length):
+            yield self.text(index)
+    
+    def stars_sum(self) -> float:
+        if "stars" in self._constants: return self._constants["stars"] * self._length
+        return sum(self._columns["stars"])
+    
+    @property
+    def nbytes(self) -> int:
+        return (sys.getsizeof(self._texts) + sys.getsizeof(self._ids)
+                + sum(a.itemsize * len(a) for a in (self._text_offsets, self._id_offsets, *self._columns.values())) + 256)
+
+
+def review_texts(reviews):
+    """评论正文迭代器：紧凑列表直接读取缓冲区"""
+    if isinstance(reviews, CompactReviewList): return reviews.texts()
+    return (review.get('text', '') for review in reviews)
+
+
+def review_stars_sum(reviews) -> float:
+    if isinstance(reviews, CompactReviewList): return reviews.stars_sum()
+    return sum(r['stars'] for r in reviews)
+
+
+class SharedLRUCache:
+    """进程级LRU缓存 - 支持条目数和内存上限、可选TTL，并统计命中、淘汰与内存占用；
+    未命中的加载按键单飞：同一键已有调用方在加载时，其他调用方等待其结果而不是重复加载"""
+
+    def __init__(self, max_entries: int = 10000, max_bytes: int = 256 * 1024 * 1024, ttl: Optional[float] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()  # key -> (value, size, expires_at)
+        self._inflight: Dict[Any, Future] = {}   # 正在加载的键 -> 加载结果
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, size, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else ttl
+        size = _estimate_size(value)
+        with self._lock:
+            if key in self._data: self._remove(key)
+            if size > self.max_bytes: return
+            self._data[key] = (value, size, time.monotonic() + ttl if ttl else None)
+            self.bytes += size
+            while len(self._data) > self.max_entries or self.bytes > self.max_bytes:
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def get_or_load(self, key, loader):
+        value, flight = self.claim(key)
+        if flight is not None: return flight.result()
+        if value is not _MISSING: return value
+        try:
+            value = loader()
+        except BaseException as e:
+            self.fulfil(key, error=e)
+            raise
+        self.fulfil(key, value)
+        return value
+
+    def claim(self, key) -> tuple:
+        """单飞加载的第一步：返回(缓存值, None)；其他调用方正在加载时返回(_MISSING, Future)；
+        否则登记由调用方加载并返回(_MISSING, None)，调用方之后必须调用fulfil"""
+        value = self.get(key, _MISSING)
+        if value is not _MISSING: return value, None
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None: return entry[0], None  # 在get之后刚被其他调用方写入
+            flight = self._inflight.get(key)
+            if flight is not None: return _MISSING, flight
+            self._inflight[key] = Future()
+        return _MISSING, None
+
+    def fulfil(self, key, value=_MISSING, error: Optional[BaseException] = None):
+        """结束claim登记的加载：成功时写入缓存并把值交给等待者，失败时把异常交给等待者"""
+        if error is None: self.put(key, value)
+        with self._lock:
+            flight = self._inflight.pop(key, None)
+        if flight is None: return
+        if error is None: flight.set_result(value)
+        else: flight.set_exception(error)
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._data: self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def _remove(self, key):
+        _, size, _ = self._data.pop(key)
+        self.bytes -= size
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._data), "bytes": self.bytes,
+            "hits": self.hits, "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "evictions": self.evictions, "expirations": self.expirations,
+        }
+
+
+class SharedVenueCache:
+    """所有智能体实例共享的场所缓存 - 场所信息与场所评论列表分别独立限额"""
+
+    def __init__(self):
+        self.items = SharedLRUCache(max_entries=50000, max_bytes=64 * 1024 * 1024)
+        self.reviews = SharedLRUCache(max_entries=5000, max_bytes=512 * 1024 * 1024)
+
+    def configure(self, item_max_entries: Optional[int] = None, review_max_entries: Optional[int] = None,
+                  item_max_bytes: Optional[int] = None, review_max_bytes: Optional[int] = None, ttl: Optional[float] = None):
+        if item_max_entries is not None: self.items.max_entries = item_max_entries
+        if review_max_entries is not None: self.reviews.max_entries = review_max_entries
+        if item_max_bytes is not None: self.items.max_bytes = item_max_bytes
+        if review_max_bytes is not None: self.reviews.max_bytes = review_max_bytes
+        if ttl is not None: self.items.ttl = self.reviews.ttl = ttl
+
+    def stats(self) -> Dict[str, Any]:
+        return {"items": self.items.stats(), "reviews": self.reviews.stats()}
+
+
+SHARED_VENUE_CACHE = SharedVenueCache()
+
+
+class MentionIndex:
+    """进程级倒排索引 - 场所ID -> (评论数据版本, {小写单词: 评论下标数组})，普通列表与紧凑评论列表都按正文建立；
+    不持有评论列表本身，按自身的估算字节数上限LRU淘汰（与评论列表是否仍在共享缓存中无关，重新加载的相同数据沿用已有倒排表）；
+    多个任务同时需要同一场所的倒排表时只建立一次"""
+
+    def __init__(self, max_items: int = 5000, max_bytes: int = 256 * 1024 * 1024):
+        self._entries = SharedLRUCache(max_entries=max_items, max_bytes=max_bytes)
+        self.indexed_reviews = 0
+
+    @staticmethod
+    def version(reviews) -> tuple:
+        """评论数据版本：评论数与首尾评论ID；评论列表重新加载但内容未变时沿用已有倒排表"""
+        if not reviews: return (0,)
+        return (len(reviews), reviews[0].get('review_id'), reviews[-1].get('review_id'))
+
+    def postings(self, item_id, reviews: List[Dict]) -> Dict[str, array]:
+        """返回场所的倒排表；评论数据版本变化时重建"""
+        version = self.version(reviews)
+        entry, flight = self._entries.claim(item_id)
+        if flight is not None:
+            # 其他任务正在建立该场所的倒排表
+            entry = flight.result() if flight.exception() is None else None
+        elif entry is _MISSING:
+            try:
+                index = self._build(reviews)
+            except BaseException as e:
+                self._entries.fulfil(item_id, error=e)
+                raise
+            self._entries.fulfil(item_id, (version, index))
+            return index
+        if entry is not None and entry[0] == version: return entry[1]
+        # 数据版本不同（场所评论有更新）或其他任务建立失败：重建并覆盖
+        index = self._build(reviews)
+        self._entries.put(item_id, (version, index))
+        return index
+
+    def _build(self, reviews: List[Dict]) -> Dict[str, array]:
+        index: Dict[str, array] = {}
+        for idx, text in enumerate(review_texts(reviews)):
+            for word in set(_WORD_RE.findall(text.lower())):
+                postings = index.get(word)
+                if postings is None: postings = index[word] = array('I')
+                postings.append(idx)
+        self.indexed_reviews += len(reviews)
+        return index
+
+    def lookup(self, word: str, item_id, reviews: List[Dict]) -> List[Dict]:
+        """返回该场所中包含word的评论（保持原评论顺序）"""
+        return [reviews[idx] for idx in self.postings(item_id, reviews).get(word, ())]
+
+    def invalidate(self, item_id):
+        self._entries.invalidate(item_id)
+
+    def stats(self) -> Dict[str, Any]:
+        entries = self._entries.stats()
+        return {"items": entries["entries"], "bytes": entries["bytes"], "evictions": entries["evictions"], "indexed_reviews": self.indexed_reviews}
+
+
+MENTION_INDEX = MentionIndex()
+
+
+_STOPWORDS = frozenset("a an and are as at be by for from in is it of on or the to with".split())
+_CJK_RUN_RE = re.compile(r'[\u4e00-\u9fff]+')
+
+# 中文需求关键词 -> 英文类别词：场所名称与类别为英文，第一阶段给出的中文主要需求（如'美甲服务'）经此映射后才能与场所文本匹配
+NEED_CATEGORY_TERMS = {
+    "美甲": "nail salons", "指甲": "nail salons", "美发": "hair salons", "理发": "hair barbers", "发型": "hair salons",
+    "美容": "beauty spas", "水疗": "day spas", "按摩": "massage spas", "健身": "gyms fitness", "瑜伽": "yoga fitness",
+    "咖啡": "coffee tea", "奶茶": "bubble tea", "酒吧": "bars", "啤酒": "beer bars", "面包": "bakeries bread", "烘焙": "bakeries",
+    "甜点": "desserts bakeries", "蛋糕": "bakeries desserts", "披萨": "pizza", "比萨": "pizza", "寿司": "sushi bars japanese",
+    "日式": "japanese sushi", "日料": "japanese sushi", "中餐": "chinese", "中式": "chinese", "意大利": "italian pizza",
+    "墨西哥": "mexican", "汉堡": "burgers", "海鲜": "seafood", "烧烤": "barbeque", "早餐": "breakfast brunch", "早午餐": "breakfast brunch",
+    "快餐": "fast food", "餐厅": "restaurants food", "餐饮": "restaurants food", "美食": "restaurants food", "料理": "restaurants food",
+    "用餐": "restaurants food", "购物": "shopping", "超市": "grocery", "酒店": "hotels", "汽修": "automotive", "宠物": "pet services",
+}
+
+
+class VenueRanker:
+    """本地BM25预排序 - 以候选池为语料，对场所名称、类别和代表性评论打分；场所词频向量按item_id进程级缓存。
+    英文按单词、中文按相邻二字切分，查询中的中文需求关键词额外扩展为NEED_CATEGORY_TERMS中的英文类别词"""
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75, max_items: int = 20000):
+        self.k1 = k1
+        self.b = b
+        self._vectors = SharedLRUCache(max_entries=max_items, max_bytes=128 * 1024 * 1024)
+
+    def tokenize(self, text: str) -> List[str]:
+        tokens = [w for w in _WORD_RE.findall(text.lower()) if w not in _STOPWORDS]
+        for run in _CJK_RUN_RE.findall(text):
+            tokens += [run[i:i + 2] for i in range(len(run) - 1)] if len(run) > 1 else [run]
+        return tokens
+
+    def query_terms(self, query: str) -> set:
+        terms = set(self.tokenize(query))
+        for keyword, expansion in NEED_CATEGORY_TERMS.items():
+            if keyword in query: terms.update(self.tokenize(expansion))
+        return terms
+
+    def venue_vector(self, venue: Dict) -> Dict[str, int]:
+        key = (venue['item_id'], venue.get('review_count', 0))
+        vector = self._vectors.get(key)
+        if vector is None:
+            vector = {}
+            # 名称与类别比评论文本更能代表场所，权重加倍
+            weighted = [(venue.get('name', ''), 2), (venue.get('category', ''), 3)]
+            weighted += [(r.get('text', ''), 1) for r in venue.get('reviews', [])[:5]]
+            for text, weight in weighted:
+                for word in self.tokenize(text):
+                    vector[word] = vector.get(word, 0) + weight
+            self._vectors.put(key, vector)
+        return vector
+
+    def score(self, query: str, venues: List[Dict]) -> List[float]:
+        terms = self.query_terms(query)
+        if not terms or not venues: return [0.0] * len(venues)
+        vectors = [self.venue_vector(v) for v in venues]
+        lengths = [sum(v.values()) for v in vectors]
+        avg_length = (sum(lengths) / len(lengths)) or 1.0
+        n = len(venues)
+        idf = {}
+        for term in terms:
+            df = sum(1 for v in vectors if term in v)
+            if df: idf[term] = math.log(1 + (n - df + 0.5) / (df + 0.5))
+        
+        scores = []
+        for vector, length in zip(vectors, lengths):
+            norm = self.k1 * (1 - self.b + self.b * length / avg_length)
+            scores.append(sum(weight * vector[t] * (self.k1 + 1) / (vector[t] + norm) for t, weight in idf.items() if t in vector))
+        return scores
+
+
+VENUE_RANKER = VenueRanker()
+
+
+class VenueSummaryCache:
+    """进程级场所摘要缓存 - item_id -> 场所块各部分的格式化文本及其中文/其他字符数（可直接求和得到拼接后的token估算）；
+    条目带版本（名称、类别、评分、评论数与前5条评论ID），场所评论变化后首次访问时按需重建"""
+
+    def __init__(self, max_items: int = 50000):
+        self._entries = SharedLRUCache(max_entries=max_items, max_bytes=128 * 1024 * 1024)
+        self.builds = 0
+
+    @staticmethod
+    def version(venue: Dict) -> tuple:
+        reviews = venue.get('reviews', [])[:5]
+        return (venue.get('name'), venue.get('category'), venue.get('avg_rating'), venue.get('review_count'),
+                tuple(r.get('review_id', r.get('date')) for r in reviews))
+
+    def get(self, venue: Dict, part, builder) -> tuple:
+        """返回(文本, 中文字符数, 其他字符数)；缓存未命中或版本过期时调用builder()生成"""
+        item_id = venue['item_id']
+        version = self.version(venue)
+        entry = self._entries.get(item_id)
+        if entry is None or entry[0] != version:
+            entry = (version, {})
+        parts = entry[1]
+        cached = parts.get(part)
+        if cached is None:
+            text = builder()
+            cjk = len(_CJK_RE.findall(text))
+            cached = parts[part] = (text, cjk, len(text) - cjk)
+            self.builds += 1
+            self._entries.put(item_id, entry)
+        return cached
+
+    def invalidate(self, item_id):
+        self._entries.invalidate(item_id)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self._entries.stats(), "builds": self.builds}
+
+
+VENUE_SUMMARY_CACHE = VenueSummaryCache()
+
+
+def _prefilter_min_rating(columns: Dict[str, Any], params: Dict[str, Any], user_preferences: Dict) -> Optional[List[bool]]:
+    """排除平均评分小于等于value的场所"""
+    threshold = params.get("value", 1.5)
+    return [rating > threshold for rating in columns["rating"]]
+
+
+def _prefilter_min_reviews(columns: Dict[str, Any], params: Dict[str, Any], user_preferences: Dict) -> Optional[List[bool]]:
+    """排除评论数少于value的场所"""
+    threshold = params.get("value", 1)
+    return [count >= threshold for count in columns["review_count"]]
+
+
+def _prefilter_rating_habit(columns: Dict[str, Any], params: Dict[str, Any], user_preferences: Dict) -> Optional[List[bool]]:
+    """排除评分比用户常去场所平均评分低margin以上的场所；用户无评分记录时不生效"""
+    visited_avg = user_preferences.get('visited_venues_avg_rating')
+    if not visited_avg: return None
+    threshold = visited_avg - params.get("margin", 1.5)
+    return [rating >= threshold for rating in columns["rating"]]
+
+
+def _prefilter_category(columns: Dict[str, Any], params: Dict[str, Any], user_preferences: Dict) -> Optional[List[bool]]:
+    """只保留用户访问过至少min_count次的类别；用户历史少于min_history条时不生效"""
+    category_prefs = user_preferences.get('category_preferences')
+    if not category_prefs or user_preferences.get('review_count', 0) < params.get("min_history", 5): return None
+    min_count = params.get("min_count", 1)
+    visited = {category for category, data in category_prefs.items() if data['count'] >= min_count}
+    return [category in visited for category in columns["category"]]
+
+
+def _prefilter_city(columns: Dict[str, Any], params: Dict[str, Any], user_preferences: Dict) -> Optional[List[bool]]:
+    """只保留用户去过的城市中的场所（城市未知的场所保留）；用户无城市记录时不生效"""
+    city_counts = user_preferences.get('city_counts')
+    if not city_counts: return None
+    min_count = params.get("min_count", 1)
+    visited = {city for city, count in city_counts.items() if count >= min_count}
+    return [city in visited or city == 'Unknown' for city in columns["city"]]
+
+
+# 预筛选规则注册表：规则名 -> 函数(候选列, 规则参数, 用户画像)，返回保留掩码；返回None表示该规则对当前用户不生效
+PREFILTER_RULES = {
+    "min_rating": _prefilter_min_rating,
+    "min_reviews": _prefilter_min_reviews,
+    "rating_habit": _prefilter_rating_habit,
+    "category": _prefilter_category,
+    "city": _prefilter_city,
+}
+
+
+class CachedUIRTool:
+    """任务级uir工具包装 - 同一任务内的重复查询直接从内存返回，并统计命中/未命中次数；
+    场所信息与场所评论在任务缓存未命中时再查询进程级共享缓存；compact_reviews时场所评论以CompactReviewList缓存"""
+
+    def __init__(self, tool, shared: Optional[SharedVenueCache] = None, compact_reviews: bool = False):
+        self._tool = tool
+        self._shared = shared
+        self.compact_reviews = compact_reviews
+        self._users: Dict[Any, Any] = {}
+        self._items: Dict[Any, Any] = {}
+        self._reviews: Dict[tuple, Any] = {}
+        self.hits = 0
+        self.misses = 0
+        self.prefetched = 0
+
+    def __getattr__(self, name):
+        # 未包装的方法直接透传给底层工具
+        return getattr(self._tool, name)
+
+    def _lookup(self, cache: Dict, key, fetch):
+        if key in cache:
+            self.hits += 1
+            return cache[key]
+        self.misses += 1
+        value = cache[key] = fetch()
+        return value
+
+    def get_user(self, user_id):
+        return self._lookup(self._users, user_id, lambda: self._tool.get_user(user_id))
+
+    def get_item(self, item_id):
+        fetch = lambda: self._tool.get_item(item_id)
+        if self._shared is not None:
+            fetch = lambda: self._shared.items.get_or_load(item_id, lambda: self._tool.get_item(item_id))
+        return self._lookup(self._items, item_id, fetch)
+
+    def get_reviews(self, user_id=None, item_id=None, review_id=None):
+        query = {k: v for k, v in (("user_id", user_id), ("item_id", item_id), ("review_id", review_id)) if v is not None}
+        fetch = lambda: self._tool.get_reviews(**query)
+        if list(query) == ["item_id"]:
+            fetch = lambda: self._fetch_item_reviews(item_id)
+            if self._shared is not None:
+                fetch = lambda: self._shared.reviews.get_or_load(item_id, lambda: self._fetch_item_reviews(item_id))
+        return self._lookup(self._reviews, (user_id, item_id, review_id), fetch)
+
+    def _fetch_item_reviews(self, item_id, reviews=_MISSING):
+        if reviews is _MISSING: reviews = self._tool.get_reviews(item_id=item_id)
+        if self.compact_reviews:
+            return CompactReviewList.from_reviews(reviews) or reviews
+        return reviews
+
+    def prefetch(self, item_ids: List[str], review_item_ids: Optional[List[str]] = None, max_workers: int = 8) -> int:
+        """批量预取场所信息和场所评论到任务缓存，返回实际查询底层工具的次数。
+        底层工具提供get_items/get_reviews_batch批量接口时各用一次查询，否则在一个线程池内并发逐个查询；
+        其他任务正在加载的场所不重复查询，本任务的查询完成后再等待其结果"""
+        item_ids = [i for i in dict.fromkeys(item_ids) if i is not None]
+        review_item_ids = [i for i in dict.fromkeys(review_item_ids or []) if i is not None]
+        missing_items, waiting_items = self._take_shared(item_ids, self._items, lambda i: i, "items")
+        missing_reviews, waiting_reviews = self._take_shared(review_item_ids, self._reviews, lambda i: (None, i, None), "reviews")
+
+        fetched_items, fetched_reviews, error = {}, {}, None
+        try:
+            batch_items = getattr(self._tool, "get_items", None)
+            batch_reviews = getattr(self._tool, "get_reviews_batch", None)
+            if callable(batch_items) and missing_items:
+                fetched_items = dict(zip(missing_items, batch_items(missing_items)))
+            if callable(batch_reviews) and missing_reviews:
+                fetched_reviews = {item_id: self._fetch_item_reviews(item_id, reviews) for item_id, reviews in zip(missing_reviews, batch_reviews(missing_reviews))}
+
+            jobs = [("items", i) for i in missing_items if i not in fetched_items] + [("reviews", i) for i in missing_reviews if i not in fetched_reviews]
+            if jobs:
+                def run(job):
+                    kind, item_id = job
+                    return self._tool.get_item(item_id) if kind == "items" else self._fetch_item_reviews(item_id)
+                if max_workers > 1 and len(jobs) > 1:
+                    with ThreadPoolExecutor(max_workers=min(max_workers, len(jobs))) as pool:
+                        results = list(pool.map(run, jobs))
+                else:
+                    results = [run(job) for job in jobs]
+                for (kind, item_id), value in zip(jobs, results):
+                    (fetched_items if kind == "items" else fetched_reviews)[item_id] = value
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            # 本任务登记的加载必须全部了结（失败时把异常交给等待者），否则等待的任务会一直阻塞
+            for item_id in missing_items:
+                if item_id in fetched_items: self._items[item_id] = fetched_items[item_id]
+                self._settle("items", item_id, fetched_items.get(item_id, _MISSING), error)
+            for item_id in missing_reviews:
+                if item_id in fetched_reviews: self._reviews[(None, item_id, None)] = fetched_reviews[item_id]
+                self._settle("reviews", item_id, fetched_reviews.get(item_id, _MISSING), error)
+
+        for memo, memo_key, waiting in ((self._items, lambda i: i, waiting_items), (self._reviews, lambda i: (None, i, None), waiting_reviews)):
+            for item_id, flight in waiting.items():
+                # 其他任务加载失败时留给之后的逐个查询
+                if flight.exception() is None: memo[memo_key(item_id)] = flight.result()
+
+        fetched = len(missing_items) + len(missing_reviews)
+        self.prefetched += fetched
+        return fetched
+
+    def _settle(self, kind: str, item_id, value, error: Optional[BaseException]):
+        shared = getattr(self._shared, kind, None)
+        if shared is None: return
+        if value is _MISSING: shared.fulfil(item_id, error=error or LookupError(item_id))
+        else: shared.fulfil(item_id, value)
+
+    def _take_shared(self, item_ids: List[str], memo: Dict, memo_key, kind: str) -> tuple:
+        """先从共享缓存填充任务缓存，返回(需由本任务查询的ID, {其他任务正在加载的ID: Future})"""
+        missing, waiting = [], {}
+        shared = getattr(self._shared, kind, None)
+        for item_id in item_ids:
+            key = memo_key(item_id)
+            if key in memo: continue
+            if shared is None:
+                missing.append(item_id)
+                continue
+            value, flight = shared.claim(item_id)
+            if flight is not None: waiting[item_id] = flight
+            elif value is _MISSING: missing.append(item_id)
+            else: memo[key] = value
+        return missing, waiting
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "prefetched": self.prefetched,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0}
+
+
+class LLMResponseCache:
+    """磁盘持久化的LLM响应缓存 - 键为规范化消息+模型名的SHA-256，响应经zlib压缩存入SQLite，
+    超出容量时按最近访问时间淘汰；readonly模式只读不写，用于回放已缓存的基准测试。
+    写入每commit_every条提交一次事务，其余在close()（进程退出时自动调用）中提交"""
+
+    def __init__(self, path: str, max_bytes: int = 512 * 1024 * 1024, readonly: bool = False, commit_every: int = 32):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.readonly = readonly
+        self.commit_every = max(1, commit_every)
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, model TEXT, response BLOB, size INTEGER, last_access REAL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_access ON llm_cache (last_access)")
+        self._conn.commit()
+        self._bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+        self._touched: Dict[str, float] = {}
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(messages: List[Dict], model: str) -> str:
+        """规范化消息（去除首尾空白与行尾空白）后计算哈希，格式上的细微差异不影响命中"""
+        normalized = [
+            [m.get('role', ''), "\n".join(line.rstrip() for line in str(m.get('content', '')).strip().splitlines())]
+            for m in messages
+        ]
+        payload = json.dumps([model, normalized], ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if not self.readonly: self._touched[key] = time.time()
+            return zlib.decompress(row[0]).decode('utf-8')
+
+    def put(self, key: str, model: str, response: str):
+        if self.readonly: return
+        blob = zlib.compress(response.encode('utf-8'), 6)
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            self._conn.execute("INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?, ?, ?)", (key, model, blob, len(blob), time.time()))
+            self._bytes += len(blob) - (old[0] if old else 0)
+            self.writes += 1
+            self._pending += 1
+            self._flush_touched()
+            while self._bytes > self.max_bytes:
+                victims = self._conn.execute("SELECT key, size FROM llm_cache ORDER BY last_access LIMIT 64").fetchall()
+                if not victims: break
+                self._conn.executemany("DELETE FROM llm_cache WHERE key = ?", [(k,) for k, _ in victims])
+                self._bytes -= sum(size for _, size in victims)
+                self.evictions += len(victims)
+            if self._pending >= self.commit_every: self._commit()
+
+    def _commit(self):
+        self._flush_touched()
+        self._conn.commit()
+        self._pending = 0
+
+    def _flush_touched(self):
+        # 命中时只记录访问时间，写入时再批量落盘，避免每次命中都提交事务
+        if self._touched:
+            self._conn.executemany("UPDATE llm_cache SET last_access = ? WHERE key = ?", [(t, k) for k, t in self._touched.items()])
+            self._touched.clear()
+
+    def close(self):
+        with self._lock:
+            if self._conn is None: return
+            if not self.readonly: self._commit()
+            self._conn.close()
+            self._conn = None
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits, "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "writes": self.writes, "evictions": self.evictions, "bytes": self._bytes,
+        }
+
+
+_LLM_RESPONSE_CACHES: Dict[tuple, LLMResponseCache] = {}
+
+
+def get_llm_response_cache(path: str, max_bytes: int = 512 * 1024 * 1024, readonly: bool = False, commit_every: int = 32) -> LLMResponseCache:
+    """同一路径、同一读写模式的缓存在进程内只打开一次，由所有智能体实例共享"""
+    key = (path, readonly)
+    if key not in _LLM_RESPONSE_CACHES:
+        _LLM_RESPONSE_CACHES[key] = LLMResponseCache(path, max_bytes=max_bytes, readonly=readonly, commit_every=commit_every)
+    return _LLM_RESPONSE_CACHES[key]
+
+
+def close_llm_response_caches():
+    """提交并关闭进程内打开的全部LLM响应缓存"""
+    for cache in _LLM_RESPONSE_CACHES.values(): cache.close()
+    _LLM_RESPONSE_CACHES.clear()
+
+
+atexit.register(close_llm_response_caches)
+
+
+# 用户画像结构版本：画像字段变化时递增（2: 增加city_counts），旧结构的画像读取时即判定过期
+PROFILE_SCHEMA_VERSION = 2
+
+
+class UserProfileStore:
+    """SQLite持久化的用户画像存储 - 离线预计算后按user_id直接读取；
+    以画像结构版本+评论数+最新评论日期作为版本号，用户有新评论或画像结构变化时读取即判定过期，也可显式invalidate"""
+
+    def __init__(self, path: str, readonly: bool = False):
+        self.path = path
+        self.readonly = readonly
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS user_profiles (user_id TEXT PRIMARY KEY, version TEXT, profile TEXT, updated REAL)")
+        self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    @staticmethod
+    def version_of(user_reviews: List[Dict]) -> str:
+        latest = max((str(r.get('date', '')) for r in user_reviews), default='')
+        return f"v{PROFILE_SCHEMA_VERSION}:{len(user_reviews)}:{latest}"
+
+    def get(self, user_id: str, version: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT version, profile FROM user_profiles WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        if version is not None and row[0] != version:
+            self.stale += 1
+            return None
+        self.hits += 1
+        return json.loads(row[1])
+
+    def put(self, user_id: str, version: str, profile: Dict[str, Any], commit: bool = True):
+        if self.readonly: return
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO user_profiles VALUES (?, ?, ?, ?)",
+                               (user_id, version, json.dumps(profile, ensure_ascii=False, separators=(',', ':')), time.time()))
+            if commit: self._conn.commit()
+
+    def invalidate(self, user_id: str):
+        """用户产生新评论时调用，仅删除该用户的画像"""
+        if self.readonly: return
+        with self._lock:
+            self._conn.execute("DELETE FROM user_profiles WHERE user_id = ?", (user_id,))
+            self._conn.commit()
+
+    def commit(self):
+        with self._lock:
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses + self.stale
+        return {"hits": self.hits, "misses": self.misses, "stale": self.stale,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0}
+
+
+_USER_PROFILE_STORES: Dict[tuple, UserProfileStore] = {}
+
+
+def iter_dataset_user_ids(path: str):
+    """逐个产出数据集用户文件中的user_id：JSON Lines（如Yelp的user.json，每行一个含user_id的对象）或每行一个ID的文本"""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line: continue
+            user_id = json.loads(line).get("user_id") if line.startswith("{") else line
+            if user_id: yield user_id
+
+
+def get_user_profile_store(path: str, readonly: bool = False) -> UserProfileStore:
+    key = (path, readonly)
+    if key not in _USER_PROFILE_STORES:
+        _USER_PROFILE_STORES[key] = UserProfileStore(path, readonly=readonly)
+    return _USER_PROFILE_STORES[key]
+
+
+class _SafeStreamHandler(logging.StreamHandler):
+    """终端编码不支持emoji/中文时退回ASCII输出，而不是报错"""
+    
+    def emit(self, record):
+        try:
+            msg = self.format(record)
+            try:
+                self.stream.write(msg + self.terminator)
+            except UnicodeEncodeError:
+                self.stream.write(msg.encode('ascii', 'ignore').decode('ascii') + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """只把日志记录放入队列，消息格式化（包括整段提示词的拼接）推迟到后台线程"""
+    
+    def prepare(self, record):
+        return record
+
+
+class _TimedMemoryHandler(logging.handlers.MemoryHandler):
+    """缓冲满capacity条、遇到WARNING及以上或距上次写出已超过flush_interval秒时写出"""
+    
+    def __init__(self, capacity: int, flush_interval: float, target: logging.Handler):
+        super().__init__(capacity, flushLevel=logging.WARNING, target=target)
+        self.flush_interval = flush_interval
+        self._last_flush = time.monotonic()
+    
+    def shouldFlush(self, record):
+        return super().shouldFlush(record) or time.monotonic() - self._last_flush >= self.flush_interval
+    
+    def flush(self):
+        super().flush()
+        self._last_flush = time.monotonic()
+
+
+class _FlushingQueueListener(logging.handlers.QueueListener):
+    """队列空闲flush_interval秒时让输出端写出缓冲中的记录，长时间没有新日志时已有的进度也能及时显示"""
+    
+    def __init__(self, log_queue, handler: logging.Handler, flush_interval: float):
+        super().__init__(log_queue, handler)
+        self.flush_interval = flush_interval
+    
+    def dequeue(self, block):
+        while True:
+            try:
+                return self.queue.get(block, timeout=self.flush_interval if block else None)
+            except queue.Empty:
+                if not block: raise
+                for handler in self.handlers: handler.flush()
+
+
+_LOG_LISTENER: Optional[logging.handlers.QueueListener] = None
+_LOG_SINK: Optional[logging.Handler] = None
+
+
+def configure_logging(level: int = logging.INFO, stream=None, path: Optional[str] = None, buffer_size: int = 64,
+                      flush_interval: float = 1.0) -> logging.handlers.QueueListener:
+    """为mygo日志安装异步缓冲输出：调用方只入队，后台线程格式化并按buffer_size批量写出；
+    WARNING及以上立即写出，其余记录在缓冲中最多停留约flush_interval秒"""
+    global _LOG_LISTENER, _LOG_SINK
+    shutdown_logging()
+    target = logging.FileHandler(path, encoding='utf-8') if path else _SafeStreamHandler(stream or sys.stdout)
+    target.setFormatter(logging.Formatter("%(message)s"))
+    _LOG_SINK = _TimedMemoryHandler(buffer_size, flush_interval, target=target)
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(_DeferredQueueHandler(log_queue))
+    logger.setLevel(level)
+    logger.propagate = False
+    _LOG_LISTENER = _FlushingQueueListener(log_queue, _LOG_SINK, flush_interval)
+    _LOG_LISTENER.start()
+    return _LOG_LISTENER
+
+
+def shutdown_logging():
+    """停止后台日志线程并写出缓冲中剩余的记录"""
+    global _LOG_LISTENER, _LOG_SINK
+    if _LOG_LISTENER is None: return
+    _LOG_LISTENER.stop()
+    for handler in [h for h in logger.handlers if isinstance(h, _DeferredQueueHandler)]:
+        logger.removeHandler(handler)
+    _LOG_SINK.flush()
+    _LOG_SINK.target.close()
+    _LOG_SINK.close()
+    _LOG_LISTENER = _LOG_SINK = None
+
+
+atexit.register(shutdown_logging)
+
+
+class _PromptDump:
+    """提示词日志的延迟格式化对象：只有记录真正写出时才拼接整段提示词"""
+    
+    def __init__(self, messages: List[Dict], task_type: str, llm_role: str):
+        self.messages, self.task_type, self.llm_role = messages, task_type, llm_role
+    
+    def __str__(self):
+        separator = "=" * 80
+        parts = [f"\n{separator}\nPROMPT - {self.task_type} [{self.llm_role}]\n{separator}"]
+        for message in self.messages:
+            parts.append(f"\n[{message.get('role', 'unknown').upper()}]:\n{'-'*60}\n{message.get('content', '')}\n{'-'*60}")
+        parts.append(f"{separator}\n")
+        return "\n".join(parts)
+
+
+# 当前任务是否被抽中输出完整提示词（在forward中按任务设置）
+_PROMPT_CAPTURE: contextvars.ContextVar[bool] = contextvars.ContextVar("mygo_prompt_capture", default=False)
+
+# 批量执行的资源限额(数据库信号量, LLM信号量)：由iter_tasks的工作协程设置，同一智能体上同时进行的多次批量执行互不影响；
+# 未设置时数据准备在事件循环中同步执行，LLM调用不限并发
+_RUN_LIMITS: contextvars.ContextVar[Optional[tuple]] = contextvars.ContextVar("mygo_run_limits", default=None)
+
+
+class TaskTrace:
+    """单个任务的结构化计时记录：按顺序保存各阶段span（耗时与属性）及缓存命中、降级等事件"""
+    
+    def __init__(self, target: str, task_id: Optional[str] = None):
+        self.target, self.task_id = target, task_id
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.spans: List[Dict[str, Any]] = []
+        self.events: List[Dict[str, Any]] = []
+        self.extra: Dict[str, Any] = {}
+    
+    @contextmanager
+    def span(self, name: str, **attrs):
+        record = {"name": name, "offset_ms": round((time.perf_counter() - self._start) * 1000, 3), **attrs}
+        start = time.perf_counter()
+        try:
+            yield record
+        except BaseException as e:
+            record["error"] = type(e).__name__
+            raise
+        finally:
+            record["duration_ms"] = round((time.perf_counter() - start) * 1000, 3)
+            self.spans.append(record)
+    
+    def event(self, name: str, **attrs):
+        self.events.append({"name": name, "offset_ms": round((time.perf_counter() - self._start) * 1000, 3), **attrs})
+    
+    def add_shared(self, source: "TaskTrace", batch_id: str, batch_size: int):
+        """复制多个任务共享的调用（如批量评论LLM调用）所记录的span与事件，换算到本trace的时间轴，
+        附加批次ID、批大小与按批大小均摊的耗时share_ms"""
+        shift = (source._start - self._start) * 1000
+        for span in source.spans:
+            self.spans.append({**span, "offset_ms": round(span["offset_ms"] + shift, 3), "batch_id": batch_id, "batch_size": batch_size,
+                               "share_ms": round(span["duration_ms"] / batch_size, 3)})
+        for event in source.events:
+            self.events.append({**event, "offset_ms": round(event["offset_ms"] + shift, 3), "batch_id": batch_id})
+    
+    def elapsed_ms(self) -> float:
+        return round((time.perf_counter() - self._start) * 1000, 3)
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {"task_id": self.task_id, "target": self.target, "started_at": self.started_at,
+                "duration_ms": self.elapsed_ms(), "spans": self.spans, "events": self.events, **self.extra}
+
+
+# 当前任务的trace；asyncio任务与to_thread线程会自动继承上下文
+_CURRENT_TRACE: contextvars.ContextVar[Optional[TaskTrace]] = contextvars.ContextVar("mygo_task_trace", default=None)
+
+
+@contextmanager
+def trace_span(name: str, **attrs):
+    """在当前任务trace中记录一个span；没有活动trace时只返回一个可写的空记录"""
+    trace = _CURRENT_TRACE.get()
+    if trace is None:
+        yield attrs
+        return
+    with trace.span(name, **attrs) as record:
+        yield record
+
+
+def trace_event(name: str, **attrs):
+    trace = _CURRENT_TRACE.get()
+    if trace is not None: trace.event(name, **attrs)
+
+
+class MetricsRegistry:
+    """进程内指标注册表：按名称保存最近的耗时/数值样本与计数器，输出p50/p95/p99摘要（线程安全）"""
+    
+    def __init__(self, max_samples: int = 10000):
+        self.max_samples = max_samples
+        self._samples: Dict[str, deque] = {}
+        self._counters: Dict[str, int] = {}
+        self._lock = threading.Lock()
+    
+    def observe(self, name: str, value: float):
+        with self._lock:
+            samples = self._samples.get(name)
+            if samples is None:
+                samples = self._samples[name] = deque(maxlen=self.max_samples)
+            samples.append(value)
+    
+    def incr(self, name: str, amount: int = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+    
+    def record_trace(self, trace: TaskTrace):
+        """把一个任务trace汇总进注册表：span耗时与token数作为样本，事件作为计数"""
+        self.observe(f"task.{trace.target}.ms", trace.elapsed_ms())
+        for span in trace.spans:
+            self.observe(f"{span['name']}.ms", span["duration_ms"])
+            for key in ("prompt_tokens", "response_tokens"):
+                if key in span: self.observe(f"{span['name']}.{key}", span[key])
+            if span.get("cache_hit"): self.incr(f"{span['name']}.cache_hits")
+            if "error" in span: self.incr(f"{span['name']}.errors")
+        for event in trace.events:
+            self.incr(f"event.{event['name']}" + (f".{event['kind']}" if "kind" in event else ""))
+            if "wait_ms" in event: self.observe(f"{event['name']}.wait_ms", event["wait_ms"])
+    
+    @staticmethod
+    def _percentile(ordered: List[float], pct: float) -> float:
+        return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+    
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            samples = {name: sorted(values) for name, values in self._samples.items() if values}
+            counters = dict(self._counters)
+        return {
+            "samples": {
+                name: {"count": len(values), "mean": round(sum(values) / len(values), 3),
+                       "p50": self._percentile(values, 50), "p95": self._percentile(values, 95),
+                       "p99": self._percentile(values, 99), "max": values[-1]}
+                for name, values in sorted(samples.items())
+            },
+            "counters": dict(sorted(counters.items())),
+        }
+    
+    def format_summary(self) -> str:
+        summary = self.summary()
+        lines = [f"{'metric':<40} {'count':>7} {'p50':>10} {'p95':>10} {'p99':>10} {'max':>10}"]
+        for name, stats in summary["samples"].items():
+            lines.append(f"{name:<40} {stats['count']:>7} {stats['p50']:>10.2f} {stats['p95']:>10.2f} {stats['p99']:>10.2f} {stats['max']:>10.2f}")
+        for name, value in summary["counters"].items():
+            lines.append(f"{name:<40} {value:>7}")
+        return "\n".join(lines)
+    
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+            self._counters.clear()
+
+
+METRICS = MetricsRegistry()
+
+
+class TraceWriter:
+    """把任务trace逐行追加写入JSONL文件（多个智能体/线程共享同一路径时共用一个写入器）"""
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8")
+    
+    def write(self, record: Dict[str, Any]):
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+    
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+_TRACE_WRITERS: Dict[str, TraceWriter] = {}
+
+
+def get_trace_writer(path: str) -> TraceWriter:
+    if path not in _TRACE_WRITERS:
+        _TRACE_WRITERS[path] = TraceWriter(path)
+    return _TRACE_WRITERS[path]
+
+
+class StageFailure(Exception):
+    """推荐阶段的LLM调用超时或出错（重试用尽），推荐流程据此直接改用启发式排序"""
+
+    def __init__(self, stage: str, error: Exception):
+        super().__init__(f"{stage}: {error}")
+        self.stage = stage
+        self.error = error
+
+
+class ReviewBatcher:
+    """评论撰写微批调度：在window秒内收集并发的评论任务，至多max_batch条打包成一次LLM调用，结果按条目编号分发给各自的等待者；
+    只凑到一条、整批失败或某条结果缺失/不合法时返回None，由调用方改为单独调用。
+    批量调用记录在单独的trace中，完成后复制到每个参与任务的trace（带批次ID与均摊耗时）"""
+
+    def __init__(self, run_batch, max_batch: int = 8, window: float = 0.02):
+        self._run_batch = run_batch  # async (条目列表) -> {条目编号(从1开始): 结果}
+        self.max_batch = max_batch
+        self.window = window
+        self._loop = None
+        self._pending: List[tuple] = []
+        self._timer = None
+        self._dispatching = set()
+        self.stats = {"batches": 0, "batched": 0, "singles": 0, "fallbacks": 0}
+
+    async def submit(self, entry: str) -> Optional[Dict[str, Any]]:
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop, self._pending, self._timer = loop, [], None
+        future = loop.create_future()
+        self._pending.append((entry, future, _CURRENT_TRACE.get()))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch = [pending for pending in self._pending if not pending[1].done()]
+        self._pending = []
+        if len(batch) == 1:
+            self.stats["singles"] += 1
+            batch[0][1].set_result(None)
+        elif batch:
+            task = asyncio.ensure_future(self._dispatch(batch))
+            self._dispatching.add(task)
+            task.add_done_callback(self._dispatching.discard)
+
+    async def _dispatch(self, batch: List[tuple]):
+        self.stats["batches"] += 1
+        self.stats["batched"] += len(batch)
+        batch_id = f"review_batch-{self.stats['batches']}"
+        traces = [trace for _, _, trace in batch if trace is not None]
+        # 本协程运行在独立的任务中，设置的trace只影响批量调用本身
+        batch_trace = TaskTrace("review_batch", batch_id) if traces else None
+        _CURRENT_TRACE.set(batch_trace)
+        try:
+            results = await self._run_batch([entry for entry, _, _ in batch])
+        except Exception as e:
+            logger.warning("批量评论生成失败，改为单独调用: %s", e)
+            results = {}
+        for trace in traces: trace.add_shared(batch_trace, batch_id, len(batch))
+        for index, (_, future, _) in enumerate(batch, 1):
+            if future.done(): continue
+            result = results.get(index)
+            if result is None: self.stats["fallbacks"] += 1
+            future.set_result(result)
+
+
+class PromptTemplate:
+    """阶段提示词模板：system为固定字符串（逐字节稳定，便于服务端前缀缓存复用），user模板在导入时一次性编译为片段列表
+
+    classic布局沿用原有提示词；prefix布局把静态的任务说明与输出格式（rules）并入system，
+    用户与候选场所数据按sections声明的固定顺序放在末尾，使同一阶段的请求共享尽可能长的前缀"""
+
+    def __init__(self, name: str, system: str, user: str, rules: str = "", sections: Optional[List[tuple]] = None):
+        self.name = name
+        self.system = system
+        self.system_tokens = estimate_tokens(system)
+        self._segments = self._compile(name, user)
+        self.fields = frozenset(field for _, field, _ in self._segments if field)
+        # prefix布局：sections为(kind, 模板)列表，kind为user（用户数据）或venues（候选场所块）
+        self.prefix_system = f"{system}\n\n{rules}" if rules else system
+        self._sections = [(kind, self._compile(name, text)) for kind, text in (sections or [])]
+        section_fields = frozenset(field for _, segments in self._sections for _, field, _ in segments if field)
+        if self._sections and section_fields != self.fields:
+            raise ValueError(f"模板{name}的sections字段与user模板不一致: {sorted(section_fields ^ self.fields)}")
+
+    @staticmethod
+    def _compile(name: str, template: str) -> List[tuple]:
+        segments = []  # (字面文本, 字段名或None, 格式说明)
+        for literal, field, spec, conversion in string.Formatter().parse(template):
+            if field is not None and (not field.isidentifier() or conversion):
+                raise ValueError(f"模板{name}仅支持简单字段: {{{field}}}")
+            segments.append((literal, field, spec or ""))
+        return segments
+
+    @staticmethod
+    def _fill(segments: List[tuple], fields: Dict[str, Any]) -> str:
+        parts = []
+        for literal, field, spec in segments:
+            parts.append(literal)
+            if field is not None:
+                value = fields[field]
+                parts.append(format(value, spec) if spec else str(value))
+        return "".join(parts)
+
+    def render_user(self, **fields) -> str:
+        return self._fill(self._segments, fields)
+
+    def render_sections(self, venues_first: bool = False, **fields) -> str:
+        """只渲染数据部分（不含任务说明与输出格式），空的部分省略"""
+        blocks = {"user": [], "venues": []}
+        for kind, segments in self._sections:
+            text = self._fill(segments, fields)
+            if text.strip(): blocks[kind].append(text)
+        ordered = blocks["venues"] + blocks["user"] if venues_first else blocks["user"] + blocks["venues"]
+        return "\n\n".join(ordered)
+
+    def render(self, layout: str = "classic", venues_first: bool = False, **fields) -> List[Dict[str, str]]:
+        if layout != "prefix" or not self._sections:
+            return [{"role": "system", "content": self.system}, {"role": "user", "content": self.render_user(**fields)}]
+        return [{"role": "system", "content": self.prefix_system}, {"role": "user", "content": self.render_sections(venues_first, **fields)}]
+
+
+# 各阶段提示词注册表：导入时编译一次，调用时只做字段填充
+PROMPT_TEMPLATES: Dict[str, PromptTemplate] = {}
+
+PROMPT_TEMPLATES["intent"] = PromptTemplate(
+    "intent",
+    system="""你是资深的用户行为分析专家。请严格按照要求格式输出：1)用户画像（一句话描述用户特征和偏好特质）2)主要需求（最核心的具体需求）3)次要需求（重要但非核心的具体需求）4)潜在需求（可能感兴趣但未明确表达的具体需求）。每项都要具体明确，不要添加其他内容。""",
+    user="""
+用户基本信息: 
+- 用户名: {user_name}
+- 平均评分: {avg_rating}星
+- 评论总数: {review_count}条
+- 访问地点的平均评分: {visited_avg_rating}星
+
+{category_analysis}
+
+{user_relevant_reviews}
+
+{mention_context}
+
+请基于用户的历史行为模式，分析用户的基本画像和多层次需求。
+
+输出格式：
+```json
+{{
+    "user_profile": "用户xxx是一名……的用户，偏好……特质",
+    "primary_need": "具体的主要需求，如'美甲服务'",
+    "secondary_need": "具体的次要需求，如'美发服务'", 
+    "potential_need": "具体的潜在需求，如'美容护理'"
+}}
+```""",
+    rules="""请基于用户的历史行为模式，分析用户的基本画像和多层次需求。
+
+输出格式：
+```json
+{
+    "user_profile": "用户xxx是一名……的用户，偏好……特质",
+    "primary_need": "具体的主要需求，如'美甲服务'",
+    "secondary_need": "具体的次要需求，如'美发服务'", 
+    "potential_need": "具体的潜在需求，如'美容护理'"
+}
+```""",
+    sections=[
+        ("user", """用户基本信息:
+- 用户名: {user_name}
+- 平均评分: {avg_rating}星
+- 评论总数: {review_count}条
+- 访问地点的平均评分: {visited_avg_rating}星"""),
+        ("user", "{category_analysis}"),
+        ("user", "{user_relevant_reviews}"),
+        ("user", "{mention_context}"),
+    ],
+)
+
+PROMPT_TEMPLATES["screening"] = PromptTemplate(
+    "screening",
+    system="""你是推荐系统的主要需求筛选专家，专门负责识别和推荐满足用户核心需求的场所。
+
+你的任务：
+基于用户画像和主要需求，从所有候选场所中识别并选出10个最符合用户主要需求的地点。
+
+重要原则：
+1. 严格聚焦于用户的主要需求，优先识别和推荐直接满足主要需求的场所
+2. 可以考虑能够间接满足主要需求的相关场所
+3. 优先考虑场所质量和用户评分习惯的匹配
+4. 重视用户历史行为模式和偏好特质
+5. 确保推荐的多样性，避免过于单一""",
+    user="""用户画像: {user_profile}
+
+主要需求: {primary_need}
+次要需求: {secondary_need}
+潜在需求: {potential_need}
+
+用户基本信息:
+- 用户名: {user_name}
+- 平均评分: {avg_rating}星
+- 评论总数: {review_count}条
+- 访问地点的平均评分: {visited_avg_rating}星
+
+{user_relevant_reviews}
+
+所有候选场所列表:
+{venues_formatted}
+
+请从以上所有候选场所中识别并选择10个最能满足用户主要需求"{primary_need}"的场所。
+【注意：深度思考后再回答】
+
+输出格式：
+```json
+{{
+    "selected_venues": [
+        {{
+            "venue_id": "场所ID",
+            "venue_name": "场所名称",
+            "selection_reason": "选择理由，说明如何满足主要需求"
+        }}
+    ]
+}}
+```""",
+    rules="""请从下方所有候选场所中识别并选择10个最能满足用户主要需求的场所。
+【注意：深度思考后再回答】
+
+输出格式：
+```json
+{
+    "selected_venues": [
+        {
+            "venue_id": "场所ID",
+            "venue_name": "场所名称",
+            "selection_reason": "选择理由，说明如何满足主要需求"
+        }
+    ]
+}
+```""",
+    sections=[
+        ("user", """用户画像: {user_profile}
+
+主要需求: {primary_need}
+次要需求: {secondary_need}
+潜在需求: {potential_need}"""),
+        ("user", """用户基本信息:
+- 用户名: {user_name}
+- 平均评分: {avg_rating}星
+- 评论总数: {review_count}条
+- 访问地点的平均评分: {visited_avg_rating}星"""),
+        ("user", "{user_relevant_reviews}"),
+        ("venues", """所有候选场所列表:
+{venues_formatted}"""),
+    ],
+)
+
+PROMPT_TEMPLATES["final"] = PromptTemplate(
+    "final",
+    system="""你是推荐系统的最终决策专家，需要从10个主要需求初筛推荐中选出最终的5个推荐。
+
+你的任务：
+综合考虑用户画像、主要需求匹配度、场所质量，选出用户最有可能访问的5个地点，并按优先级排序。
+
+决策原则：
+1. 严格聚焦主要需求，优先选择最符合核心需求的场所
+2. 第一个推荐尤其重要，应该是最符合用户画像和主要需求的
+3. 考虑场所质量和用户评分习惯的匹配
+4. 适度考虑多样性，但不偏离主要需求
+5. 重点参考用户评论了解场所的真实体验""",
+    user="""用户画像: {user_profile}
+
+主要需求: {primary_need}
+
+用户档案:
+- 历史平均评分: {avg_rating}星
+- 评论数量: {review_count}
+- 访问地点的平均评分: {visited_avg_rating}星
+
+初筛选出的10个主要需求场所:
+{venues_text}
+
+请从以上10个场所中选择5个最终推荐，按优先级从高到低排序。
+
+【注意：深度思考后再回答】
+
+输出格式：
+```json
+{{
+    "final_recommendations": ["场所ID1", "场所ID2", "场所ID3", "场所ID4", "场所ID5"],
+    "selection_rationale": "详细选择理由，说明为什么选择这5个场所以及优先级排序的逻辑"
+}}
+```""",
+    rules="""请从下方10个场所中选择5个最终推荐，按优先级从高到低排序。
+
+【注意：深度思考后再回答】
+
+输出格式：
+```json
+{
+    "final_recommendations": ["场所ID1", "场所ID2", "场所ID3", "场所ID4", "场所ID5"],
+    "selection_rationale": "详细选择理由，说明为什么选择这5个场所以及优先级排序的逻辑"
+}
+```""",
+    sections=[
+        ("user", """用户画像: {user_profile}
+
+主要需求: {primary_need}"""),
+        ("user", """用户档案:
+- 历史平均评分: {avg_rating}星
+- 评论数量: {review_count}
+- 访问地点的平均评分: {visited_avg_rating}星"""),
+        ("venues", """初筛选出的10个主要需求场所:
+{venues_text}"""),
+    ],
+)
+
+PROMPT_TEMPLATES["secondary"] = PromptTemplate(
+    "secondary",
+    system="""你是推荐系统的次要需求专家，负责识别和推荐满足用户次要需求和潜在需求的场所。
+
+你的任务：
+基于用户画像、次要需求和潜在需求，从剩余候选场所中识别并选出3个推荐（优先次要需求，适当考虑潜在需求）。
+
+推荐原则：
+1. 优先识别和推荐能满足次要需求的场所
+2. 适当考虑能满足潜在需求的场所，发掘用户可能感兴趣的新体验
+3. 结合用户画像和偏好特质
+4. 确保推荐的场所质量符合用户标准
+5. 提供与主要需求不同的多样化体验""",
+    user="""用户画像: {user_profile}
+
+次要需求: {secondary_need}
+潜在需求: {potential_need}
+
+用户基本信息:
+- 用户名: {user_name}
+- 平均评分: {avg_rating}星
+- 评论总数: {review_count}条
+- 访问地点的平均评分: {visited_avg_rating}星
+
+剩余候选场所（已排除主要需求推荐）:
+{venues_formatted}
+
+请从以上场所中识别并选择3个能满足次要需求或潜在需求的场所推荐。
+【注意：深度思考后再回答】
+
+输出格式：
+```json
+{{
+    "recommended_venues": [
+        {{
+            "venue_id": "场所ID",
+            "venue_name": "场所名称",
+            "need_type": "secondary或potential",
+            "selection_reason": "选择理由，说明满足哪种需求"
+        }}
+    ]
+}}
+```""",
+    rules="""请从下方场所中识别并选择3个能满足次要需求或潜在需求的场所推荐。
+【注意：深度思考后再回答】
+
+输出格式：
+```json
+{
+    "recommended_venues": [
+        {
+            "venue_id": "场所ID",
+            "venue_name": "场所名称",
+            "need_type": "secondary或potential",
+            "selection_reason": "选择理由，说明满足哪种需求"
+        }
+    ]
+}
+```""",
+    sections=[
+        ("user", """用户画像: {user_profile}
+
+次要需求: {secondary_need}
+潜在需求: {potential_need}"""),
+        ("user", """用户基本信息:
+- 用户名: {user_name}
+- 平均评分: {avg_rating}星
+- 评论总数: {review_count}条
+- 访问地点的平均评分: {visited_avg_rating}星"""),
+        ("venues", """剩余候选场所（已排除主要需求推荐）:
+{venues_formatted}"""),
+    ],
+)
+
+PROMPT_TEMPLATES["fast"] = PromptTemplate(
+    "fast",
+    system="""你是推荐系统的综合决策专家，需要在一次分析中完成用户需求识别与场所推荐。
+
+你的任务：
+1. 分析用户画像，识别主要需求、次要需求和潜在需求
+2. 从候选场所中选出5个最满足主要需求的场所，按优先级从高到低排序
+3. 从其余候选场所中选出3个满足次要需求或潜在需求的场所
+
+决策原则：
+1. 主要推荐严格聚焦主要需求，第一个推荐尤其重要
+2. 考虑场所质量和用户评分习惯的匹配
+3. 次要/潜在推荐不得与主要推荐重复，提供与主要需求不同的多样化体验
+4. 只能使用候选列表中给出的场所ID""",
+    user="""用户基本信息:
+- 用户名: {user_name}
+- 平均评分: {avg_rating}星
+- 评论总数: {review_count}条
+- 访问地点的平均评分: {visited_avg_rating}星
+
+{category_analysis}
+
+{user_relevant_reviews}
+
+{mention_context}
+
+所有候选场所列表:
+{venues_formatted}
+
+请分析用户画像与多层次需求，并给出5个主要需求推荐和3个次要/潜在需求推荐。
+
+输出格式：
+```json
+{{
+    "user_profile": "用户xxx是一名……的用户，偏好……特质",
+    "primary_need": "具体的主要需求",
+    "secondary_need": "具体的次要需求",
+    "potential_need": "具体的潜在需求",
+    "primary_recommendations": ["场所ID1", "场所ID2", "场所ID3", "场所ID4", "场所ID5"],
+    "secondary_recommendations": [
+        {{
+            "venue_id": "场所ID",
+            "venue_name": "场所名称",
+            "need_type": "secondary或potential",
+            "selection_reason": "选择理由，说明满足哪种需求"
+        }}
+    ]
+}}
+```""",
+    rules="""请分析用户画像与多层次需求，并给出5个主要需求推荐和3个次要/潜在需求推荐。
+
+输出格式：
+```json
+{
+    "user_profile": "用户xxx是一名……的用户，偏好……特质",
+    "primary_need": "具体的主要需求",
+    "secondary_need": "具体的次要需求",
+    "potential_need": "具体的潜在需求",
+    "primary_recommendations": ["场所ID1", "场所ID2", "场所ID3", "场所ID4", "场所ID5"],
+    "secondary_recommendations": [
+        {
+            "venue_id": "场所ID",
+            "venue_name": "场所名称",
+            "need_type": "secondary或potential",
+            "selection_reason": "选择理由，说明满足哪种需求"
+        }
+    ]
+}
+```""",
+    sections=[
+        ("user", """用户基本信息:
+- 用户名: {user_name}
+- 平均评分: {avg_rating}星
+- 评论总数: {review_count}条
+- 访问地点的平均评分: {visited_avg_rating}星"""),
+        ("user", "{category_analysis}"),
+        ("user", "{user_relevant_reviews}"),
+        ("user", "{mention_context}"),
+        ("venues", """所有候选场所列表:
+{venues_formatted}"""),
+    ],
+)
+
+PROMPT_TEMPLATES["review"] = PromptTemplate(
+    "review",
+    system="""你是一个评价写手，需要根据用户的历史行为模式为场所写出符合该用户风格的评价。
+
+要求：
+1. 评分要符合用户的评分习惯和对该类场所的偏好
+2. 评价文本要模仿用户的写作风格，长度控制在30-50词
+3. 内容要合理，关注用户历史上重视的场所特征""",
+    user="""用户偏好分析：
+{preference_summary}
+
+{user_relevant_reviews}
+
+目标场所信息：
+- 场所名称: {item_name}
+- 场所类别: {target_category}
+- 该场所平均评分: {item_avg_rating:.1f}星
+
+请根据用户的偏好模式生成一条评价。
+
+输出格式：
+```json
+{{
+    "stars": [1-5的整数评分],
+    "review": "[模仿用户风格的评价文本，30-50词]"
+}}
+```""",
+    rules="""请根据用户的偏好模式生成一条评价。
+
+输出格式：
+```json
+{
+    "stars": [1-5的整数评分],
+    "review": "[模仿用户风格的评价文本，30-50词]"
+}
+```""",
+    sections=[
+        ("user", """用户偏好分析：
+{preference_summary}"""),
+        ("user", "{user_relevant_reviews}"),
+        ("venues", """目标场所信息：
+- 场所名称: {item_name}
+- 场所类别: {target_category}
+- 该场所平均评分: {item_avg_rating:.1f}星"""),
+    ],
+)
+
+PROMPT_TEMPLATES["review_batch"] = PromptTemplate(
+    "review_batch",
+    system="""你是一个评价写手，需要根据多位用户各自的历史行为模式，分别为每位用户的目标场所写出符合该用户风格的评价。
+
+要求：
+1. 每个条目相互独立，只参考该条目中的用户偏好与场所信息
+2. 评分要符合该用户的评分习惯和对该类场所的偏好
+3. 评价文本要模仿该用户的写作风格，长度控制在30-50词
+4. 内容要合理，关注该用户历史上重视的场所特征""",
+    user="""以下共有{count}个评价任务：
+
+{entries}
+
+请为每个条目分别生成一条评价，id与条目编号一致，不要遗漏条目。
+
+输出格式：
+```json
+{{
+    "reviews": [
+        {{"id": 条目编号, "stars": [1-5的整数评分], "review": "[模仿该用户风格的评价文本，30-50词]"}}
+    ]
+}}
+```""",
+    rules="""请为下方每个条目分别生成一条评价，id与条目编号一致，不要遗漏条目。
+
+输出格式：
+```json
+{
+    "reviews": [
+        {"id": 条目编号, "stars": [1-5的整数评分], "review": "[模仿该用户风格的评价文本，30-50词]"}
+    ]
+}
+```""",
+    sections=[
+        ("user", "以下共有{count}个评价任务："),
+        ("user", "{entries}"),
+    ],
+)
+
 
 class SimplifiedRecommendationAgent(IndividualAgentBase):
     """精简版推荐智能体 - 单LLM初筛 + 最终选择 + 用户名提及分析"""
     
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.print_prompts = kwargs.get('print_prompts', True)
-        self.debug_communication = kwargs.get('debug_communication', True)
-    
-    def safe_print(self, text):
-        try: print(text)
-        except: print(str(text).encode('ascii', 'ignore').decode('ascii'))
+        self._configure(kwargs)
+
+    def _configure(self, options: Dict[str, Any]):
+        """读取智能体运行选项（与基类初始化分离，便于离线基准测试直接构造）"""
+        # 进度输出走mygo日志（INFO级别）；未显式指定时跟随日志级别，默认关闭
+        self.print_prompts = options.get('print_prompts')
+        if self.print_prompts is None:
+            self.print_prompts = logger.isEnabledFor(logging.INFO)
+        elif self.print_prompts and not (logger.isEnabledFor(logging.INFO) and logger.hasHandlers()):
+            configure_logging(logging.INFO)
+        self.debug_communication = options.get('debug_communication', False)
+        self.prompt_sample_rate = options.get('prompt_sample_rate', 0.1)  # 输出完整提示词的任务比例（按任务确定性抽样）
+        self.use_shared_cache = options.get('use_shared_cache', True)
+        self.venue_summary_cache = options.get('venue_summary_cache', True)  # 场所摘要块进程级缓存（按评论版本失效）
+        self.bulk_fetch = options.get('bulk_fetch', True)
+        self.compact_reviews = options.get('compact_reviews', True)  # 场所评论以CompactReviewList缓存
+        self.bulk_fetch_workers = options.get('bulk_fetch_workers', 8)
+        # 提示词布局：classic为原有布局；prefix把静态说明与输出格式前置，venues_first时候选场所块排在用户数据之前
+        self.message_layout = options.get('message_layout', 'classic')
+        self.venues_first = options.get('venues_first', False)
+        self.prompt_budgets = {stage: {**sections, **options.get('prompt_budgets', {}).get(stage, {})}
+                               for stage, sections in DEFAULT_PROMPT_BUDGETS.items()}
+        self.prerank_top_k = options.get('prerank_top_k')  # 初筛前本地预排序保留的候选数，None为不裁剪
+        self.review_ranking = options.get('review_ranking', 'recency')  # recency | useful | balanced（按类别轮流选取）
+        self.mention_mode = options.get('mention_mode', 'index')  # index: 倒排索引查找; scan: 逐条分词（参考实现）
+        self.recommend_mode = options.get('recommend_mode', 'multi_stage')  # multi_stage: 四阶段流程; fast: 单次LLM调用; heuristic: 不调用LLM
+        self.fast_mode_stats = {"calls": 0, "fallbacks": 0}
+        self.heuristic_weights = {**DEFAULT_HEURISTIC_WEIGHTS, **options.get('heuristic_weights', {})}
+        self.load_shed_threshold = options.get('load_shed_threshold')  # 排队中的LLM请求数达到该值时改用启发式排序
+        self.heuristic_stats = {"errors": 0, "insufficient": 0, "load_shed": 0, "stage_failure": 0}
+        self.prefilter_rules = options.get('prefilter_rules', DEFAULT_PREFILTER_RULES)
+        for params in self.prefilter_rules or []:
+            if not isinstance(params, dict) or params.get("rule") not in PREFILTER_RULES:
+                raise ValueError(f"未知的预筛选规则: {params!r}（可用规则: {', '.join(PREFILTER_RULES)}）")
+        self.prefilter_min_keep = options.get('prefilter_min_keep')  # 规则过滤后至少保留的候选数，None为不限制
+        self.prefilter_stats: Dict[str, int] = {}  # 规则名 -> 累计过滤的候选数；guarded为因min_keep被跳过的次数
+        self._prefilter_stats_lock = threading.Lock()  # 预筛选在数据准备线程中执行，累加统计需加锁
+        self._llm_inflight = 0
+        # 流式调用：stream_endpoint为OpenAIStreamClient参数；未配置时使用LLM对象上名为stream_method的异步迭代方法
+        self.stream_llm = options.get('stream_llm', False)
+        self.stream_method = options.get('stream_method', 'astream_request')
+        self._stream_client: Optional[OpenAIStreamClient] = OpenAIStreamClient(**options['stream_endpoint']) if options.get('stream_endpoint') else None
+        self.stream_stats = {"requests": 0, "early_stops": 0}
+        policies = options.get('llm_policy', {})
+        base_policy = {**DEFAULT_LLM_POLICY, **policies.get('default', {})}
+        self.llm_policies = {stage: {**base_policy, **policies.get(stage, {})} for stage in (*STAGE_REQUIRED_KEYS, 'llm')}
+        self.llm_policy_stats = {"timeouts": 0, "errors": 0, "retries": 0, "hedges": 0, "hedge_wins": 0}
+        self.stage_failures: Dict[str, int] = {}
+        # 评论撰写微批：review_batch_size > 1时把window秒内并发的评论任务合并为一次LLM调用
+        self.review_batch_size = options.get('review_batch_size', 1)
+        self.review_batch_window = options.get('review_batch_window', 0.02)
+        self._review_batcher: Optional[ReviewBatcher] = (
+            ReviewBatcher(self._review_batch_llm, self.review_batch_size, self.review_batch_window) if self.review_batch_size > 1 else None
+        )
+        self.speculative_stage4 = options.get('speculative_stage4', False)
+        self.speculation_stats = {"runs": 0, "kept": 0, "filtered": 0, "discarded": 0}
+        # LLM响应缓存：llm_cache_path为空时关闭；llm_cache_mode为readonly时只回放不写入；llm_cache_commit_every条写入提交一次
+        self.llm_model = options.get('llm_model')
+        self._llm_cache: Optional[LLMResponseCache] = None
+        if options.get('llm_cache_path'):
+            self._llm_cache = get_llm_response_cache(
+                options['llm_cache_path'],
+                max_bytes=int(options.get('llm_cache_max_mb', 512) * 1024 * 1024),
+                readonly=options.get('llm_cache_mode', 'readwrite') == 'readonly',
+                commit_every=int(options.get('llm_cache_commit_every', 32)),
+            )
+        # 预计算用户画像存储：profile_store_path为空时每个任务现场计算；profile_users_path为数据集用户文件，供全量预计算
+        self.profile_users_path = options.get('profile_users_path')
+        self._profile_store: Optional[UserProfileStore] = None
+        if options.get('profile_store_path'):
+            self._profile_store = get_user_profile_store(
+                options['profile_store_path'], readonly=options.get('profile_store_mode', 'readwrite') == 'readonly'
+            )
+        # 结构化计时：collect_metrics汇总到进程内METRICS注册表，trace_path非空时每个任务追加一行JSONL
+        self.collect_metrics = options.get('collect_metrics', True)
+        self._trace_writer: Optional[TraceWriter] = get_trace_writer(options['trace_path']) if options.get('trace_path') else None
+        self.last_trace: Optional[Dict[str, Any]] = None
 
-    def _print_prompt(self, messages: List[Dict], task_type: str, llm_role: str = ""):
-        if not self.print_prompts: return
-        separator = "=" * 80
-        self.safe_print(f"\n{separator}\nPROMPT - {task_type} [{llm_role}]\n{separator}")
-        for message in messages:
-            self.safe_print(f"\n[{message.get('role', 'unknown').upper()}]:\n{'-'*60}\n{message.get('content', '')}\n{'-'*60}")
-        self.safe_print(f"{separator}\n")
+    def safe_print(self, text, level: int = logging.INFO):
+        logger.log(level, text)
 
-    def _parse_json(self, response: str) -> Dict:
+    def _print_prompt(self, messages: List[Dict], task_type: str, llm_role: str = ""):
+        if not _PROMPT_CAPTURE.get() or not prompt_logger.isEnabledFor(logging.INFO): return
+        prompt_logger.info("%s", _PromptDump(messages, task_type, llm_role))
+
+    def _should_capture_prompts(self, task_context: Dict[str, Any]) -> bool:
+        """按prompt_sample_rate确定性地抽样任务（同一任务每次结果相同），抽中的任务输出全部阶段的提示词"""
+        if self.prompt_sample_rate <= 0 or not prompt_logger.isEnabledFor(logging.INFO): return False
+        if self.prompt_sample_rate >= 1: return True
+        key = str(task_context.get("task_id") or json.dumps(task_context, sort_keys=True, default=str))
+        return zlib.crc32(key.encode("utf-8")) / 2 ** 32 < self.prompt_sample_rate
+
+    def _llm_model_name(self) -> str:
+        if self.llm_model: return self.llm_model
+        try:
+            model = getattr(self.llm, 'model', None) or getattr(self.llm.configs[0], 'model', None)
+        except Exception:
+            model = None
+        self.llm_model = str(model) if model else 'unknown'
+        return self.llm_model
+
+    async def _llm_request(self, messages: List[Dict], stage: str = "llm") -> str:
+        """所有阶段统一的LLM调用入口：先查响应缓存，再按阶段策略调用；按阶段记录计时与token数。
+        只缓存能解析出阶段必需键的响应，已缓存但无法解析的响应视为未命中并重新请求"""
+        prompt_text = "".join(str(m.get('content', '')) for m in messages)
+        with trace_span(f"llm.{stage}", prompt_chars=len(prompt_text), prompt_tokens=estimate_tokens(prompt_text)) as span:
+            cache_key = None
+            if self._llm_cache is not None:
+                cache_key = self._llm_cache.make_key(messages, self._llm_model_name())
+                cached = self._llm_cache.get(cache_key)
+                if cached is not None and not self._cacheable_response(cached, stage):
+                    span["cache_rejected"] = True
+                    cached = None
+                span["cache_hit"] = cached is not None
+                if cached is not None:
+                    span["response_chars"], span["response_tokens"] = len(cached), estimate_tokens(cached)
+                    return cached
+            
+            response = await self._call_with_policy(messages, stage, span)
+            span["response_chars"], span["response_tokens"] = len(response or ""), estimate_tokens(response or "")
+        
+        if cache_key is not None and response and self._cacheable_response(response, stage):
+            await self._run_db(self._llm_cache.put, cache_key, self._llm_model_name(), response)
+        return response
+
+    @staticmethod
+    def _cacheable_response(response: str, stage: str) -> bool:
+        """响应能否缓存：能完整解析出该阶段的全部必需键（未定义必需键的调用只要求非空）"""
+        required_keys = STAGE_REQUIRED_KEYS.get(stage)
+        if not required_keys: return bool(response)
+        extractor = IncrementalJSONExtractor(required_keys, fence=_JSON_FENCE)
+        extractor.feed(response)
+        return bool(extractor.finish()) and extractor.error is None
+
+    async def _call_with_policy(self, messages: List[Dict], stage: str, span: Dict[str, Any]) -> str:
+        """按阶段策略调用LLM：超时、带抖动的指数退避重试、可选对冲请求；重试用尽后抛出最后一次的异常。
+        每次请求记录为一个llm.<阶段>.attempt子span，span中记录请求次数与返回结果的那次请求"""
+        policy = self.llm_policies.get(stage, self.llm_policies['llm'])
+        response, error = "", None
+        for attempt in range(max(1, policy['retries'] + 1)):
+            if attempt:
+                self.llm_policy_stats["retries"] += 1
+                delay = min(policy['backoff_max'], policy['backoff'] * 2 ** (attempt - 1))
+                await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+            try:
+                response, error = await self._hedged_attempt(messages, stage, span, policy, attempt), None
+                if response: break
+            except asyncio.TimeoutError as e:
+                error = e
+                self.llm_policy_stats["timeouts"] += 1
+                trace_event("llm_timeout", stage=stage, attempt=attempt)
+            except Exception as e:
+                error = e
+                self.llm_policy_stats["errors"] += 1
+                trace_event("llm_error", stage=stage, attempt=attempt, error=type(e).__name__)
+        span["attempts"] = attempt + 1
+        if error is not None: raise error
+        return response
+
+    async def _hedged_attempt(self, messages: List[Dict], stage: str, span: Dict[str, Any], policy: Dict[str, Any], attempt: int = 0) -> str:
+        """超过hedge_after秒仍未返回时再发一个相同请求，取先成功的结果并取消另一个"""
+        if not policy['hedge_after']:
+            response = await self._attempt_llm(messages, stage, policy['timeout'], attempt=attempt)
+            if response: span["winning_attempt"] = attempt
+            return response
+        primary = asyncio.ensure_future(self._attempt_llm(messages, stage, policy['timeout'], attempt=attempt))
+        pending, error = {primary}, None
+        try:
+            done, pending = await asyncio.wait(pending, timeout=policy['hedge_after'])
+            if not done:
+                self.llm_policy_stats["hedges"] += 1
+                span["hedged"] = True
+                pending.add(asyncio.ensure_future(self._attempt_llm(messages, stage, policy['timeout'], attempt=attempt, hedge=True)))
+            while True:
+                for task in done:
+                    if task.exception() is None and task.result():
+                        if task is not primary: self.llm_policy_stats["hedge_wins"] += 1
+                        span["winning_attempt"], span["hedge_won"] = attempt, task is not primary
+                        return task.result()
+                    error = task.exception() or error
+                if not pending: break
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in pending: task.cancel()
+        if error is not None: raise error
+        return ""
+
+    async def _attempt_llm(self, messages: List[Dict], stage: str, timeout: Optional[float], attempt: int = 0, hedge: bool = False) -> str:
+        """单次LLM调用（记录为独立的子span，对冲请求之间互不覆盖）：批量执行时受LLM并发限额约束，超时只计算调用本身（不含排队）"""
+        self._llm_inflight += 1
+        try:
+            with trace_span(f"llm.{stage}.attempt", attempt=attempt, hedge=hedge) as span:
+                limits = _RUN_LIMITS.get()
+                if limits is None:
+                    return await asyncio.wait_for(self._call_llm(messages, stage, span), timeout)
+                wait_start = time.perf_counter()
+                async with limits[1]:
+                    span["queue_ms"] = round((time.perf_counter() - wait_start) * 1000, 3)
+                    return await asyncio.wait_for(self._call_llm(messages, stage, span), timeout)
+        finally:
+            self._llm_inflight -= 1
+
+    async def _call_llm(self, messages: List[Dict], stage: str, span: Dict[str, Any]) -> str:
+        """流式模式下边接收边解析，阶段所需的键读完即终止生成；不支持流式时整段请求"""
+        required_keys = STAGE_REQUIRED_KEYS.get(stage)
+        if self.stream_llm and required_keys:
+            stream = await self._open_llm_stream(messages)
+            if stream is not None:
+                return await self._consume_stream(stream, required_keys, span)
+        return await self.llm.atext_request(messages)
+
+    async def _open_llm_stream(self, messages: List[Dict]):
+        if self._stream_client is not None:
+            return self._stream_client.stream(messages)
+        method = getattr(self.llm, self.stream_method, None) if self.stream_method else None
+        if method is None: return None
+        stream = method(messages)
+        if inspect.isawaitable(stream): stream = await stream
+        return stream
+
+    async def _consume_stream(self, stream, required_keys, span: Dict[str, Any]) -> str:
+        extractor = IncrementalJSONExtractor(required_keys, fence=_JSON_FENCE)
+        pieces: List[str] = []
+        start = time.perf_counter()
+        self.stream_stats["requests"] += 1
+        span["streamed"] = True
+        try:
+            async for piece in stream:
+                if not pieces: span["ttft_ms"] = round((time.perf_counter() - start) * 1000, 3)
+                pieces.append(piece)
+                if extractor.feed(piece):
+                    # 结构化输出已完整，关闭流以取消其余生成（通常是JSON之后的长篇推理）
+                    span["early_stop"] = True
+                    self.stream_stats["early_stops"] += 1
+                    break
+        finally:
+            aclose = getattr(stream, "aclose", None)
+            if aclose is not None: await aclose()
+        return "".join(pieces)
+
+    async def _run_db(self, func, *args):
+        """执行数据准备函数；批量执行时在线程中运行并受数据库并发限额约束，避免阻塞事件循环"""
+        limits = _RUN_LIMITS.get()
+        if limits is None:
+            return func(*args)
+        wait_start = time.perf_counter()
+        async with limits[0]:
+            trace_event("db_queue", wait_ms=round((time.perf_counter() - wait_start) * 1000, 3))
+            return await asyncio.to_thread(func, *args)
+
+    def _prefetch_task_data(self, tool, candidate_list: List[str], user_reviews: List[Dict]):
+        """批量模式：一次性预取候选场所的信息与评论，以及用户历史评论涉及的场所信息；失败时回退到逐个查询"""
+        if not self.bulk_fetch or not isinstance(tool, CachedUIRTool): return
         try:
-            json_text = response.split("```json")[1].split("```")[0].strip() if "```json" in response else response
-            json_text = re.sub(r'//.*', '', json_text)
-            json_text = re.sub(r',(\s*[}\]])', r'\1', json_text)
-            return json.loads(json_text.strip())
-        except: return {}
+            history_item_ids = [r.get('item_id') for r in user_reviews or []]
+            with trace_span("db.prefetch") as span:
+                span["fetched"] = tool.prefetch(list(candidate_list) + history_item_ids, review_item_ids=candidate_list, max_workers=self.bulk_fetch_workers)
+        except Exception as e:
+            trace_event("fallback", kind="prefetch")
+            logger.warning("⚠️ 批量预取失败，回退到逐个查询: %s", e)
+
+    def _get_task_tool(self, base=None) -> CachedUIRTool:
+        """为单个任务创建带缓存的uir工具（包装base，默认为工具箱中的uir工具），任务结束即丢弃"""
+        shared = SHARED_VENUE_CACHE if self.use_shared_cache else None
+        return CachedUIRTool(base or self.toolbox.get_tool_object("uir"), shared=shared, compact_reviews=self.compact_reviews)
+
+    def _report_task_stats(self, tool: CachedUIRTool):
+        self.last_tool_stats = tool.stats()
+        trace = _CURRENT_TRACE.get()
+        if trace is not None: trace.extra["tool_stats"] = self.last_tool_stats
+        if self.print_prompts:
+            stats = self.last_tool_stats
+            self.safe_print(f"💾 数据缓存: 命中{stats['hits']}次, 未命中{stats['misses']}次 (命中率{stats['hit_rate']:.1%})")
+            if self.use_shared_cache:
+                shared = SHARED_VENUE_CACHE.stats()
+                self.safe_print(f"💾 共享缓存: 场所{shared['items']['entries']}条(命中率{shared['items']['hit_rate']:.1%}), "
+                                f"评论列表{shared['reviews']['entries']}条(命中率{shared['reviews']['hit_rate']:.1%}), "
+                                f"约{(shared['items']['bytes'] + shared['reviews']['bytes']) / 1024 / 1024:.1f}MB")
+            if self.venue_summary_cache:
+                summary = VENUE_SUMMARY_CACHE.stats()
+                self.safe_print(f"💾 场所摘要缓存: {summary['entries']}个场所, 命中率{summary['hit_rate']:.1%}, 累计生成{summary['builds']}块")
+            if self._llm_cache is not None:
+                llm_stats = self._llm_cache.stats()
+                self.safe_print(f"💾 LLM响应缓存: 命中{llm_stats['hits']}次, 未命中{llm_stats['misses']}次 (命中率{llm_stats['hit_rate']:.1%})")
+
+    def _parse_json(self, response: str, required_keys=()) -> Dict:
+        """解析LLM输出中的JSON对象；失败返回{}，原因记录在当前任务的json.parse计时段中"""
+        with trace_span("json.parse", chars=len(response or "")) as span:
+            extractor = IncrementalJSONExtractor(required_keys, fence=_JSON_FENCE)
+            extractor.feed(response or "")
+            result = extractor.finish()
+            span["ok"] = bool(result)
+            if extractor.error:
+                span["reason"] = extractor.error
+                logger.debug("JSON解析问题: %s", extractor.error)
+            return result
 
     def _extract_main_category(self, categories_str: str) -> str:
         return (categories_str.split(',')[0].strip() if categories_str and categories_str != 'Unknown' else 'Unknown')
 
     def _tokenize_text(self, text: str) -> List[str]:
         """简单分词：使用正则表达式分割单词"""
-        words = re.findall(r'\b[a-zA-Z]+\b', text.lower())
+        words = _WORD_RE.findall(text.lower())
         return words
 
-    def _analyze_user_preferences(self, user_reviews: List[Dict], tool) -> Dict[str, Any]:
-        if not user_reviews: return {}
-        
-        ratings = [r['stars'] for r in user_reviews]
-        preferences = {
-            "avg_rating": round(sum(ratings) / len(ratings), 1),
-            "review_count": len(user_reviews),
-            "category_preferences": {},
-        }
-
-        venue_ratings = []
-        
+    def _build_user_profile(self, user_reviews: List[Dict], tool) -> Dict[str, Any]:
+        """推荐与评论撰写共用的用户画像：一次遍历收集评分、文本长度、类别编码、场所评分四列（及城市计数），再统一分组聚合"""
+        stars, text_lengths, category_codes, venue_stars = [], [], [], []
+        categories: Dict[str, int] = {}
+        city_counts: Dict[str, int] = {}
         for review in user_reviews:
+            stars.append(review['stars'])
+            text_lengths.append(len(review['text']))
             item_info = tool.get_item(review.get('item_id'))
-            if not item_info: continue
-            
-            venue_avg_rating = item_info.get('stars', 0)
-            if venue_avg_rating > 0:
-                venue_ratings.append(venue_avg_rating)
-            
+            if not item_info:
+                category_codes.append(-1)
+                venue_stars.append(0)
+                continue
+            venue_stars.append(item_info.get('stars', 0) or 0)
             category = self._extract_main_category(item_info.get('categories', 'Unknown'))
-            if category not in preferences["category_preferences"]:
-                preferences["category_preferences"][category] = {'count': 0, 'ratings': []}
-            preferences["category_preferences"][category]['count'] += 1
-            preferences["category_preferences"][category]['ratings'].append(review['stars'])
-        
-        if venue_ratings:
-            preferences["visited_venues_avg_rating"] = round(sum(venue_ratings) / len(venue_ratings), 2)
-        else:
-            preferences["visited_venues_avg_rating"] = 0.0
+            category_codes.append(categories.setdefault(category, len(categories)))
+            city = item_info.get('city')
+            if city: city_counts[city] = city_counts.get(city, 0) + 1
+        
+        aggregate = self._aggregate_profile_numpy if np is not None else self._aggregate_profile_python
+        return {**aggregate(stars, text_lengths, category_codes, venue_stars, list(categories)), "city_counts": city_counts}
+
+    def _aggregate_profile_numpy(self, stars: List, text_lengths: List[int], category_codes: List[int], venue_stars: List, category_names: List[str]) -> Dict[str, Any]:
+        stars_arr = np.asarray(stars, dtype=np.float64)
+        venue_arr = np.asarray(venue_stars, dtype=np.float64)
+        codes = np.asarray(category_codes, dtype=np.int64)
+        rated_venues = venue_arr[venue_arr > 0]
+        
+        profile = {
+            "avg_rating": round(float(stars_arr.mean()), 1),
+            "review_count": len(stars),
+            "avg_text_length": round(float(np.mean(text_lengths))),
+            "positive_ratio": round(float((stars_arr >= 4).mean()), 2),
+            "visited_venues_avg_rating": round(float(rated_venues.mean()), 2) if rated_venues.size else 0.0,
+            "category_preferences": {},
+        }
         
-        for data in preferences["category_preferences"].values():
+        known = np.flatnonzero(codes >= 0)
+        if known.size:
+            counts = np.bincount(codes[known], minlength=len(category_names))
+            sums = np.bincount(codes[known], weights=stars_arr[known], minlength=len(category_names))
+            groups = np.split(known[np.argsort(codes[known], kind='stable')], np.cumsum(counts)[:-1])
+            for code, category in enumerate(category_names):
+                profile["category_preferences"][category] = {
+                    'count': int(counts[code]),
+                    'ratings': [stars[i] for i in groups[code]],
+                    'avg_rating': round(float(sums[code] / counts[code]), 1),
+                }
+        return profile
+
+    def _aggregate_profile_python(self, stars: List, text_lengths: List[int], category_codes: List[int], venue_stars: List, category_names: List[str]) -> Dict[str, Any]:
+        rated_venues = [v for v in venue_stars if v > 0]
+        category_preferences = {category: {'count': 0, 'ratings': []} for category in category_names}
+        for code, rating in zip(category_codes, stars):
+            if code < 0: continue
+            data = category_preferences[category_names[code]]
+            data['count'] += 1
+            data['ratings'].append(rating)
+        for data in category_preferences.values():
             data['avg_rating'] = round(sum(data['ratings']) / len(data['ratings']), 1)
         
-        return preferences
+        return {
+            "avg_rating": round(sum(stars) / len(stars), 1),
+            "review_count": len(stars),
+            "avg_text_length": round(sum(text_lengths) / len(text_lengths)),
+            "positive_ratio": round(sum(1 for r in stars if r >= 4) / len(stars), 2),
+            "visited_venues_avg_rating": round(sum(rated_venues) / len(rated_venues), 2) if rated_venues else 0.0,
+            "category_preferences": category_preferences,
+        }
+
+    def _get_user_profile(self, user_reviews: List[Dict], tool, user_id: Optional[str] = None) -> Dict[str, Any]:
+        """优先从预计算画像存储读取；存储中不存在或已过期时现场计算并写回"""
+        if self._profile_store is None or user_id is None:
+            return self._build_user_profile(user_reviews, tool)
+        version = UserProfileStore.version_of(user_reviews)
+        profile = self._profile_store.get(user_id, version)
+        if profile is None:
+            profile = self._build_user_profile(user_reviews, tool)
+            self._profile_store.put(user_id, version, profile)
+        return profile
+
+    def precompute_user_profiles(self, user_ids=None, tool=None, commit_every: int = 500, users_path: Optional[str] = None) -> int:
+        """离线预计算阶段：为给定的用户计算画像写入存储（已是最新版本的跳过），返回写入数量；
+        未给出user_ids时预计算数据集中的全部用户，用户列表取自users_path（或profile_users_path选项）指向的用户文件。
+        tool为底层uir工具；每个用户各用一个任务级缓存工具，处理完即丢弃，只有有界的共享场所缓存跨用户保留"""
+        if self._profile_store is None: raise ValueError("profile_store_path未配置")
+        if user_ids is None:
+            users_path = users_path or self.profile_users_path
+            if not users_path: raise ValueError("未给出user_ids时需要users_path或profile_users_path选项指向数据集用户文件")
+            user_ids = iter_dataset_user_ids(users_path)
+        tool = tool or self.toolbox.get_tool_object("uir")
+        written = 0
+        for user_id in user_ids:
+            task_tool = self._get_task_tool(tool)
+            user_reviews = task_tool.get_reviews(user_id=user_id)
+            if not user_reviews: continue
+            version = UserProfileStore.version_of(user_reviews)
+            if self._profile_store.get(user_id, version) is not None: continue
+            self._profile_store.put(user_id, version, self._build_user_profile(user_reviews, task_tool), commit=False)
+            written += 1
+            if written % commit_every == 0: self._profile_store.commit()
+        self._profile_store.commit()
+        if self.print_prompts: self.safe_print(f"📇 用户画像预计算完成: 写入{written}个用户")
+        return written
+
+    def _analyze_user_preferences(self, user_reviews: List[Dict], tool, user_id: Optional[str] = None) -> Dict[str, Any]:
+        if not user_reviews: return {}
+        return self._get_user_profile(user_reviews, tool, user_id)
 
-    def _build_candidate_details(self, candidate_list: List[str], tool) -> List[Dict]:
+    def _build_candidate_details(self, candidate_list: List[str], tool, user_preferences: Optional[Dict] = None) -> List[Dict]:
         candidate_details = []
-        filtered_count = 0
+        ratings = array('d')  # 未取整的平均评分，供预筛选规则使用
         
         for item_id in candidate_list:
             item_info = tool.get_item(item_id)
             if not item_info: continue
             
             item_reviews = tool.get_reviews(item_id=item_id)
-            avg_rating = item_info.get('stars', 0) or (sum(r['stars'] for r in item_reviews) / len(item_reviews) if item_reviews else 0)
-            
-            # 预筛选：排除平均评分小于等于1.5的地点
-            if avg_rating <= 1.5:
-                filtered_count += 1
-                continue
+            avg_rating = item_info.get('stars', 0) or (review_stars_sum(item_reviews) / len(item_reviews) if item_reviews else 0)
+            ratings.append(avg_rating)
             
             candidate_details.append({
                 "item_id": item_id,
@@ -102,12 +2416,69 @@ class SimplifiedRecommendationAgent(IndividualAgentBase):
                 "reviews": item_reviews[:5] if item_reviews else []
             })
         
-        if self.print_prompts and filtered_count > 0:
-            self.safe_print(f"🔍 预筛选: 过滤掉{filtered_count}个低评分地点(评分<=1.5)")
-            
-        return candidate_details
+        return self._prefilter_candidates(candidate_details, ratings, user_preferences or {})
+
+    def _prefilter_candidates(self, candidate_details: List[Dict], ratings, user_preferences: Dict) -> List[Dict]:
+        """按prefilter_rules顺序对候选逐条规则过滤（LLM调用之前）；候选各字段先整理为列，规则只做列上的比较。
+        某条规则会使剩余候选少于prefilter_min_keep时跳过该规则"""
+        if not candidate_details or not self.prefilter_rules: return candidate_details
+        columns = {
+            "rating": ratings,
+            "review_count": array('q', (venue['review_count'] for venue in candidate_details)),
+            "category": [venue['category'] for venue in candidate_details],
+            "city": [venue['city'] for venue in candidate_details],
+        }
+        keep = [True] * len(candidate_details)
+        kept_count = len(keep)
+        removed: Dict[str, int] = {}
+        guarded = 0
+        for params in self.prefilter_rules:
+            name = params["rule"]
+            mask = PREFILTER_RULES[name](columns, params, user_preferences)
+            if mask is None: continue
+            new_keep = [k and m for k, m in zip(keep, mask)]
+            new_count = sum(new_keep)
+            if new_count == kept_count: continue
+            if self.prefilter_min_keep is not None and new_count < self.prefilter_min_keep:
+                guarded += 1
+                continue
+            removed[name] = removed.get(name, 0) + kept_count - new_count
+            keep, kept_count = new_keep, new_count
+        
+        with self._prefilter_stats_lock:
+            for name, count in removed.items():
+                self.prefilter_stats[name] = self.prefilter_stats.get(name, 0) + count
+            if guarded: self.prefilter_stats["guarded"] = self.prefilter_stats.get("guarded", 0) + guarded
+        if removed:
+            trace_event("prefilter", kept=kept_count, **removed)
+            if self.print_prompts:
+                self.safe_print(f"🔍 预筛选: 过滤掉{len(keep) - kept_count}个候选 ({', '.join(f'{name}: {count}' for name, count in removed.items())})")
+        return [venue for venue, k in zip(candidate_details, keep) if k]
 
-    def _get_user_relevant_reviews(self, user_reviews: List[Dict], candidate_categories: List[str], tool, limit: int = 6) -> str:
+    def _budget(self, stage: str, section: str) -> Optional[int]:
+        return self.prompt_budgets.get(stage, {}).get(section)
+
+    def _rank_relevant_reviews(self, relevant_reviews: List[Dict]) -> List[Dict]:
+        """按配置的排序方式排列用户历史评论：recency最新优先，useful有用数优先，balanced在各类别间轮流取最新"""
+        if self.review_ranking == 'useful':
+            return sorted(relevant_reviews, key=lambda x: (x['useful'], x.get('date', '')), reverse=True)
+        try:
+            ranked = sorted(relevant_reviews, key=lambda x: x.get('date', ''), reverse=True)
+        except:
+            return sorted(relevant_reviews, key=lambda x: x['useful'], reverse=True)
+        if self.review_ranking != 'balanced': return ranked
+        
+        by_category: Dict[str, List[Dict]] = OrderedDict()
+        for review in ranked:
+            by_category.setdefault(review['category'], []).append(review)
+        balanced = []
+        while by_category:
+            for category in list(by_category):
+                balanced.append(by_category[category].pop(0))
+                if not by_category[category]: del by_category[category]
+        return balanced
+
+    def _get_user_relevant_reviews(self, user_reviews: List[Dict], candidate_categories: List[str], tool, limit: int = 6, max_tokens: Optional[int] = None) -> str:
         if not user_reviews or not candidate_categories: return "用户在相关类别下无历史评论"
         
         relevant_reviews = []
@@ -126,44 +2497,136 @@ class SimplifiedRecommendationAgent(IndividualAgentBase):
         
         if not relevant_reviews: return "用户在相关类别下无历史评论"
         
-        try:
-            selected_reviews = sorted(relevant_reviews, key=lambda x: x.get('date', ''), reverse=True)[:limit]
-        except:
-            selected_reviews = sorted(relevant_reviews, key=lambda x: x['useful'], reverse=True)[:limit]   
+        selected_reviews = self._rank_relevant_reviews(relevant_reviews)[:limit]
         
         examples = ["用户在相关类别下的历史评论示例："]
+        used_tokens = estimate_tokens(examples[0])
         for i, review in enumerate(selected_reviews, 1):
             text = review['text'][:120] + "..." if len(review['text']) > 120 else review['text']
             useful_info = f" ({review['useful']}个有用)" if review['useful'] > 0 else ""
             date_info = f" {review.get('date', '')[:10]}" if review.get('date') else ""
-            examples.append(f"\n{i}. [{review['rating']}星{useful_info}]{date_info} {review['venue_name']} ({review['category']})")
-            examples.append(f"   \"{text}\"")
+            header = f"\n{i}. [{review['rating']}星{useful_info}]{date_info} {review['venue_name']} ({review['category']})"
+            body = f"   \"{text}\""
+            
+            # 超出token预算时截断剩余示例（至少保留一条）
+            cost = estimate_tokens(header) + estimate_tokens(body)
+            if max_tokens is not None and i > 1 and used_tokens + cost > max_tokens:
+                if self.print_prompts: self.safe_print(f"✂️ 历史评论示例超出预算({max_tokens} tokens)，保留{i-1}/{len(selected_reviews)}条")
+                break
+            used_tokens += cost
+            examples.append(header)
+            examples.append(body)
         
         return "\n".join(examples)
 
-    def _format_venues_for_screening(self, candidate_details: List[Dict]) -> str:
-        formatted_venues = []
-        
-        for i, venue in enumerate(candidate_details, 1):
-            venue_info = f"""{i}. {venue['name']} (ID: {venue['item_id']})
-   类别: {venue['category']} | 评分: {venue['avg_rating']}⭐ ({venue['review_count']}条评论)"""
-            
-            reviews = venue.get('reviews', [])
-            if reviews:
-                venue_info += "\n   代表性评论:"
-                for j, review in enumerate(reviews[:3], 1):
-                    review_text = review.get('text', '')[:120] + "..." if len(review.get('text', '')) > 120 else review.get('text', '')
-                    useful_info = f" ({review.get('useful', 0)}个有用)" if review.get('useful', 0) > 0 else ""
-                    venue_info += f"\n     {j}. [{review.get('stars', 0)}⭐{useful_info}] \"{review_text}\""
-            else:
-                venue_info += "\n   代表性评论: 暂无评论"
-            
-            formatted_venues.append(venue_info)
+    def _venue_reviews_text(self, venue: Dict, max_reviews: int = 3, text_length: int = 120) -> str:
+        reviews = venue.get('reviews', [])
+        if reviews and max_reviews > 0:
+            if max_reviews < 3:
+                # 截断时优先保留更有用的评论
+                reviews = sorted(reviews[:5], key=lambda r: r.get('useful', 0), reverse=True)
+            venue_info = "\n   代表性评论:"
+            for j, review in enumerate(reviews[:max_reviews], 1):
+                review_text = review.get('text', '')[:text_length] + "..." if len(review.get('text', '')) > text_length else review.get('text', '')
+                useful_info = f" ({review.get('useful', 0)}个有用)" if review.get('useful', 0) > 0 else ""
+                venue_info += f"\n     {j}. [{review.get('stars', 0)}⭐{useful_info}] \"{review_text}\""
+            return venue_info
+        return "\n   代表性评论: 已省略" if reviews else "\n   代表性评论: 暂无评论"
+
+    def _venue_stats_text(self, venue: Dict) -> str:
+        return f"   类别: {venue.get('category', 'Unknown')} | 评分: {venue.get('avg_rating', 0)}⭐ ({venue.get('review_count', 0)}条评论)"
+
+    def _venue_summary(self, venue: Dict, part, builder) -> tuple:
+        """场所块中与任务无关的部分：启用venue_summary_cache时从进程级缓存读取"""
+        if not self.venue_summary_cache:
+            text = builder()
+            cjk = len(_CJK_RE.findall(text))
+            return text, cjk, len(text) - cjk
+        return VENUE_SUMMARY_CACHE.get(venue, part, builder)
+
+    def _venue_block_body(self, venue: Dict, max_reviews: int = 3, text_length: int = 120) -> tuple:
+        return self._venue_summary(venue, ("body", max_reviews, text_length), lambda: (
+            f"{venue['name']} (ID: {venue['item_id']})\n{self._venue_stats_text(venue)}"
+            f"{self._venue_reviews_text(venue, max_reviews, text_length)}"))
+
+    def _format_venue_block(self, index: int, venue: Dict, max_reviews: int = 3, text_length: int = 120) -> str:
+        return f"{index}. {self._venue_block_body(venue, max_reviews, text_length)[0]}"
+
+    def _format_venues_for_screening(self, candidate_details: List[Dict], max_tokens: Optional[int] = None) -> str:
+        # 逐级减少每个场所的评论条数与长度，直到满足token预算；token数由缓存的各块字符数求和，无需重新扫描拼接结果
+        for max_reviews, text_length in ((3, 120), (2, 120), (1, 80), (0, 0)):
+            bodies = [self._venue_block_body(venue, max_reviews, text_length) for venue in candidate_details]
+            if max_tokens is None: break
+            # 序号前缀"i. "与块间的空行均为非中文字符
+            other = sum(body[2] + len(str(i)) + 2 for i, body in enumerate(bodies, 1)) + 2 * max(len(bodies) - 1, 0)
+            if sum(body[1] for body in bodies) + math.ceil(other / 4) <= max_tokens:
+                break
+        if self.print_prompts and max_reviews < 3:
+            self.safe_print(f"✂️ 候选场所列表超出预算({max_tokens} tokens)，每个场所保留{max_reviews}条评论")
+        return "\n\n".join(f"{i}. {body[0]}" for i, body in enumerate(bodies, 1))
+
+    def _prerank_candidates(self, candidate_details: List[Dict], query: str) -> List[Dict]:
+        """本地预排序：按BM25得分保留前prerank_top_k个候选送入初筛LLM（保持原有顺序）；查询与所有候选均无词重合时不裁剪。
+        中文需求不含NEED_CATEGORY_TERMS中的关键词时只有查询中的英文部分（候选类别）参与打分，得分为0的候选并列，
+        按候选列表原顺序截取，此时保留哪些候选与用户需求无关（基准测试中召回率与随机保留相当）"""
+        top_k = self.prerank_top_k
+        if not top_k or len(candidate_details) <= top_k: return candidate_details
+        scores = VENUE_RANKER.score(query, candidate_details)
+        if not any(scores): return candidate_details
+        
+        ranked = sorted(range(len(candidate_details)), key=lambda i: scores[i], reverse=True)
+        kept = [candidate_details[i] for i in sorted(ranked[:top_k])]
+        if self.print_prompts: self.safe_print(f"📐 本地预排序: {len(candidate_details)}个候选 → {len(kept)}个")
+        return kept
+
+    def _heuristic_rank(self, candidate_details: List[Dict], user_preferences: Dict, mention_info: Optional[Dict[str, Any]] = None) -> List[str]:
+        """非LLM的确定性排序：综合类别偏好、评分习惯匹配、评论数热度与用户名提及信号，得分相同按原顺序"""
+        weights = self.heuristic_weights
+        category_prefs = user_preferences.get('category_preferences', {}) if user_preferences else {}
+        total_visits = sum(data['count'] for data in category_prefs.values()) or 1
+        user_avg = user_preferences.get('avg_rating', 3) if user_preferences else 3
+        visited_avg = (user_preferences.get('visited_venues_avg_rating') if user_preferences else 0) or 3.5
+        max_reviews = max((c.get('review_count', 0) for c in candidate_details), default=0)
+        mentioned = set()
+        if mention_info and 0 < mention_info.get('venue_count', 0) < 4:
+            mentioned = set(mention_info.get('mentioned_venues', []))
+        
+        scored = []
+        for index, venue in enumerate(candidate_details):
+            category_data = category_prefs.get(venue.get('category'))
+            rating = venue.get('avg_rating', 0)
+            score = (
+                weights["category"] * (category_data['count'] / total_visits if category_data else 0)
+                + weights["category_rating"] * (category_data['avg_rating'] / 5 if category_data else 0)
+                + weights["rating_fit"] * max(0.0, 1 - abs(rating - visited_avg) / 4)
+                + weights["quality"] * (rating - user_avg) / 4
+                + weights["popularity"] * (math.log1p(venue.get('review_count', 0)) / math.log1p(max_reviews) if max_reviews else 0)
+                + weights["mention"] * (venue['item_id'] in mentioned)
+            )
+            scored.append((-score, index, venue['item_id']))
         
-        return "\n\n".join(formatted_venues)
+        return [item_id for _, _, item_id in sorted(scored)]
 
-    def _check_user_mentioned_in_reviews(self, user_name: str, candidate_list: List[str], tool) -> Dict[str, Any]:
-        """检查用户名在评论中的提及情况，返回详细信息"""
+    def _heuristic_recommendations(self, candidate_list: List[str], candidate_details: Optional[List[Dict]], user_preferences: Dict, mention_info: Optional[Dict[str, Any]], reason: str,
+                                   preferred: Optional[List[str]] = None) -> Dict[str, Any]:
+        """启发式兜底推荐：按启发式得分取前5个，候选信息不可用时按输入顺序返回；preferred（已完成阶段的结果）保持原顺序排在最前"""
+        self.heuristic_stats[reason] += 1
+        trace_event("fallback", kind=f"heuristic_{reason}")
+        if not candidate_details:
+            return {"item_list": candidate_list[:5]}
+        ranked = self._heuristic_rank(candidate_details, user_preferences, mention_info)
+        if preferred:
+            kept = [item_id for item_id in dict.fromkeys(preferred) if item_id in ranked]
+            ranked = kept + [item_id for item_id in ranked if item_id not in kept]
+        if reason != 'insufficient' and len(ranked) < 5:
+            # 预筛选后不足5个时，用被过滤的候选补足
+            ranked += [item_id for item_id in candidate_list if item_id not in ranked][:5 - len(ranked)]
+        if self.print_prompts: self.safe_print(f"🧮 启发式排序({reason}): {ranked[:5]}")
+        return {"item_list": ranked[:5]}
+
+    def _check_user_mentioned_in_reviews(self, user_name: str, candidate_list: List[str], tool, mode: Optional[str] = None) -> Dict[str, Any]:
+        """检查用户名在评论中的提及情况，返回详细信息；mode为scan时逐条分词，用于校验倒排索引结果"""
+        mode = mode or self.mention_mode
         if not user_name or len(user_name.strip()) < 2:
             return {"mentioned_venues": [], "venue_count": 0, "mention_details": []}
         
@@ -182,13 +2645,16 @@ class SimplifiedRecommendationAgent(IndividualAgentBase):
             venue_name = item_info.get('name', 'Unknown') if item_info else 'Unknown'
             
             venue_mentions = []
-            for review in item_reviews:
-                review_text = review.get('text', '')
-                
-                # 分词后检查是否包含用户名
-                words = self._tokenize_text(review_text)
-                if user_name_clean in words:
-                    venue_mentions.append(review_text)
+            if mode == 'scan':
+                for review in item_reviews:
+                    review_text = review.get('text', '')
+                    
+                    # 分词后检查是否包含用户名
+                    words = self._tokenize_text(review_text)
+                    if user_name_clean in words:
+                        venue_mentions.append(review_text)
+            else:
+                venue_mentions = [review.get('text', '') for review in MENTION_INDEX.lookup(user_name_clean, item_id, item_reviews)]
             
             if venue_mentions:
                 mentioned_venues.append(item_id)
@@ -255,46 +2721,31 @@ class SimplifiedRecommendationAgent(IndividualAgentBase):
         category_analysis = self._build_category_analysis_text(user_preferences, candidate_categories)
         
         # 获取用户相关评论，不限制数量以获得更全面的分析
-        user_relevant_reviews = self._get_user_relevant_reviews(user_reviews, candidate_categories, tool, limit=len(user_reviews))
+        user_relevant_reviews = self._get_user_relevant_reviews(user_reviews, candidate_categories, tool, limit=len(user_reviews), max_tokens=self._budget('intent', 'reviews'))
         
         # 构建用户名提及上下文
         mention_context = ""
         if mention_info["venue_count"] > 0 and mention_info["venue_count"] < 4:
             mention_context = self._build_user_mention_context(mention_info["mention_details"])
 
-        user_prompt = f"""
-用户基本信息: 
-- 用户名: {user_name}
-- 平均评分: {user_preferences.get('avg_rating', 3)}星
-- 评论总数: {user_preferences.get('review_count', 0)}条
-- 访问地点的平均评分: {user_preferences.get('visited_venues_avg_rating', 0)}星
-
-{category_analysis}
-
-{user_relevant_reviews}
-
-{mention_context}
-
-请基于用户的历史行为模式，分析用户的基本画像和多层次需求。
-
-输出格式：
-```json
-{{
-    "user_profile": "用户xxx是一名……的用户，偏好……特质",
-    "primary_need": "具体的主要需求，如'美甲服务'",
-    "secondary_need": "具体的次要需求，如'美发服务'", 
-    "potential_need": "具体的潜在需求，如'美容护理'"
-}}
-```"""
-
-        messages = [
-            {"role": "system", "content": "你是资深的用户行为分析专家。请严格按照要求格式输出：1)用户画像（一句话描述用户特征和偏好特质）2)主要需求（最核心的具体需求）3)次要需求（重要但非核心的具体需求）4)潜在需求（可能感兴趣但未明确表达的具体需求）。每项都要具体明确，不要添加其他内容。"},
-            {"role": "user", "content": user_prompt}
-        ]
+        messages = self._render_prompt("intent", user_name=user_name, category_analysis=category_analysis, user_relevant_reviews=user_relevant_reviews,
+            mention_context=mention_context, **self._user_stat_fields(user_preferences))
         self._print_prompt(messages, "INTENT_ANALYSIS", "Intent Analyzer")
         
-        response = await self.llm.atext_request(messages)
-        return self._parse_json(response)
+        response = await self._llm_request(messages, "intent")
+        return self._parse_json(response, STAGE_REQUIRED_KEYS["intent"])
+
+    def _render_prompt(self, stage: str, **fields) -> List[Dict[str, str]]:
+        """按当前布局渲染阶段提示词"""
+        return PROMPT_TEMPLATES[stage].render(layout=self.message_layout, venues_first=self.venues_first, **fields)
+
+    def _user_stat_fields(self, user_preferences: Dict) -> Dict[str, Any]:
+        """提示词中用户基本信息的评分统计字段"""
+        return {
+            "avg_rating": user_preferences.get('avg_rating', 3),
+            "review_count": user_preferences.get('review_count', 0),
+            "visited_avg_rating": user_preferences.get('visited_venues_avg_rating', 0),
+        }
 
     def _build_category_analysis_text(self, user_preferences: Dict, candidate_categories: List[str]) -> str:
         """构建类别分析文本"""
@@ -318,254 +2769,6 @@ class SimplifiedRecommendationAgent(IndividualAgentBase):
         
         return "\n".join(analysis_parts)
     
-    async def _handle_recommendation(self, task_context: Dict) -> Dict[str, Any]:
-        user_id, candidate_list, candidate_category = task_context["user_id"], task_context["candidate_list"], task_context["candidate_category"]
-        tool = self.toolbox.get_tool_object("uir")
-        
-        if self.print_prompts: self.safe_print(f"\n🎭 分层需求推荐: 用户{user_id}, 候选{len(candidate_list)}个")
-        
-        try:
-            user_reviews = tool.get_reviews(user_id=user_id)
-            user_preferences = self._analyze_user_preferences(user_reviews, tool)
-            candidate_details = self._build_candidate_details(candidate_list, tool)
-            
-            # 检查用户名在评论中的提及情况
-            user_info = tool.get_user(user_id)
-            user_name = user_info.get('name', '') if user_info else ''
-            
-            mention_info = {"mentioned_venues": [], "venue_count": 0, "mention_details": []}
-            if user_name:
-                mention_info = self._check_user_mentioned_in_reviews(user_name, candidate_list, tool)
-
-            # 检查预筛选后是否还有足够的候选
-            if len(candidate_details) < 5:
-                if self.print_prompts: 
-                    self.safe_print(f"⚠️ 预筛选后候选数量不足: {len(candidate_details)}个，直接返回剩余候选")
-                return {"item_list": [c['item_id'] for c in candidate_details]}
-            
-            if self.print_prompts: 
-                self.safe_print(f"✅ 预筛选后保留{len(candidate_details)}个优质候选，开始分层推荐")
-            
-            # 第一阶段：意图分析LLM - 识别用户画像和分层需求
-            if self.print_prompts: self.safe_print(f"\n🧠 第一阶段: 意图分析LLM")
-            intent_result = await self._intent_analysis_llm(user_preferences, candidate_details, candidate_category, user_reviews, tool, user_id, mention_info)
-            
-            user_profile = intent_result.get('user_profile', '用户画像分析不可用')
-            primary_need = intent_result.get('primary_need', '主要需求未识别')
-            secondary_need = intent_result.get('secondary_need', '次要需求未识别')
-            potential_need = intent_result.get('potential_need', '潜在需求未识别')
-            
-            if self.print_prompts:
-                self.safe_print(f"   用户画像: {user_profile}")
-                self.safe_print(f"   主要需求: {primary_need}")
-                self.safe_print(f"   次要需求: {secondary_need}")
-                self.safe_print(f"   潜在需求: {potential_need}")
-            
-            # 根据需求层次对场所进行分类
-            categorized_venues = self._categorize_venues_by_needs(candidate_details, primary_need, secondary_need, potential_need)
-            
-            if self.print_prompts:
-                self.safe_print(f"   场所分类: 主要需求{len(categorized_venues['primary'])}个, 次要需求{len(categorized_venues['secondary'])}个, 潜在需求{len(categorized_venues['potential'])}个, 其他{len(categorized_venues['other'])}个")
-            
-            # 检查主要需求场所是否足够
-            primary_venues = categorized_venues['primary']
-            if len(primary_venues) < 3:
-                # 如果主要需求场所不足，从其他类别补充
-                primary_venues.extend(categorized_venues['other'][:5-len(primary_venues)])
-                if self.print_prompts:
-                    self.safe_print(f"   主要需求场所不足，从其他类别补充到{len(primary_venues)}个")
-            
-            # 第二阶段：主要需求初筛LLM (选出10个)
-            if self.print_prompts: self.safe_print(f"\n🎯 第二阶段: 主要需求初筛LLM ({len(primary_venues)}个→10个)")
-            
-            primary_screening_result = await self._primary_need_screening_llm(user_preferences, primary_venues, user_profile, primary_need, user_reviews, tool, user_id)
-            selected_primary_venues = primary_screening_result.get('selected_venues', [])
-            
-            if self.print_prompts: self.safe_print(f"   主要需求初筛完成，选出{len(selected_primary_venues)}个候选")
-            
-            # 第三阶段：主要需求最终选择LLM (选出5个)
-            if self.print_prompts: self.safe_print(f"\n👑 第三阶段: 主要需求最终选择LLM (10个→5个)")
-            
-            final_primary_result = await self._final_selection_llm(user_preferences, selected_primary_venues, primary_venues, user_profile, primary_need)
-            final_primary_recommendations = final_primary_result.get('final_recommendations', [])
-            
-            if self.print_prompts: self.safe_print(f"   主要需求最终选择完成，选出{len(final_primary_recommendations)}个推荐")
-            
-            # 第四阶段：次要和潜在需求推荐LLM (选出3个)
-            secondary_potential_recommendations = []
-            secondary_venues = categorized_venues['secondary']
-            potential_venues = categorized_venues['potential']
-            
-            if secondary_venues or potential_venues:
-                if self.print_prompts: self.safe_print(f"\n🔍 第四阶段: 次要和潜在需求推荐LLM ({len(secondary_venues)}+{len(potential_venues)}个→3个)")
-                
-                secondary_potential_result = await self._secondary_potential_needs_llm(
-                    user_preferences, secondary_venues, potential_venues, 
-                    user_profile, secondary_need, potential_need, 
-                    user_reviews, tool, user_id
-                )
-                secondary_potential_venues = secondary_potential_result.get('recommended_venues', [])
-                secondary_potential_recommendations = [v['venue_id'] for v in secondary_potential_venues]
-                
-                if self.print_prompts: 
-                    self.safe_print(f"   次要和潜在需求推荐完成，选出{len(secondary_potential_recommendations)}个推荐")
-                    for venue in secondary_potential_venues:
-                        self.safe_print(f"     - {venue['venue_name']} ({venue['need_type']}): {venue['selection_reason']}")
-            else:
-                if self.print_prompts: self.safe_print(f"\n🔍 第四阶段: 无次要和潜在需求场所，跳过")
-            
-            # 合并最终推荐结果 (5个主要需求 + 3个次要/潜在需求 = 8个总推荐)
-            all_recommendations = final_primary_recommendations + secondary_potential_recommendations
-            
-            # 确保不超过推荐数量限制，优先保证主要需求
-            if len(all_recommendations) > 8:
-                all_recommendations = final_primary_recommendations[:5] + secondary_potential_recommendations[:3]
-            
-            # 如果总推荐不足，从剩余候选中补充
-            if len(all_recommendations) < 5:
-                remaining_candidates = [c['item_id'] for c in candidate_details if c['item_id'] not in all_recommendations]
-                all_recommendations.extend(remaining_candidates[:5-len(all_recommendations)])
-            
-            if self.print_prompts:
-                self.safe_print(f"\n🎉 分层需求推荐完成! 总推荐{len(all_recommendations)}个")
-                self.safe_print(f"📊 流程: {len(candidate_list)}个候选 → 意图分析 → 主要需求({len(final_primary_recommendations)}) + 次要/潜在需求({len(secondary_potential_recommendations)}) → {len(all_recommendations)}个最终推荐")
-                self.safe_print(f"🏆 最终推荐列表: {all_recommendations}")
-            
-            return {"item_list": all_recommendations}
-        
-        except Exception as e:
-            if self.print_prompts: self.safe_print(f"❌ 分层需求推荐出错: {e}")
-            return {"item_list": candidate_list[:5]}
-
-    def _analyze_user_review_style(self, user_reviews: List[Dict], tool) -> Dict[str, Any]:
-        if not user_reviews:
-            return {"avg_rating": 3.0, "review_count": 0, "avg_text_length": 50, "category_preferences": {}}
-        
-        ratings = [r['stars'] for r in user_reviews]
-        text_lengths = [len(r['text']) for r in user_reviews]
-        
-        basic_stats = {
-            "avg_rating": round(sum(ratings) / len(ratings), 1),
-            "review_count": len(user_reviews),
-            "avg_text_length": round(sum(text_lengths) / len(text_lengths)),
-            "positive_ratio": round(sum(1 for r in ratings if r >= 4) / len(ratings), 2),
-        }
-        
-        category_preferences = {}
-        
-        for review in user_reviews:
-            item_info = tool.get_item(review.get('item_id'))
-            if not item_info: continue
-            
-            category = self._extract_main_category(item_info.get('categories', 'Unknown'))
-            if category not in category_preferences:
-                category_preferences[category] = {'count': 0, 'ratings': []}
-            category_preferences[category]['count'] += 1
-            category_preferences[category]['ratings'].append(review['stars'])
-        
-        for data in category_preferences.values():
-            data['avg_rating'] = round(sum(data['ratings']) / len(data['ratings']), 1)
-        
-        return {**basic_stats, 'category_preferences': category_preferences}
-
-    def _parse_review_response(self, response: str, user_preferences: Dict) -> Dict[str, Any]:
-        try:
-            result = self._parse_json(response)
-            if result.get("stars") and result.get("review"):
-                stars = result["stars"]
-                if isinstance(stars, int) and 1 <= stars <= 5:
-                    review_text = result["review"].strip()
-                    max_length = 120
-                    if len(review_text) > max_length: review_text = review_text[:max_length-3] + "..."
-                    return {"stars": stars, "review": review_text}
-        
-        except Exception as e:
-            if self.print_prompts: self.safe_print(f"评论解析错误: {e}")
-        
-        default_rating = max(1, min(5, round(user_preferences.get("avg_rating", 3))))
-        sentences = [s.strip() for s in response.replace('\n', '. ').split('.') if len(s.strip()) > 20]
-        default_review = sentences[0] if sentences else "This place has good quality."
-        
-        max_length = 120
-        if len(default_review) > max_length: default_review = default_review[:max_length-3] + "..."
-        
-        return {"stars": default_rating, "review": default_review}
-
-    async def _generate_review(self, user_id: str, item_id: str, tool) -> Dict[str, Any]:
-        user_reviews = tool.get_reviews(user_id=user_id)
-        item_info = tool.get_item(item_id)
-        item_reviews = tool.get_reviews(item_id=item_id)
-        
-        if not item_info: return {"stars": 3, "review": "This place seems decent."}
-        
-        user_preferences = self._analyze_user_review_style(user_reviews, tool)
-        target_category = self._extract_main_category(item_info.get('categories', 'Unknown'))
-        item_avg_rating = item_info.get('stars', 0) or (sum(r['stars'] for r in item_reviews) / len(item_reviews) if item_reviews else 3)
-        
-        # 构建用户偏好摘要
-        category_prefs = user_preferences.get('category_preferences', {})
-        preference_parts = [
-            f"用户评价习惯: 平均{user_preferences.get('avg_rating', 3)}星，共{user_preferences.get('review_count', 0)}条评价",
-            f"积极评价比例: {user_preferences.get('positive_ratio', 0)*100:.0f}%"
-        ]
-        
-        if target_category in category_prefs:
-            target_stats = category_prefs[target_category]
-            preference_parts.append(f"在{target_category}类别: 评价{target_stats['count']}次，平均{target_stats['avg_rating']}星")
-        
-        preference_summary = "\n".join(preference_parts)
-        
-        # 获取用户相关评论示例
-        candidate_categories = [target_category]
-        user_relevant_reviews = self._get_user_relevant_reviews(user_reviews, candidate_categories, tool, limit=5)
-
-        system_prompt = """你是一个评价写手，需要根据用户的历史行为模式为场所写出符合该用户风格的评价。
-
-要求：
-1. 评分要符合用户的评分习惯和对该类场所的偏好
-2. 评价文本要模仿用户的写作风格，长度控制在30-50词
-3. 内容要合理，关注用户历史上重视的场所特征"""
-
-        user_prompt = f"""用户偏好分析：
-{preference_summary}
-
-{user_relevant_reviews}
-
-目标场所信息：
-- 场所名称: {item_info.get('name', 'Unknown')}
-- 场所类别: {target_category}
-- 该场所平均评分: {item_avg_rating:.1f}星
-
-请根据用户的偏好模式生成一条评价。
-
-输出格式：
-```json
-{{
-    "stars": [1-5的整数评分],
-    "review": "[模仿用户风格的评价文本，30-50词]"
-}}
-```"""
-
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
-        
-        self._print_prompt(messages, "REVIEW_GENERATION", "Review Generator")
-        response = await self.llm.atext_request(messages)
-        return self._parse_review_response(response, user_preferences)
-
-    async def forward(self, task_context: dict[str, Any]):
-        target = task_context["target"]
-        if target == "recommendation":
-            return await self._handle_recommendation(task_context)
-        elif target == "review_writing":
-            user_id, item_id = task_context["user_id"], task_context["item_id"]
-            tool = self.toolbox.get_tool_object("uir")
-            return await self._generate_review(user_id, item_id, tool)
-        else:
-            raise ValueError(f"Unknown target: {target}")
-
     async def _primary_need_screening_llm(self, user_preferences: Dict, candidate_details: List[Dict], user_profile: str, primary_need: str, secondary_need: str, potential_need: str, user_reviews: List[Dict], tool, user_id: str) -> Dict[str, Any]:
         """主要需求初筛LLM - 从所有候选中识别主要需求相关场所并选出10个"""
         
@@ -574,67 +2777,77 @@ class SimplifiedRecommendationAgent(IndividualAgentBase):
         user_name = user_info.get('name', user_id) if user_info else user_id
         
         # 格式化所有候选场所
-        venues_formatted = self._format_venues_for_screening(candidate_details)
+        venues_formatted = self._format_venues_for_screening(candidate_details, max_tokens=self._budget('screening', 'venues'))
         
         # 构建用户相关评论
         candidate_categories = list(set(v.get('category', 'Unknown') for v in candidate_details))
-        user_relevant_reviews = self._get_user_relevant_reviews(user_reviews, candidate_categories, tool, limit=6)
-
-        system_prompt = """你是推荐系统的主要需求筛选专家，专门负责识别和推荐满足用户核心需求的场所。
-
-你的任务：
-基于用户画像和主要需求，从所有候选场所中识别并选出10个最符合用户主要需求的地点。
-
-重要原则：
-1. 严格聚焦于用户的主要需求，优先识别和推荐直接满足主要需求的场所
-2. 可以考虑能够间接满足主要需求的相关场所
-3. 优先考虑场所质量和用户评分习惯的匹配
-4. 重视用户历史行为模式和偏好特质
-5. 确保推荐的多样性，避免过于单一"""
-
-        user_prompt = f"""用户画像: {user_profile}
-
-主要需求: {primary_need}
-次要需求: {secondary_need}
-潜在需求: {potential_need}
-
-用户基本信息:
-- 用户名: {user_name}
-- 平均评分: {user_preferences.get('avg_rating', 3)}星
-- 评论总数: {user_preferences.get('review_count', 0)}条
-- 访问地点的平均评分: {user_preferences.get('visited_venues_avg_rating', 0)}星
-
-{user_relevant_reviews}
-
-所有候选场所列表:
-{venues_formatted}
+        user_relevant_reviews = self._get_user_relevant_reviews(user_reviews, candidate_categories, tool, limit=6, max_tokens=self._budget('screening', 'reviews'))
 
-请从以上所有候选场所中识别并选择10个最能满足用户主要需求"{primary_need}"的场所。
-【注意：深度思考后再回答】
+        messages = self._render_prompt("screening", user_profile=user_profile, primary_need=primary_need, secondary_need=secondary_need, potential_need=potential_need,
+            user_name=user_name, user_relevant_reviews=user_relevant_reviews, venues_formatted=venues_formatted, **self._user_stat_fields(user_preferences))
+        self._print_prompt(messages, "PRIMARY_NEED_SCREENING", "Primary Need Screening LLM")
+        
+        response = await self._llm_request(messages, "screening")
+        result = self._parse_json(response, STAGE_REQUIRED_KEYS["screening"])
+        
+        return self._validate_screening_result(result, candidate_details)
 
-输出格式：
-```json
-{{
-    "selected_venues": [
-        {{
-            "venue_id": "场所ID",
-            "venue_name": "场所名称",
-            "selection_reason": "选择理由，说明如何满足主要需求"
-        }}
-    ]
-}}
-```"""
+    async def _final_selection_llm(self, user_preferences: Dict, selected_venues: List[Dict], candidate_details: List[Dict], user_profile: str, primary_need: str) -> Dict[str, Any]:
+        """最终选择LLM - 从10个主要需求推荐中选出最终5个"""
+        
+        # 构建候选详情映射
+        venue_details_map = {venue['item_id']: venue for venue in candidate_details}
+        
+        # 格式化选中的场所信息
+        venues_info = []
+        for i, venue in enumerate(selected_venues, 1):
+            venue_id = venue.get('venue_id')
+            venue_name = venue.get('venue_name', 'Unknown')
+            selection_reason = venue.get('selection_reason', 'N/A')
+            
+            venue_detail = venue_details_map.get(venue_id, {})
+            
+            if venue_detail:
+                stats_text = self._venue_summary(venue_detail, "stats", lambda: self._venue_stats_text(venue_detail))[0]
+                reviews_text = self._venue_summary(venue_detail, ("reviews", 3, 100), lambda: self._venue_reviews_text(venue_detail, 3, 100))[0]
+            else:
+                stats_text, reviews_text = self._venue_stats_text(venue_detail), "\n   代表性评论: 暂无评论"
+            venue_info = f"{i}. {venue_name} (ID: {venue_id})\n{stats_text}\n   选择理由: {selection_reason}{reviews_text}"
+            
+            venues_info.append(venue_info)
+        
+        venues_text = "\n\n".join(venues_info)
+        
+        messages = self._render_prompt("final", user_profile=user_profile, primary_need=primary_need, venues_text=venues_text, **self._user_stat_fields(user_preferences))
+        self._print_prompt(messages, "FINAL_SELECTION", "Final Selection LLM")
+        
+        response = await self._llm_request(messages, "final")
+        result = self._parse_json(response, STAGE_REQUIRED_KEYS["final"])
+        
+        return self._validate_final_result(result, selected_venues)
 
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
-        self._print_prompt(messages, "PRIMARY_NEED_SCREENING", "Primary Need Screening LLM")
+    async def _secondary_potential_needs_llm(self, user_preferences: Dict, candidate_details: List[Dict], user_profile: str, secondary_need: str, potential_need: str, primary_recommendations: List[str], user_reviews: List[Dict], tool, user_id: str) -> Dict[str, Any]:
+        """次要和潜在需求推荐LLM - 从所有候选中识别次要和潜在需求相关场所"""
+        
+        # 获取用户信息
+        user_info = tool.get_user(user_id)
+        user_name = user_info.get('name', user_id) if user_info else user_id
+        
+        # 排除已经推荐的主要需求场所
+        remaining_venues = [v for v in candidate_details if v['item_id'] not in primary_recommendations]
+        venues_formatted = self._format_venues_for_screening(remaining_venues, max_tokens=self._budget('secondary', 'venues'))
+
+        messages = self._render_prompt("secondary", user_profile=user_profile, secondary_need=secondary_need, potential_need=potential_need,
+            user_name=user_name, venues_formatted=venues_formatted, **self._user_stat_fields(user_preferences))
+        self._print_prompt(messages, "SECONDARY_POTENTIAL_NEEDS", "Secondary & Potential Needs LLM")
         
-        response = await self.llm.atext_request(messages)
-        result = self._parse_json(response)
+        response = await self._llm_request(messages, "secondary")
+        result = self._parse_json(response, STAGE_REQUIRED_KEYS["secondary"])
         
-        # 验证结果
+        return self._validate_secondary_result(result, remaining_venues)
+
+    def _validate_screening_result(self, result: Dict[str, Any], candidate_details: List[Dict]) -> Dict[str, Any]:
+        """校验初筛结果：只保留候选中存在的场所，不足10个时用高评分候选补足"""
         if 'selected_venues' not in result: result['selected_venues'] = []
         valid_ids = {v['item_id'] for v in candidate_details}
         validated_venues = []
@@ -664,84 +2877,8 @@ class SimplifiedRecommendationAgent(IndividualAgentBase):
         result['selected_venues'] = validated_venues[:10]
         return result
 
-    async def _final_selection_llm(self, user_preferences: Dict, selected_venues: List[Dict], candidate_details: List[Dict], user_profile: str, primary_need: str) -> Dict[str, Any]:
-        """最终选择LLM - 从10个主要需求推荐中选出最终5个"""
-        
-        # 构建候选详情映射
-        venue_details_map = {venue['item_id']: venue for venue in candidate_details}
-        
-        # 格式化选中的场所信息
-        venues_info = []
-        for i, venue in enumerate(selected_venues, 1):
-            venue_id = venue.get('venue_id')
-            venue_name = venue.get('venue_name', 'Unknown')
-            selection_reason = venue.get('selection_reason', 'N/A')
-            
-            venue_detail = venue_details_map.get(venue_id, {})
-            
-            venue_info = f"""{i}. {venue_name} (ID: {venue_id})
-   类别: {venue_detail.get('category', 'Unknown')} | 评分: {venue_detail.get('avg_rating', 0)}⭐ ({venue_detail.get('review_count', 0)}条评论)
-   选择理由: {selection_reason}"""
-            
-            reviews = venue_detail.get('reviews', [])
-            if reviews:
-                venue_info += "\n   代表性评论:"
-                for j, review in enumerate(reviews[:3], 1):
-                    review_text = review.get('text', '')[:100] + "..." if len(review.get('text', '')) > 100 else review.get('text', '')
-                    useful_info = f" ({review.get('useful', 0)}个有用)" if review.get('useful', 0) > 0 else ""
-                    venue_info += f"\n     {j}. [{review.get('stars', 0)}⭐{useful_info}] \"{review_text}\""
-            else:
-                venue_info += "\n   代表性评论: 暂无评论"
-            
-            venues_info.append(venue_info)
-        
-        venues_text = "\n\n".join(venues_info)
-        
-        system_prompt = """你是推荐系统的最终决策专家，需要从10个主要需求初筛推荐中选出最终的5个推荐。
-
-你的任务：
-综合考虑用户画像、主要需求匹配度、场所质量，选出用户最有可能访问的5个地点，并按优先级排序。
-
-决策原则：
-1. 严格聚焦主要需求，优先选择最符合核心需求的场所
-2. 第一个推荐尤其重要，应该是最符合用户画像和主要需求的
-3. 考虑场所质量和用户评分习惯的匹配
-4. 适度考虑多样性，但不偏离主要需求
-5. 重点参考用户评论了解场所的真实体验"""
-
-        user_prompt = f"""用户画像: {user_profile}
-
-主要需求: {primary_need}
-
-用户档案:
-- 历史平均评分: {user_preferences.get('avg_rating', 3)}星
-- 评论数量: {user_preferences.get('review_count', 0)}
-- 访问地点的平均评分: {user_preferences.get('visited_venues_avg_rating', 0)}星
-
-初筛选出的10个主要需求场所:
-{venues_text}
-
-请从以上10个场所中选择5个最终推荐，按优先级从高到低排序。
-
-【注意：深度思考后再回答】
-
-输出格式：
-```json
-{{
-    "final_recommendations": ["场所ID1", "场所ID2", "场所ID3", "场所ID4", "场所ID5"],
-    "selection_rationale": "详细选择理由，说明为什么选择这5个场所以及优先级排序的逻辑"
-}}
-```"""
-
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
-        self._print_prompt(messages, "FINAL_SELECTION", "Final Selection LLM")
-        
-        response = await self.llm.atext_request(messages)
-        result = self._parse_json(response)
-        
+    def _validate_final_result(self, result: Dict[str, Any], selected_venues: List[Dict]) -> Dict[str, Any]:
+        """校验最终选择结果：只保留初筛结果中的场所，不足5个时按初筛顺序补足"""
         if 'final_recommendations' not in result: result['final_recommendations'] = []
         valid_ids = {venue['venue_id'] for venue in selected_venues}
         validated_recommendations = [vid for vid in result['final_recommendations'] if vid in valid_ids]
@@ -755,70 +2892,8 @@ class SimplifiedRecommendationAgent(IndividualAgentBase):
         result['final_recommendations'] = validated_recommendations[:5]
         return result
 
-    async def _secondary_potential_needs_llm(self, user_preferences: Dict, candidate_details: List[Dict], user_profile: str, secondary_need: str, potential_need: str, primary_recommendations: List[str], user_reviews: List[Dict], tool, user_id: str) -> Dict[str, Any]:
-        """次要和潜在需求推荐LLM - 从所有候选中识别次要和潜在需求相关场所"""
-        
-        # 获取用户信息
-        user_info = tool.get_user(user_id)
-        user_name = user_info.get('name', user_id) if user_info else user_id
-        
-        # 排除已经推荐的主要需求场所
-        remaining_venues = [v for v in candidate_details if v['item_id'] not in primary_recommendations]
-        venues_formatted = self._format_venues_for_screening(remaining_venues)
-
-        system_prompt = """你是推荐系统的次要需求专家，负责识别和推荐满足用户次要需求和潜在需求的场所。
-
-你的任务：
-基于用户画像、次要需求和潜在需求，从剩余候选场所中识别并选出3个推荐（优先次要需求，适当考虑潜在需求）。
-
-推荐原则：
-1. 优先识别和推荐能满足次要需求的场所
-2. 适当考虑能满足潜在需求的场所，发掘用户可能感兴趣的新体验
-3. 结合用户画像和偏好特质
-4. 确保推荐的场所质量符合用户标准
-5. 提供与主要需求不同的多样化体验"""
-
-        user_prompt = f"""用户画像: {user_profile}
-
-次要需求: {secondary_need}
-潜在需求: {potential_need}
-
-用户基本信息:
-- 用户名: {user_name}
-- 平均评分: {user_preferences.get('avg_rating', 3)}星
-- 评论总数: {user_preferences.get('review_count', 0)}条
-- 访问地点的平均评分: {user_preferences.get('visited_venues_avg_rating', 0)}星
-
-剩余候选场所（已排除主要需求推荐）:
-{venues_formatted}
-
-请从以上场所中识别并选择3个能满足次要需求或潜在需求的场所推荐。
-【注意：深度思考后再回答】
-
-输出格式：
-```json
-{{
-    "recommended_venues": [
-        {{
-            "venue_id": "场所ID",
-            "venue_name": "场所名称",
-            "need_type": "secondary或potential",
-            "selection_reason": "选择理由，说明满足哪种需求"
-        }}
-    ]
-}}
-```"""
-
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
-        self._print_prompt(messages, "SECONDARY_POTENTIAL_NEEDS", "Secondary & Potential Needs LLM")
-        
-        response = await self.llm.atext_request(messages)
-        result = self._parse_json(response)
-        
-        # 验证结果
+    def _validate_secondary_result(self, result: Dict[str, Any], remaining_venues: List[Dict]) -> Dict[str, Any]:
+        """校验次要/潜在需求推荐：只保留剩余候选中的场所，不足3个时用高评分场所补足"""
         if 'recommended_venues' not in result: result['recommended_venues'] = []
         valid_ids = {v['item_id'] for v in remaining_venues}
         validated_venues = []
@@ -850,38 +2925,210 @@ class SimplifiedRecommendationAgent(IndividualAgentBase):
         result['recommended_venues'] = validated_venues[:3]
         return result
 
+    def _merge_recommendations(self, final_primary_recommendations: List[str], secondary_potential_recommendations: List[str], candidate_details: List[Dict]) -> List[str]:
+        """按固定交错顺序合并主要与次要/潜在推荐，不足5个时从剩余候选中补充"""
+        # Tricky方式合并：主要1+次要1+主要4+次要2+主要5（跳过主要2,3）
+        tricky_recommendations = []
 
-    async def _handle_recommendation(self, task_context: Dict) -> Dict[str, Any]:
-        user_id, candidate_list, candidate_category = task_context["user_id"], task_context["candidate_list"], task_context["candidate_category"]
-        tool = self.toolbox.get_tool_object("uir")
+        # 添加主要推荐1
+        if len(final_primary_recommendations) >= 1:
+            tricky_recommendations.append(final_primary_recommendations[0])
+
+        # 添加次要推荐1
+        if len(secondary_potential_recommendations) >= 1:
+            tricky_recommendations.append(secondary_potential_recommendations[0])
+
+        # 添加主要推荐4（跳过2,3）
+        if len(final_primary_recommendations) >= 4:
+            tricky_recommendations.append(final_primary_recommendations[3])
+
+        # 添加次要推荐2
+        if len(secondary_potential_recommendations) >= 2:
+            tricky_recommendations.append(secondary_potential_recommendations[1])
+
+        # 添加主要推荐5
+        if len(final_primary_recommendations) >= 5:
+            tricky_recommendations.append(final_primary_recommendations[4])
+
+        all_recommendations = tricky_recommendations
         
-        if self.print_prompts: self.safe_print(f"\n🎭 分层需求推荐: 用户{user_id}, 候选{len(candidate_list)}个")
+        # 如果总推荐不足，从剩余候选中补充
+        if len(all_recommendations) < 5:
+            remaining_candidates = [c['item_id'] for c in candidate_details if c['item_id'] not in all_recommendations]
+            all_recommendations.extend(remaining_candidates[:5-len(all_recommendations)])
+        
+        return all_recommendations
+
+    async def _fast_recommendation_llm(self, user_preferences: Dict, candidate_details: List[Dict], candidate_category: str, user_reviews: List[Dict], tool, user_id: str, mention_info: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """快速模式LLM - 单次调用同时给出用户画像、三层需求、5个主要推荐和3个次要/潜在推荐；校验不通过时返回None"""
+        
+        # 获取用户信息
+        user_info = tool.get_user(user_id)
+        user_name = user_info.get('name', user_id) if user_info else user_id
+        
+        candidate_categories = list(set(c.get('category', 'Unknown') for c in candidate_details if c.get('category') != 'Unknown'))
+        category_analysis = self._build_category_analysis_text(user_preferences, candidate_categories)
+        user_relevant_reviews = self._get_user_relevant_reviews(user_reviews, candidate_categories, tool, limit=6, max_tokens=self._budget('fast', 'reviews'))
+        venues_formatted = self._format_venues_for_screening(candidate_details, max_tokens=self._budget('fast', 'venues'))
+        
+        mention_context = ""
+        if mention_info["venue_count"] > 0 and mention_info["venue_count"] < 4:
+            mention_context = self._build_user_mention_context(mention_info["mention_details"])
+
+        messages = self._render_prompt("fast", user_name=user_name, category_analysis=category_analysis, user_relevant_reviews=user_relevant_reviews,
+            mention_context=mention_context, venues_formatted=venues_formatted, **self._user_stat_fields(user_preferences))
+        self._print_prompt(messages, "FAST_RECOMMENDATION", "Fast Single-Call LLM")
         
+        self.fast_mode_stats["calls"] += 1
+        response = await self._llm_request(messages, "fast")
+        result = self._parse_json(response, STAGE_REQUIRED_KEYS["fast"])
+        
+        # 校验：需求完整、至少5个有效主要推荐、至少2个不与主要推荐重复的有效次要推荐（合并时用到前2个）
+        valid_ids = {v['item_id'] for v in candidate_details}
+        primary_ids = list(dict.fromkeys(vid for vid in result.get('primary_recommendations') or [] if isinstance(vid, str) and vid in valid_ids))
+        remaining_venues = [v for v in candidate_details if v['item_id'] not in primary_ids[:5]]
+        remaining_ids = {v['item_id'] for v in remaining_venues}
+        secondary = [v for v in result.get('secondary_recommendations') or [] if isinstance(v, dict) and v.get('venue_id') in remaining_ids]
+        
+        if any(not result.get(k) for k in ('user_profile', 'primary_need', 'secondary_need', 'potential_need')) or len(primary_ids) < 5 or len(secondary) < 2:
+            self.fast_mode_stats["fallbacks"] += 1
+            trace_event("fallback", kind="fast_mode")
+            return None
+        
+        final_result = self._validate_final_result({'final_recommendations': primary_ids}, [{'venue_id': v['item_id']} for v in candidate_details])
+        secondary_result = self._validate_secondary_result({'recommended_venues': secondary}, remaining_venues)
+        return {
+            **{k: result[k] for k in ('user_profile', 'primary_need', 'secondary_need', 'potential_need')},
+            'final_recommendations': final_result['final_recommendations'],
+            'recommended_venues': secondary_result['recommended_venues'],
+        }
+
+    async def _run_stage(self, stage: str, coro, fallback=None):
+        """执行一个阶段；LLM失败或超时时有fallback则用兜底结果继续，否则抛出StageFailure由推荐流程改用启发式排序"""
+        try:
+            return await coro
+        except Exception as e:
+            self.stage_failures[stage] = self.stage_failures.get(stage, 0) + 1
+            trace_event("fallback", kind=f"stage_{stage}")
+            if fallback is None:
+                logger.warning("⚠️ %s阶段失败，改用启发式排序: %s", stage, e)
+                raise StageFailure(stage, e) from e
+            logger.warning("⚠️ %s阶段失败，使用兜底结果继续: %s", stage, e)
+            return fallback()
+
+    async def _speculative_final_and_secondary(self, user_preferences: Dict, selected_venues: List[Dict], candidate_details: List[Dict], user_profile: str, primary_need: str, secondary_need: str, potential_need: str, user_reviews: List[Dict], tool, user_id: str,
+                                               completed_ids: Optional[List[str]] = None):
+        """推测执行第三、四阶段：第四阶段先假定初筛前5个为主要推荐（即第三阶段的兜底结果）并与第三阶段并行，
+        第三阶段返回后过滤与最终主要推荐冲突的场所，过滤后不足2个时按真实主要推荐重跑第四阶段；
+        第三阶段一返回就把最终主要推荐写入completed_ids，第四阶段失败时仍可用于启发式兜底"""
+        predicted_primary = [v['venue_id'] for v in selected_venues[:5]]
+        stages = [
+            asyncio.ensure_future(self._run_stage("final", self._final_selection_llm(user_preferences, selected_venues, candidate_details, user_profile, primary_need))),
+            asyncio.ensure_future(self._run_stage("secondary", self._secondary_potential_needs_llm(
+                user_preferences, candidate_details, user_profile,
+                secondary_need, potential_need, predicted_primary,
+                user_reviews, tool, user_id
+            ))),
+        ]
         try:
+            final_result = await stages[0]
+            final_ids = final_result.get('final_recommendations', [])
+            if completed_ids is not None: completed_ids[:] = final_ids
+            secondary_result = await stages[1]
+        finally:
+            # 第三阶段失败时不再等待第四阶段
+            for stage in stages: stage.cancel()
+        speculative = secondary_result.get('recommended_venues', [])
+        kept = [v for v in speculative if v['venue_id'] not in final_ids]
+        
+        self.speculation_stats["runs"] += 1
+        if len(kept) == len(speculative):
+            self.speculation_stats["kept"] += 1
+        elif len(kept) >= 2:
+            # 合并时只用到前2个次要推荐，过滤后仍足够则无需重跑
+            self.speculation_stats["filtered"] += 1
+            secondary_result['recommended_venues'] = kept
+        else:
+            self.speculation_stats["discarded"] += 1
+            trace_event("fallback", kind="speculation_discarded")
+            if self.print_prompts: self.safe_print(f"   推测结果与最终主要推荐冲突，重跑第四阶段")
+            secondary_result = await self._run_stage("secondary", self._secondary_potential_needs_llm(
+                user_preferences, candidate_details, user_profile,
+                secondary_need, potential_need, final_ids,
+                user_reviews, tool, user_id
+            ))
+        
+        if self.print_prompts:
+            stats = self.speculation_stats
+            self.safe_print(f"   推测执行统计: 共{stats['runs']}次, 直接采用{stats['kept']}次, 过滤后采用{stats['filtered']}次, 丢弃重跑{stats['discarded']}次")
+        return final_result, secondary_result
+
+
+    def _load_recommendation_data(self, tool, user_id: str, candidate_list: List[str]):
+        """推荐任务的数据准备阶段（纯数据库访问与统计，可在线程中执行）"""
+        with trace_span("db.user_reviews") as span:
             user_reviews = tool.get_reviews(user_id=user_id)
-            user_preferences = self._analyze_user_preferences(user_reviews, tool)
-            candidate_details = self._build_candidate_details(candidate_list, tool)
-            
-            # 检查用户名在评论中的提及情况
+            span["count"] = len(user_reviews or [])
+        self._prefetch_task_data(tool, candidate_list, user_reviews)
+        with trace_span("profile"):
+            user_preferences = self._analyze_user_preferences(user_reviews, tool, user_id)
+        with trace_span("candidates.build", candidates=len(candidate_list)) as span:
+            candidate_details = self._build_candidate_details(candidate_list, tool, user_preferences)
+            span["kept"] = len(candidate_details)
+        
+        # 检查用户名在评论中的提及情况
+        with trace_span("db.user"):
             user_info = tool.get_user(user_id)
-            user_name = user_info.get('name', '') if user_info else ''
-            
-            mention_info = {"mentioned_venues": [], "venue_count": 0, "mention_details": []}
-            if user_name:
+        user_name = user_info.get('name', '') if user_info else ''
+        
+        mention_info = {"mentioned_venues": [], "venue_count": 0, "mention_details": []}
+        if user_name:
+            with trace_span("mention_scan", mode=self.mention_mode) as span:
                 mention_info = self._check_user_mentioned_in_reviews(user_name, candidate_list, tool)
+                span["venues"] = mention_info.get("venue_count", 0)
+        return user_reviews, user_preferences, candidate_details, mention_info
+
+    async def _handle_recommendation(self, task_context: Dict) -> Dict[str, Any]:
+        user_id, candidate_list, candidate_category = task_context["user_id"], task_context["candidate_list"], task_context["candidate_category"]
+        tool = self._get_task_tool()
+        
+        if self.print_prompts: self.safe_print(f"\n🎭 分层需求推荐: 用户{user_id}, 候选{len(candidate_list)}个")
+        
+        user_preferences, candidate_details, mention_info = {}, None, None
+        completed_ids: List[str] = []  # 已完成阶段选出的场所（按阶段输出顺序），阶段失败时排在启发式结果之前
+        try:
+            user_reviews, user_preferences, candidate_details, mention_info = await self._run_db(
+                self._load_recommendation_data, tool, user_id, candidate_list
+            )
 
             # 检查预筛选后是否还有足够的候选
             if len(candidate_details) < 5:
                 if self.print_prompts: 
-                    self.safe_print(f"⚠️ 预筛选后候选数量不足: {len(candidate_details)}个，直接返回剩余候选")
-                return {"item_list": [c['item_id'] for c in candidate_details]}
+                    self.safe_print(f"⚠️ 预筛选后候选数量不足: {len(candidate_details)}个，按启发式排序返回剩余候选")
+                return self._heuristic_recommendations(candidate_list, candidate_details, user_preferences, mention_info, 'insufficient')
+            
+            # LLM排队过多或指定启发式模式时直接降级（负载削峰）
+            if self.recommend_mode == 'heuristic' or (self.load_shed_threshold is not None and self._llm_inflight >= self.load_shed_threshold):
+                return self._heuristic_recommendations(candidate_list, candidate_details, user_preferences, mention_info, 'load_shed')
             
             if self.print_prompts: 
                 self.safe_print(f"✅ 预筛选后保留{len(candidate_details)}个优质候选，开始分层推荐")
             
+            if self.recommend_mode == 'fast':
+                if self.print_prompts: self.safe_print(f"\n⚡ 快速模式: 单次LLM调用完成意图分析与分层推荐")
+                fast_result = await self._run_stage("fast", self._fast_recommendation_llm(user_preferences, candidate_details, candidate_category, user_reviews, tool, user_id, mention_info))
+                if fast_result is not None:
+                    secondary_ids = [v['venue_id'] for v in fast_result['recommended_venues']]
+                    all_recommendations = self._merge_recommendations(fast_result['final_recommendations'], secondary_ids, candidate_details)
+                    if self.print_prompts:
+                        self.safe_print(f"   主要需求: {fast_result['primary_need']} | 次要需求: {fast_result['secondary_need']} | 潜在需求: {fast_result['potential_need']}")
+                        self.safe_print(f"🏆 最终推荐列表: {all_recommendations}")
+                    return {"item_list": all_recommendations}
+                if self.print_prompts: self.safe_print(f"   快速模式结果校验未通过，回退到多阶段流程")
+            
             # 第一阶段：意图分析LLM - 识别用户画像和分层需求
             if self.print_prompts: self.safe_print(f"\n🧠 第一阶段: 意图分析LLM")
-            intent_result = await self._intent_analysis_llm(user_preferences, candidate_details, candidate_category, user_reviews, tool, user_id, mention_info)
+            intent_result = await self._run_stage("intent", self._intent_analysis_llm(user_preferences, candidate_details, candidate_category, user_reviews, tool, user_id, mention_info))
             
             user_profile = intent_result.get('user_profile', '用户画像分析不可用')
             primary_need = intent_result.get('primary_need', '主要需求未识别')
@@ -895,41 +3142,54 @@ class SimplifiedRecommendationAgent(IndividualAgentBase):
                 self.safe_print(f"   潜在需求: {potential_need}")
             
             # 第二阶段：主要需求初筛LLM (从所有候选中识别并选出10个)
-            if self.print_prompts: self.safe_print(f"\n🎯 第二阶段: 主要需求初筛LLM ({len(candidate_details)}个候选→识别并选出10个)")
+            screening_candidates = self._prerank_candidates(candidate_details, f"{primary_need} {candidate_category}")
+            if self.print_prompts: self.safe_print(f"\n🎯 第二阶段: 主要需求初筛LLM ({len(screening_candidates)}个候选→识别并选出10个)")
             
-            primary_screening_result = await self._primary_need_screening_llm(
-                user_preferences, candidate_details, user_profile, 
+            primary_screening_result = await self._run_stage("screening", self._primary_need_screening_llm(
+                user_preferences, screening_candidates, user_profile, 
                 primary_need, secondary_need, potential_need, 
                 user_reviews, tool, user_id
-            )
+            ))
             selected_primary_venues = primary_screening_result.get('selected_venues', [])
+            completed_ids = [v['venue_id'] for v in selected_primary_venues]
             
             if self.print_prompts: 
                 self.safe_print(f"   主要需求初筛完成，识别并选出{len(selected_primary_venues)}个候选")
                 for venue in selected_primary_venues:
                     self.safe_print(f"     - {venue['venue_name']}: {venue['selection_reason']}")
             
-            # 第三阶段：主要需求最终选择LLM (选出5个)
-            if self.print_prompts: self.safe_print(f"\n👑 第三阶段: 主要需求最终选择LLM (10个→5个)")
-            
-            final_primary_result = await self._final_selection_llm(
-                user_preferences, selected_primary_venues, candidate_details, 
-                user_profile, primary_need
-            )
-            final_primary_recommendations = final_primary_result.get('final_recommendations', [])
-            
-            if self.print_prompts: self.safe_print(f"   主要需求最终选择完成，选出{len(final_primary_recommendations)}个推荐")
-            
-            # 第四阶段：次要和潜在需求推荐LLM (从剩余候选中识别并选出3个)
-            secondary_potential_recommendations = []
-            
-            if self.print_prompts: self.safe_print(f"\n🔍 第四阶段: 次要和潜在需求推荐LLM (从剩余候选→识别并选出3个)")
-            
-            secondary_potential_result = await self._secondary_potential_needs_llm(
-                user_preferences, candidate_details, user_profile, 
-                secondary_need, potential_need, final_primary_recommendations,
-                user_reviews, tool, user_id
-            )
+            if self.speculative_stage4:
+                # 推测执行：第三阶段与第四阶段并行
+                if self.print_prompts: self.safe_print(f"\n👑🔍 第三/四阶段: 最终选择LLM与次要/潜在需求推荐LLM并行执行")
+                final_primary_result, secondary_potential_result = await self._speculative_final_and_secondary(
+                    user_preferences, selected_primary_venues, candidate_details,
+                    user_profile, primary_need, secondary_need, potential_need,
+                    user_reviews, tool, user_id, completed_ids
+                )
+                final_primary_recommendations = final_primary_result.get('final_recommendations', [])
+            else:
+                # 第三阶段：主要需求最终选择LLM (选出5个)
+                if self.print_prompts: self.safe_print(f"\n👑 第三阶段: 主要需求最终选择LLM (10个→5个)")
+                
+                final_primary_result = await self._run_stage("final", self._final_selection_llm(
+                    user_preferences, selected_primary_venues, candidate_details, 
+                    user_profile, primary_need
+                ))
+                final_primary_recommendations = final_primary_result.get('final_recommendations', [])
+                completed_ids = list(final_primary_recommendations)
+                
+                if self.print_prompts: self.safe_print(f"   主要需求最终选择完成，选出{len(final_primary_recommendations)}个推荐")
+                
+                # 第四阶段：次要和潜在需求推荐LLM (从剩余候选中识别并选出3个)
+                secondary_potential_recommendations = []
+                
+                if self.print_prompts: self.safe_print(f"\n🔍 第四阶段: 次要和潜在需求推荐LLM (从剩余候选→识别并选出3个)")
+                
+                secondary_potential_result = await self._run_stage("secondary", self._secondary_potential_needs_llm(
+                    user_preferences, candidate_details, user_profile, 
+                    secondary_need, potential_need, final_primary_recommendations,
+                    user_reviews, tool, user_id
+                ))
             secondary_potential_venues = secondary_potential_result.get('recommended_venues', [])
             secondary_potential_recommendations = [v['venue_id'] for v in secondary_potential_venues]
             
@@ -938,35 +3198,7 @@ class SimplifiedRecommendationAgent(IndividualAgentBase):
                 for venue in secondary_potential_venues:
                     self.safe_print(f"     - {venue['venue_name']} ({venue['need_type']}): {venue['selection_reason']}")
             
-            # Tricky方式合并：主要1+次要1+主要4+次要2+主要5（跳过主要2,3）
-            tricky_recommendations = []
-
-            # 添加主要推荐1
-            if len(final_primary_recommendations) >= 1:
-                tricky_recommendations.append(final_primary_recommendations[0])
-
-            # 添加次要推荐1
-            if len(secondary_potential_recommendations) >= 1:
-                tricky_recommendations.append(secondary_potential_recommendations[0])
-
-            # 添加主要推荐4（跳过2,3）
-            if len(final_primary_recommendations) >= 4:
-                tricky_recommendations.append(final_primary_recommendations[3])
-
-            # 添加次要推荐2
-            if len(secondary_potential_recommendations) >= 2:
-                tricky_recommendations.append(secondary_potential_recommendations[1])
-
-            # 添加主要推荐5
-            if len(final_primary_recommendations) >= 5:
-                tricky_recommendations.append(final_primary_recommendations[4])
-
-            all_recommendations = tricky_recommendations
-            
-            # 如果总推荐不足，从剩余候选中补充
-            if len(all_recommendations) < 5:
-                remaining_candidates = [c['item_id'] for c in candidate_details if c['item_id'] not in all_recommendations]
-                all_recommendations.extend(remaining_candidates[:5-len(all_recommendations)])
+            all_recommendations = self._merge_recommendations(final_primary_recommendations, secondary_potential_recommendations, candidate_details)
             
             if self.print_prompts:
                 self.safe_print(f"\n🎉 分层需求推荐完成! 总推荐{len(all_recommendations)}个")
@@ -975,53 +3207,36 @@ class SimplifiedRecommendationAgent(IndividualAgentBase):
             
             return {"item_list": all_recommendations}
         
+        except StageFailure:
+            return self._heuristic_recommendations(candidate_list, candidate_details, user_preferences, mention_info, 'stage_failure', completed_ids)
         except Exception as e:
-            if self.print_prompts: self.safe_print(f"❌ 分层需求推荐出错: {e}")
-            return {"item_list": candidate_list[:5]}
-    def _analyze_user_review_style(self, user_reviews: List[Dict], tool) -> Dict[str, Any]:
+            logger.warning("❌ 分层需求推荐出错: %s", e)
+            return self._heuristic_recommendations(candidate_list, candidate_details, user_preferences, mention_info, 'errors')
+        finally:
+            self._report_task_stats(tool)
+    def _analyze_user_review_style(self, user_reviews: List[Dict], tool, user_id: Optional[str] = None) -> Dict[str, Any]:
         if not user_reviews:
             return {"avg_rating": 3.0, "review_count": 0, "avg_text_length": 50, "category_preferences": {}}
-        
-        ratings = [r['stars'] for r in user_reviews]
-        text_lengths = [len(r['text']) for r in user_reviews]
-        
-        basic_stats = {
-            "avg_rating": round(sum(ratings) / len(ratings), 1),
-            "review_count": len(user_reviews),
-            "avg_text_length": round(sum(text_lengths) / len(text_lengths)),
-            "positive_ratio": round(sum(1 for r in ratings if r >= 4) / len(ratings), 2),
-        }
-        
-        category_preferences = {}
-        
-        for review in user_reviews:
-            item_info = tool.get_item(review.get('item_id'))
-            if not item_info: continue
-            
-            category = self._extract_main_category(item_info.get('categories', 'Unknown'))
-            if category not in category_preferences:
-                category_preferences[category] = {'count': 0, 'ratings': []}
-            category_preferences[category]['count'] += 1
-            category_preferences[category]['ratings'].append(review['stars'])
-        
-        for data in category_preferences.values():
-            data['avg_rating'] = round(sum(data['ratings']) / len(data['ratings']), 1)
-        
-        return {**basic_stats, 'category_preferences': category_preferences}
+        return self._get_user_profile(user_reviews, tool, user_id)
+
+    def _normalize_review(self, result: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """校验单条评论结果（1-5的整数评分与非空文本）并截断过长文本，不合法时返回None"""
+        if result.get("stars") and result.get("review"):
+            stars = result["stars"]
+            if isinstance(stars, int) and 1 <= stars <= 5:
+                review_text = result["review"].strip()
+                max_length = 120
+                if len(review_text) > max_length: review_text = review_text[:max_length-3] + "..."
+                return {"stars": stars, "review": review_text}
+        return None
 
     def _parse_review_response(self, response: str, user_preferences: Dict) -> Dict[str, Any]:
         try:
-            result = self._parse_json(response)
-            if result.get("stars") and result.get("review"):
-                stars = result["stars"]
-                if isinstance(stars, int) and 1 <= stars <= 5:
-                    review_text = result["review"].strip()
-                    max_length = 120
-                    if len(review_text) > max_length: review_text = review_text[:max_length-3] + "..."
-                    return {"stars": stars, "review": review_text}
+            review = self._normalize_review(self._parse_json(response, STAGE_REQUIRED_KEYS["review"]))
+            if review is not None: return review
         
         except Exception as e:
-            if self.print_prompts: self.safe_print(f"评论解析错误: {e}")
+            logger.warning("评论解析错误: %s", e)
         
         default_rating = max(1, min(5, round(user_preferences.get("avg_rating", 3))))
         sentences = [s.strip() for s in response.replace('\n', '. ').split('.') if len(s.strip()) > 20]
@@ -1032,16 +3247,27 @@ class SimplifiedRecommendationAgent(IndividualAgentBase):
         
         return {"stars": default_rating, "review": default_review}
 
+    def _load_review_data(self, tool, user_id: str, item_id: str):
+        """评论撰写任务的数据准备阶段（纯数据库访问与统计，可在线程中执行）"""
+        with trace_span("db.user_reviews") as span:
+            user_reviews = tool.get_reviews(user_id=user_id)
+            span["count"] = len(user_reviews or [])
+        self._prefetch_task_data(tool, [item_id], user_reviews)
+        with trace_span("db.item"):
+            item_info = tool.get_item(item_id)
+            item_reviews = tool.get_reviews(item_id=item_id)
+        if not item_info: return user_reviews, item_info, item_reviews, {}
+        with trace_span("profile"):
+            user_preferences = self._analyze_user_review_style(user_reviews, tool, user_id)
+        return user_reviews, item_info, item_reviews, user_preferences
+
     async def _generate_review(self, user_id: str, item_id: str, tool) -> Dict[str, Any]:
-        user_reviews = tool.get_reviews(user_id=user_id)
-        item_info = tool.get_item(item_id)
-        item_reviews = tool.get_reviews(item_id=item_id)
+        user_reviews, item_info, item_reviews, user_preferences = await self._run_db(self._load_review_data, tool, user_id, item_id)
         
         if not item_info: return {"stars": 3, "review": "This place seems decent."}
         
-        user_preferences = self._analyze_user_review_style(user_reviews, tool)
         target_category = self._extract_main_category(item_info.get('categories', 'Unknown'))
-        item_avg_rating = item_info.get('stars', 0) or (sum(r['stars'] for r in item_reviews) / len(item_reviews) if item_reviews else 3)
+        item_avg_rating = item_info.get('stars', 0) or (review_stars_sum(item_reviews) / len(item_reviews) if item_reviews else 3)
         
         # 构建用户偏好摘要
         category_prefs = user_preferences.get('category_preferences', {})
@@ -1058,51 +3284,148 @@ class SimplifiedRecommendationAgent(IndividualAgentBase):
         
         # 获取用户相关评论示例
         candidate_categories = [target_category]
-        user_relevant_reviews = self._get_user_relevant_reviews(user_reviews, candidate_categories, tool, limit=5)
-
-        system_prompt = """你是一个评价写手，需要根据用户的历史行为模式为场所写出符合该用户风格的评价。
-
-要求：
-1. 评分要符合用户的评分习惯和对该类场所的偏好
-2. 评价文本要模仿用户的写作风格，长度控制在30-50词
-3. 内容要合理，关注用户历史上重视的场所特征"""
-
-        user_prompt = f"""用户偏好分析：
-{preference_summary}
-
-{user_relevant_reviews}
-
-目标场所信息：
-- 场所名称: {item_info.get('name', 'Unknown')}
-- 场所类别: {target_category}
-- 该场所平均评分: {item_avg_rating:.1f}星
-
-请根据用户的偏好模式生成一条评价。
-
-输出格式：
-```json
-{{
-    "stars": [1-5的整数评分],
-    "review": "[模仿用户风格的评价文本，30-50词]"
-}}
-```"""
+        user_relevant_reviews = self._get_user_relevant_reviews(user_reviews, candidate_categories, tool, limit=5, max_tokens=self._budget('review', 'reviews'))
 
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
+        fields = dict(preference_summary=preference_summary, user_relevant_reviews=user_relevant_reviews, item_name=item_info.get('name', 'Unknown'),
+            target_category=target_category, item_avg_rating=item_avg_rating)
+        
+        if self._review_batcher is not None:
+            review = await self._review_batcher.submit(PROMPT_TEMPLATES["review"].render_sections(**fields))
+            if review is not None: return review
         
+        messages = self._render_prompt("review", **fields)
         self._print_prompt(messages, "REVIEW_GENERATION", "Review Generator")
-        response = await self.llm.atext_request(messages)
+        response = await self._run_stage("review", self._llm_request(messages, "review"), str)
         return self._parse_review_response(response, user_preferences)
 
+    async def _review_batch_llm(self, entries: List[str]) -> Dict[int, Dict[str, Any]]:
+        """一次LLM调用生成多位用户的评论，返回{条目编号: 评论}，只包含校验通过的条目"""
+        entries_text = "\n\n".join(f"### 条目{index}\n{entry}" for index, entry in enumerate(entries, 1))
+        messages = self._render_prompt("review_batch", count=len(entries), entries=entries_text)
+        self._print_prompt(messages, "REVIEW_BATCH", "Review Batch Generator")
+        response = await self._run_stage("review_batch", self._llm_request(messages, "review_batch"), str)
+        result = self._parse_json(response, STAGE_REQUIRED_KEYS["review_batch"])
+        reviews = {}
+        for item in result.get("reviews") or []:
+            if not isinstance(item, dict): continue
+            try:
+                index = int(item.get("id"))
+            except (TypeError, ValueError):
+                continue
+            review = self._normalize_review(item)
+            if review is not None and 1 <= index <= len(entries): reviews.setdefault(index, review)
+        if self.print_prompts: self.safe_print(f"📝 批量评论: {len(entries)}个条目, 解析成功{len(reviews)}个")
+        return reviews
+
     async def forward(self, task_context: dict[str, Any]):
+        trace = TaskTrace(task_context.get("target"), task_context.get("task_id")) if (self.collect_metrics or self._trace_writer) else None
+        trace_token = _CURRENT_TRACE.set(trace)
+        capture_token = _PROMPT_CAPTURE.set(self._should_capture_prompts(task_context))
+        try:
+            return await self._forward_task(task_context)
+        finally:
+            _PROMPT_CAPTURE.reset(capture_token)
+            _CURRENT_TRACE.reset(trace_token)
+            if trace is not None: self._finish_trace(trace)
+
+    async def _forward_task(self, task_context: dict[str, Any]):
         target = task_context["target"]
         if target == "recommendation":
             return await self._handle_recommendation(task_context)
         elif target == "review_writing":
             user_id, item_id = task_context["user_id"], task_context["item_id"]
-            tool = self.toolbox.get_tool_object("uir")
-            return await self._generate_review(user_id, item_id, tool)
+            tool = self._get_task_tool()
+            try:
+                return await self._generate_review(user_id, item_id, tool)
+            finally:
+                self._report_task_stats(tool)
         else:
-            raise ValueError(f"Unknown target: {target}")
\ No newline at end of file
+            raise ValueError(f"Unknown target: {target}")
+
+    def _finish_trace(self, trace: TaskTrace):
+        """任务结束：汇总到指标注册表并写出JSONL；打印各阶段耗时便于定位慢任务"""
+        record = trace.to_dict()
+        self.last_trace = record
+        if self.collect_metrics: METRICS.record_trace(trace)
+        if self._trace_writer is not None: self._trace_writer.write(record)
+        if self.print_prompts:
+            stages = ", ".join(f"{span['name']} {span['duration_ms']:.0f}ms" for span in trace.spans if span["name"] != "json.parse")
+            self.safe_print(f"⏱️ 任务耗时{record['duration_ms']:.0f}ms: {stages}")
+
+    async def iter_tasks(self, task_contexts, concurrency: int = 32, db_concurrency: int = 8, llm_concurrency: int = 200,
+                         queue_size: int = 128, task_timeout: Optional[float] = None):
+        """并发批量执行任务（recommendation与review_writing均可），按输入顺序逐个产出结果。
+        task_contexts可为普通或异步可迭代对象；已读入但尚未产出的任务数不超过queue_size+concurrency（背压），
+        超时或出错的任务产出{"error": 原因}"""
+        queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        window = asyncio.Semaphore(queue_size + concurrency)
+        ready = asyncio.Condition()
+        results: Dict[int, Any] = {}
+        total: Optional[int] = None
+        stats = {"completed": 0, "failed": 0, "timed_out": 0}
+        limits = (asyncio.Semaphore(db_concurrency), asyncio.Semaphore(llm_concurrency))
+
+        async def produce():
+            nonlocal total
+            count = 0
+            try:
+                if hasattr(task_contexts, "__aiter__"):
+                    async for task_context in task_contexts:
+                        await window.acquire()
+                        await queue.put((count, task_context))
+                        count += 1
+                else:
+                    for task_context in task_contexts:
+                        await window.acquire()
+                        await queue.put((count, task_context))
+                        count += 1
+            finally:
+                total = count
+                for _ in range(concurrency): await queue.put(None)
+                async with ready: ready.notify_all()
+
+        async def work():
+            _RUN_LIMITS.set(limits)  # 每个工作任务有独立的上下文副本，只影响本次批量执行
+            while True:
+                job = await queue.get()
+                if job is None: return
+                index, task_context = job
+                try:
+                    result = await asyncio.wait_for(self.forward(task_context), task_timeout)
+                    stats["completed"] += 1
+                except asyncio.TimeoutError:
+                    result = {"error": "timeout"}
+                    stats["timed_out"] += 1
+                except Exception as e:
+                    result = {"error": str(e)}
+                    stats["failed"] += 1
+                async with ready:
+                    results[index] = result
+                    ready.notify_all()
+
+        start = time.perf_counter()
+        producer = asyncio.create_task(produce())
+        workers = [asyncio.create_task(work()) for _ in range(concurrency)]
+        next_index = 0
+        try:
+            while True:
+                async with ready:
+                    await ready.wait_for(lambda: next_index in results or (total is not None and next_index >= total))
+                    if next_index not in results: break
+                    result = results.pop(next_index)
+                window.release()
+                next_index += 1
+                yield result
+            if producer.done() and producer.exception(): raise producer.exception()
+        finally:
+            for task in [producer, *workers]: task.cancel()
+            elapsed = time.perf_counter() - start
+            self.batch_stats = {**stats, "tasks": next_index, "elapsed": round(elapsed, 3),
+                                "tasks_per_sec": round(next_index / elapsed, 2) if elapsed > 0 else 0.0}
+            if self.print_prompts:
+                self.safe_print(f"📦 批量执行: {next_index}个任务, 成功{stats['completed']}, 失败{stats['failed']}, "
+                                f"超时{stats['timed_out']}, 吞吐{self.batch_stats['tasks_per_sec']}个/秒")
+
+    async def run_tasks(self, task_contexts, **kwargs) -> List[Any]:
+        """iter_tasks的便捷版本：执行全部任务并按输入顺序返回结果列表"""
+        return [result async for result in self.iter_tasks(task_contexts, **kwargs)]
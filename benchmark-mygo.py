@@ -0,0 +1,1077 @@
+"""MyGO离线基准测试 - 在合成的内存数据上测量智能体热点路径的耗时
+
+用法:
+    python benchmark-mygo.py bulk --tasks 50 --candidates 20 --db-latency 0.002
+    python benchmark-mygo.py prerank --tasks 200 --candidates 40 --top-k 10 20 30
+    python benchmark-mygo.py stream --tasks 10 --token-delay 0.002 --tail-chars 1500
+    python benchmark-mygo.py prefix --tasks 40 --candidate-sets 4 --block-size 16
+    python benchmark-mygo.py prefilter --tasks 200 --candidates 20
+    python benchmark-mygo.py reviews --tasks 200 --batch-sizes 1 4 8 --llm-latency 0.3
+    python benchmark-mygo.py suite --scales 10 1000 100000 --tasks 40 --llm-latency 0.05 --output suite.json
+    python benchmark-mygo.py check
+"""
+from typing import Any, List, Dict
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import asyncio
+import importlib.util
+import io
+import json
+import logging
+import os
+import re
+import random
+import statistics
+import sqlite3
+import tempfile
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # Windows上不报告进程峰值RSS
+    resource = None
+
+
+def load_agent_module():
+    """按文件路径加载agent-mygo.py（文件名含连字符，无法直接import）"""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "agent-mygo.py")
+    spec = importlib.util.spec_from_file_location("agent_mygo", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+mygo = load_agent_module()
+
+CATEGORIES = ["Restaurants", "Nail Salons", "Hair Salons", "Coffee & Tea", "Bars", "Bakeries", "Gyms", "Day Spas", "Pizza", "Sushi Bars"]
+CITIES = ["Philadelphia", "Tampa", "Tucson", "Reno", "Nashville"]
+NAMES = ["alice", "brian", "chloe", "david", "emma", "felix", "grace", "henry", "irene", "jason"]
+WORDS = ("great service friendly staff clean place amazing food slow waiting time price value nice atmosphere "
+         "recommend again never coming back best ever decent okay quality fresh tasty rude manager owner").split()
+
+
+class SyntheticUIRTool:
+    """合成的内存uir工具 - 可配置用户/场所/评论规模，每次查询可模拟数据库延迟并计数。
+    text_pool > 0时评论正文与评分/日期从固定大小的池中复用（大规模评论时控制生成耗时与内存）；
+    cache_reviews=False时不保留生成的评论，每次读取按种子重新生成（评论规模超过内存时使用）"""
+
+    def __init__(self, n_users: int = 200, n_items: int = 500, reviews_per_item: int = 50, reviews_per_user: int = 30,
+                 db_latency: float = 0.0, batch_api: bool = False, seed: int = 0, text_pool: int = 0, cache_reviews: bool = True):
+        self.n_users, self.n_items = n_users, n_items
+        self.reviews_per_item, self.reviews_per_user = reviews_per_item, reviews_per_user
+        self.db_latency = db_latency
+        self.seed = seed
+        self.cache_reviews = cache_reviews
+        self.calls = Counter()
+        rng = random.Random(seed)
+        self._texts = [self._make_text(rng) for _ in range(text_pool)]
+        self._meta = [self._make_meta(rng) for _ in range(text_pool)]
+        self.items = {
+            f"item_{i}": {
+                "item_id": f"item_{i}", "name": f"Venue {i}",
+                "categories": f"{rng.choice(CATEGORIES)}, {rng.choice(CATEGORIES)}",
+                "stars": rng.choice([1.0, 1.5, 2.5, 3.0, 3.5, 4.0, 4.5, 5.0]),
+                "city": rng.choice(CITIES),
+            }
+            for i in range(n_items)
+        }
+        self.users = {f"user_{u}": {"user_id": f"user_{u}", "name": NAMES[u % len(NAMES)].capitalize()} for u in range(n_users)}
+        self._item_reviews: Dict[str, List[Dict]] = {}
+        self._user_reviews: Dict[str, List[Dict]] = {}
+        if batch_api:
+            self.get_items = self._get_items
+            self.get_reviews_batch = self._get_reviews_batch
+
+    def _sleep(self, kind: str):
+        self.calls[kind] += 1
+        if self.db_latency: time.sleep(self.db_latency)
+
+    @staticmethod
+    def _make_text(rng: random.Random) -> str:
+        words = rng.choices(WORDS, k=rng.randint(20, 80))
+        if rng.random() < 0.02: words.insert(rng.randrange(len(words)), rng.choice(NAMES))
+        return " ".join(words).capitalize() + "."
+
+    @staticmethod
+    def _make_meta(rng: random.Random) -> tuple:
+        return (rng.randint(1, 5), rng.choice([0, 0, 0, 1, 2, 5]),
+                f"20{rng.randint(10, 21)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d} 12:00:00")
+
+    def _make_review(self, rng: random.Random, review_id: str, user_id: str, item_id: str) -> Dict[str, Any]:
+        if self._texts:
+            text, (stars, useful, date) = self._texts[int(rng.random() * len(self._texts))], self._meta[int(rng.random() * len(self._meta))]
+        else:
+            stars, useful, date = self._make_meta(rng)
+            text = self._make_text(rng)
+        return {
+            "review_id": review_id, "user_id": user_id, "item_id": item_id,
+            "stars": stars, "useful": useful, "date": date, "text": text,
+        }
+
+    def _load_item_reviews(self, item_id: str) -> List[Dict]:
+        if item_id in self._item_reviews: return self._item_reviews[item_id]
+        rng = random.Random(f"{self.seed}:{item_id}")
+        reviews = [
+            self._make_review(rng, f"{item_id}_r{k}", f"user_{rng.randrange(self.n_users)}", item_id)
+            for k in range(self.reviews_per_item)
+        ]
+        if self.cache_reviews: self._item_reviews[item_id] = reviews
+        return reviews
+
+    def _load_user_reviews(self, user_id: str) -> List[Dict]:
+        if user_id not in self._user_reviews:
+            rng = random.Random(f"{self.seed}:{user_id}")
+            self._user_reviews[user_id] = [
+                self._make_review(rng, f"{user_id}_h{k}", user_id, f"item_{rng.randrange(self.n_items)}")
+                for k in range(self.reviews_per_user)
+            ]
+        return self._user_reviews[user_id]
+
+    def get_user(self, user_id):
+        self._sleep("get_user")
+        return self.users.get(user_id)
+
+    def get_item(self, item_id):
+        self._sleep("get_item")
+        return self.items.get(item_id)
+
+    @staticmethod
+    def _rows(reviews: List[Dict], copy: bool = True) -> List[Dict]:
+        """像数据库反序列化一样每次返回新的评论对象（包括正文字符串），使内存测量与真实工具一致；
+        copy=False用于刚生成的评论，只替换正文字符串"""
+        if not copy:
+            for r in reviews: r["text"] = r["text"].encode("utf-8").decode("utf-8")
+            return reviews
+        return [{**r, "text": r["text"].encode("utf-8").decode("utf-8")} for r in reviews]
+
+    def get_reviews(self, user_id=None, item_id=None, review_id=None):
+        self._sleep("get_reviews")
+        if item_id is not None: return self._rows(self._load_item_reviews(item_id), self.cache_reviews) if item_id in self.items else []
+        if user_id is not None: return self._rows(self._load_user_reviews(user_id)) if user_id in self.users else []
+        return []
+
+    def _get_items(self, item_ids):
+        self._sleep("get_items")
+        return [self.items.get(i) for i in item_ids]
+
+    def _get_reviews_batch(self, item_ids):
+        self._sleep("get_reviews_batch")
+        return [self._rows(self._load_item_reviews(i), self.cache_reviews) if i in self.items else [] for i in item_ids]
+
+    def make_tasks(self, n_tasks: int, n_candidates: int, seed: int = 1, candidate_sets: int = 0) -> List[Dict[str, Any]]:
+        """candidate_sets > 0时各任务从固定数量的候选列表中选取（多个用户面对同一组候选场所）"""
+        rng = random.Random(seed)
+        shared_lists = [rng.sample(list(self.items), n_candidates) for _ in range(candidate_sets)]
+        tasks = []
+        for _ in range(n_tasks):
+            tasks.append({
+                "target": "recommendation",
+                "user_id": f"user_{rng.randrange(self.n_users)}",
+                "candidate_category": rng.choice(CATEGORIES),
+                "candidate_list": list(rng.choice(shared_lists)) if shared_lists else rng.sample(list(self.items), n_candidates),
+            })
+        return tasks
+
+    def make_review_tasks(self, n_tasks: int, seed: int = 2) -> List[Dict[str, Any]]:
+        rng = random.Random(seed)
+        return [{"target": "review_writing", "user_id": f"user_{rng.randrange(self.n_users)}", "item_id": rng.choice(list(self.items))}
+                for _ in range(n_tasks)]
+
+
+class SyntheticLLM:
+    """按提示词中的输出格式生成合法JSON的假LLM；JSON之后可附带tail_chars长度的“推理”文本，latency模拟整段响应耗时，
+    char_latency按输出长度追加生成耗时；批量评论请求中每个条目以batch_drop的概率被遗漏（模拟输出不完整）；
+    final_from_end时最终选择阶段选最后5个场所（与初筛顺序不同）"""
+
+    def __init__(self, latency: float = 0.0, tail_chars: int = 0, char_latency: float = 0.0, batch_drop: float = 0.0, final_from_end: bool = False):
+        self.latency, self.tail_chars = latency, tail_chars
+        self.char_latency, self.batch_drop = char_latency, batch_drop
+        self.final_from_end = final_from_end
+        self._rng = random.Random(5)
+        self.calls = 0
+
+    def respond(self, messages: List[Dict]) -> str:
+        text = "\n".join(m["content"] for m in messages)
+        ids = list(dict.fromkeys(re.findall(r"\(ID: ([^)]+)\)", text)))
+        if '"primary_recommendations"' in text:
+            out = {"user_profile": "常去餐厅的本地用户", "primary_need": "Restaurants food", "secondary_need": "Bars", "potential_need": "Bakeries",
+                   "primary_recommendations": ids[:5], "secondary_recommendations": [{"venue_id": i, "need_type": "secondary"} for i in ids[5:8]]}
+        elif '"selected_venues"' in text:
+            out = {"selected_venues": [{"venue_id": i, "venue_name": "venue", "selection_reason": "符合主要需求"} for i in ids[:10]]}
+        elif '"final_recommendations"' in text:
+            out = {"final_recommendations": ids[-5:] if self.final_from_end else ids[:5]}
+        elif '"recommended_venues"' in text:
+            out = {"recommended_venues": [{"venue_id": i, "venue_name": "venue", "need_type": "secondary", "selection_reason": "符合次要需求"} for i in ids[:3]]}
+        elif '"reviews"' in text:
+            out = {"reviews": [{"id": int(i), "stars": 4, "review": "Great food and friendly staff, would come back again."}
+                               for i in re.findall(r"### 条目(\d+)", text) if self._rng.random() >= self.batch_drop]}
+        elif '"user_profile"' in text:
+            out = {"user_profile": "常去餐厅的本地用户", "primary_need": "Restaurants food", "secondary_need": "Bars", "potential_need": "Bakeries"}
+        else:
+            out = {"stars": 4, "review": "Great food and friendly staff, would come back again."}
+        tail = ("\n深度思考：" + "这些场所与用户历史偏好一致。" * (self.tail_chars // 13 + 1))[:self.tail_chars]
+        return "```json\n" + json.dumps(out, ensure_ascii=False, indent=2) + "\n```" + tail
+
+    async def atext_request(self, messages: List[Dict], **kwargs) -> str:
+        self.calls += 1
+        response = self.respond(messages)
+        delay = self.latency + self.char_latency * len(response)
+        if delay: await asyncio.sleep(delay)
+        return response
+
+
+class FakeSSEServer:
+    """本地OpenAI兼容流式服务：把SyntheticLLM的输出按chunk_chars切分，每段间隔token_delay秒以SSE推送；
+    客户端断开即停止生成并计入cancelled"""
+
+    def __init__(self, llm: SyntheticLLM, token_delay: float = 0.002, chunk_chars: int = 4):
+        self.llm, self.token_delay, self.chunk_chars = llm, token_delay, chunk_chars
+        self.stats = Counter()
+        self._server = None
+        self._handlers = set()
+
+    async def start(self) -> str:
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        port = self._server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}/v1"
+
+    async def close(self):
+        self._server.close()
+        # 被客户端断开的生成在下一个分段前退出，等它们结束再关闭
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+        await self._server.wait_closed()
+
+    @staticmethod
+    def _write_chunk(writer, data: bytes):
+        writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+    async def _handle(self, reader, writer):
+        task = asyncio.current_task()
+        self._handlers.add(task)
+        try:
+            await reader.readline()
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b""): break
+                name, _, value = line.decode("latin-1").partition(":")
+                if name.strip().lower() == "content-length": length = int(value)
+            payload = json.loads(await reader.readexactly(length))
+            text = self.llm.respond(payload["messages"])
+            self.stats["requests"] += 1
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\nConnection: close\r\n\r\n")
+            for k in range(0, len(text), self.chunk_chars):
+                if reader.at_eof() or writer.is_closing():
+                    self.stats["cancelled"] += 1
+                    return
+                await asyncio.sleep(self.token_delay)
+                event = {"choices": [{"delta": {"content": text[k:k + self.chunk_chars]}}]}
+                self._write_chunk(writer, f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+                await writer.drain()
+                self.stats["chunks_sent"] += 1
+            self._write_chunk(writer, b"data: [DONE]\n\n")
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            self.stats["cancelled"] += 1
+        finally:
+            writer.close()
+            self._handlers.discard(task)
+
+
+class _StreamBackedLLM:
+    """整段读取流式服务输出的LLM（非流式基线，与流式模式走同一服务便于对比）"""
+
+    def __init__(self, client):
+        self.client = client
+
+    async def atext_request(self, messages: List[Dict], **kwargs) -> str:
+        return "".join([piece async for piece in self.client.stream(messages)])
+
+
+class _Toolbox:
+    def __init__(self, tool):
+        self._tool = tool
+
+    def get_tool_object(self, name):
+        return self._tool
+
+
+class BenchAgent(mygo.SimplifiedRecommendationAgent):
+    """绕过基类初始化的基准测试智能体，直接注入uir工具与LLM"""
+    llm = None
+    toolbox = None
+
+    def __init__(self, tool, llm=None, **options):
+        self._configure({"print_prompts": False, **options})
+        self.toolbox = _Toolbox(tool)
+        self.llm = llm
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))] if ordered else 0.0
+
+
+def _summary(values: List[float]) -> str:
+    return (f"mean {statistics.mean(values) * 1000:8.2f}ms  p50 {_percentile(values, 50) * 1000:8.2f}ms  "
+            f"p95 {_percentile(values, 95) * 1000:8.2f}ms")
+
+
+def run_data_phase(agent: BenchAgent, task: Dict[str, Any]):
+    """执行推荐任务中LLM之前的全部数据访问步骤"""
+    tool = agent._get_task_tool()
+    user_reviews = tool.get_reviews(user_id=task["user_id"])
+    agent._prefetch_task_data(tool, task["candidate_list"], user_reviews)
+    agent._analyze_user_preferences(user_reviews, tool)
+    agent._build_candidate_details(task["candidate_list"], tool)
+    user_info = tool.get_user(task["user_id"])
+    agent._check_user_mentioned_in_reviews(user_info.get("name", ""), task["candidate_list"], tool)
+
+
+def bench_bulk(args):
+    """对比逐个查询与批量预取两种模式下每个任务数据阶段的耗时"""
+    for batch_api in (False, True):
+        print(f"\n== bulk fetch (db_latency={args.db_latency * 1000:.1f}ms, batch_api={batch_api}) ==")
+        for bulk in (False, True):
+            tool = SyntheticUIRTool(reviews_per_item=args.reviews_per_item, db_latency=args.db_latency, batch_api=batch_api)
+            agent = BenchAgent(tool, use_shared_cache=False, bulk_fetch=bulk, bulk_fetch_workers=args.workers)
+            tasks = tool.make_tasks(args.tasks, args.candidates)
+            timings = []
+            for task in tasks:
+                start = time.perf_counter()
+                run_data_phase(agent, task)
+                timings.append(time.perf_counter() - start)
+            calls = sum(tool.calls.values()) / len(tasks)
+            print(f"{'bulk' if bulk else 'per-id':>7}: {_summary(timings)}  db calls/task {calls:6.1f}")
+
+
+# 第一阶段可能给出的中文主要需求（按用户最常去的类别选取）：
+# keyword为含NEED_CATEGORY_TERMS关键词的表述，paraphrase为不含任何表中关键词的同义表述（扩展落空时的情形）
+CATEGORY_NEEDS = {
+    "keyword": {
+        "Restaurants": "想找一家口碑好的餐厅用餐", "Nail Salons": "美甲服务", "Hair Salons": "美发造型", "Coffee & Tea": "安静的咖啡馆",
+        "Bars": "下班后去酒吧小酌", "Bakeries": "新鲜的面包烘焙", "Gyms": "附近的健身房", "Day Spas": "放松的水疗按摩",
+        "Pizza": "披萨外卖", "Sushi Bars": "高品质的日式料理",
+    },
+    "paraphrase": {
+        "Restaurants": "找个地方吃顿像样的晚饭", "Nail Salons": "做个手部护理，涂个颜色", "Hair Salons": "剪短头发换个造型",
+        "Coffee & Tea": "找个地方喝杯拿铁看书", "Bars": "晚上喝两杯鸡尾酒", "Bakeries": "买点刚出炉的可颂和吐司",
+        "Gyms": "找个地方撸铁锻炼身体", "Day Spas": "周末做个全身放松护理", "Pizza": "点一份芝士薄饼", "Sushi Bars": "吃生鱼片和手握饭团",
+    },
+}
+
+
+def bench_prerank(args):
+    """评估本地预排序：主要需求取自用户历史最常去的类别（与候选场所无关），查询与流程中相同（中文主要需求 + 任务候选类别）；
+    按需求表述（含/不含关键词表中的词）分别统计该类别候选被保留的比例（召回率，随机保留的期望为top_k/候选数）与初筛候选列表token的缩减"""
+    for need in CATEGORY_NEEDS["paraphrase"].values():
+        assert not any(keyword in need for keyword in mygo.NEED_CATEGORY_TERMS), need
+    tool = SyntheticUIRTool(reviews_per_item=args.reviews_per_item)
+    print(f"\n== prerank ({args.tasks} tasks, {args.candidates} candidates) ==")
+    for top_k in args.top_k:
+        agent = BenchAgent(tool, prerank_top_k=top_k)
+        for phrasing, needs in CATEGORY_NEEDS.items():
+            relevant, kept_relevant, expected, tasks, full_tokens, kept_tokens, timings = 0, 0, 0.0, 0, 0, 0, []
+            for task in tool.make_tasks(args.tasks, args.candidates):
+                task_tool = agent._get_task_tool()
+                preferences = agent._analyze_user_preferences(task_tool.get_reviews(user_id=task["user_id"]), task_tool)
+                need_category = max(preferences["category_preferences"].items(), key=lambda kv: kv[1]["count"])[0]
+                details = agent._build_candidate_details(task["candidate_list"], task_tool)
+                targets = [d["item_id"] for d in details if d["category"] == need_category]
+                if not targets: continue
+                query = f"{needs[need_category]} {task['candidate_category']}"
+                start = time.perf_counter()
+                kept = agent._prerank_candidates(details, query)
+                timings.append(time.perf_counter() - start)
+                kept_ids = {d["item_id"] for d in kept}
+                tasks += 1
+                relevant += len(targets)
+                kept_relevant += sum(t in kept_ids for t in targets)
+                expected += len(targets) * min(1.0, top_k / len(details))
+                full_tokens += mygo.estimate_tokens(agent._format_venues_for_screening(details))
+                kept_tokens += mygo.estimate_tokens(agent._format_venues_for_screening(kept))
+            print(f"top_k={top_k:>3} {phrasing:>10}: need-category recall {kept_relevant / relevant:6.1%} (random {expected / relevant:6.1%}, {tasks} tasks)  "
+                  f"screening tokens {full_tokens / tasks:7.0f} -> {kept_tokens / tasks:7.0f} ({1 - kept_tokens / full_tokens:5.1%} saved)  rank {_summary(timings)}")
+
+
+def bench_stream(args):
+    """对比整段读取与流式提前终止：每个任务的端到端耗时、服务端实际推送的分段数与被取消的生成数"""
+    async def run():
+        tool = SyntheticUIRTool(reviews_per_item=args.reviews_per_item)
+        tasks = tool.make_tasks(args.tasks, args.candidates)
+        server = FakeSSEServer(SyntheticLLM(tail_chars=args.tail_chars), token_delay=args.token_delay, chunk_chars=args.chunk_chars)
+        base_url = await server.start()
+        endpoint = {"base_url": base_url, "model": "fake"}
+        print(f"\n== streaming ({args.tasks} tasks, token delay {args.token_delay * 1000:.1f}ms, tail {args.tail_chars} chars) ==")
+        outputs = {}
+        for stream in (False, True):
+            server.stats.clear()
+            agent = BenchAgent(tool, _StreamBackedLLM(mygo.OpenAIStreamClient(**endpoint)), stream_llm=stream, stream_endpoint=endpoint)
+            timings, results = [], []
+            for task in tasks:
+                start = time.perf_counter()
+                results.append(await agent.forward(task))
+                timings.append(time.perf_counter() - start)
+            outputs[stream] = results
+            print(f"{'stream' if stream else 'full':>7}: {_summary(timings)}  chunks sent/task {server.stats['chunks_sent'] / len(tasks):7.1f}  "
+                  f"cancelled {server.stats['cancelled']}/{server.stats['requests']}")
+        await server.close()
+        print(f"same recommendations: {outputs[False] == outputs[True]}")
+
+    asyncio.run(run())
+
+
+class _PromptRecorder:
+    """记录每次LLM请求的消息列表，响应交给内部的假LLM"""
+
+    def __init__(self, llm: SyntheticLLM):
+        self._llm = llm
+        self.requests: List[List[Dict]] = []
+
+    async def atext_request(self, messages: List[Dict], **kwargs) -> str:
+        self.requests.append(messages)
+        return await self._llm.atext_request(messages, **kwargs)
+
+
+_TOKEN_RE = re.compile(r"[A-Za-z]+|\d+|\s+|[^\sA-Za-z\d]")
+
+
+def _prompt_tokens(messages: List[Dict]) -> List[str]:
+    """本地近似分词：英文单词、数字、空白串各为一个token，中文与标点逐字；每条消息前加角色标记"""
+    tokens = []
+    for message in messages:
+        tokens.append(f"<|{message['role']}|>")
+        tokens.extend(_TOKEN_RE.findall(message["content"]))
+    return tokens
+
+
+def _request_stage(messages: List[Dict]) -> str:
+    system = messages[0]["content"] if messages and messages[0]["role"] == "system" else ""
+    for name, template in mygo.PROMPT_TEMPLATES.items():
+        if system in (template.system, template.prefix_system): return name
+    return "other"
+
+
+def prefix_overlap(requests: List[List[Dict]], block_size: int = 16) -> Dict[str, Dict[str, float]]:
+    """按请求顺序模拟服务端前缀缓存（容量不限）：token按block_size分块并链式哈希，
+    每个请求命中此前任一请求已缓存的最长前导块序列；返回各阶段与总体的token复用比例"""
+    cached = set()
+    per_stage: Dict[str, Counter] = {}
+    for messages in requests:
+        tokens = _prompt_tokens(messages)
+        stats = per_stage.setdefault(_request_stage(messages), Counter())
+        chain, reused, hit = 0, 0, True
+        for start in range(0, len(tokens) - block_size + 1, block_size):
+            chain = hash((chain, tuple(tokens[start:start + block_size])))
+            if hit and chain in cached: reused += block_size
+            else: hit = False
+            cached.add(chain)
+        stats["requests"] += 1
+        stats["tokens"] += len(tokens)
+        stats["reused"] += reused
+    total = sum(per_stage.values(), Counter())
+    return {name: {"requests": c["requests"], "tokens_per_request": round(c["tokens"] / c["requests"], 1),
+                   "reuse": round(c["reused"] / c["tokens"], 4) if c["tokens"] else 0.0}
+            for name, c in [*sorted(per_stage.items()), ("total", total)]}
+
+
+def bench_prefix(args):
+    """对比不同提示词布局在一批任务上的前缀复用：按请求顺序统计每个请求与此前请求共享的前缀token比例"""
+    tool = SyntheticUIRTool(reviews_per_item=args.reviews_per_item)
+    n_review = int(args.tasks * args.review_ratio)
+    tasks = tool.make_tasks(args.tasks - n_review, args.candidates, candidate_sets=args.candidate_sets) + tool.make_review_tasks(n_review)
+    random.Random(3).shuffle(tasks)
+    print(f"\n== prefix overlap ({len(tasks)} tasks, {args.candidate_sets or 'random'} candidate sets, block {args.block_size} tokens) ==")
+    outputs = {}
+    for layout, venues_first in (("classic", False), ("prefix", False), ("prefix", True)):
+        label = f"{layout}{'+venues_first' if venues_first else ''}"
+        recorder = _PromptRecorder(SyntheticLLM())
+        agent = BenchAgent(tool, recorder, message_layout=layout, venues_first=venues_first)
+        outputs[label] = asyncio.run(agent.run_tasks(tasks, concurrency=1))
+        report = prefix_overlap(recorder.requests, args.block_size)
+        print(f"\n{label}:")
+        for name, stats in report.items():
+            print(f"  {name:<10} requests {stats['requests']:>4}  tokens/request {stats['tokens_per_request']:>8.1f}  "
+                  f"prefix reuse {stats['reuse']:6.1%}")
+    print(f"\nsame outputs across layouts: {len({json.dumps(o, sort_keys=True) for o in outputs.values()}) == 1}")
+
+
+PREFILTER_CONFIGS = {
+    "default": {},
+    "rating_habit": {"prefilter_rules": [*mygo.DEFAULT_PREFILTER_RULES, {"rule": "rating_habit", "margin": 1.0}]},
+    "category": {"prefilter_rules": [*mygo.DEFAULT_PREFILTER_RULES, {"rule": "category", "min_count": 3}]},
+    "city": {"prefilter_rules": [*mygo.DEFAULT_PREFILTER_RULES, {"rule": "city", "min_count": 6}]},
+    "combined": {"prefilter_rules": [*mygo.DEFAULT_PREFILTER_RULES, {"rule": "rating_habit", "margin": 1.0},
+                                     {"rule": "category", "min_count": 3}, {"rule": "city", "min_count": 6}],
+                 "prefilter_min_keep": 8},
+}
+
+
+def bench_prefilter(args):
+    """对比不同预筛选规则组合：每个任务保留的候选数、各规则过滤数、初筛候选列表token与候选构建耗时"""
+    tool = SyntheticUIRTool(reviews_per_item=args.reviews_per_item)
+    tasks = tool.make_tasks(args.tasks, args.candidates)
+    print(f"\n== prefilter ({args.tasks} tasks, {args.candidates} candidates) ==")
+    for name, options in PREFILTER_CONFIGS.items():
+        agent = BenchAgent(tool, **options)
+        kept, tokens, timings = [], 0, []
+        for task in tasks:
+            preferences = agent._analyze_user_preferences(tool.get_reviews(user_id=task["user_id"]), tool)
+            start = time.perf_counter()
+            details = agent._build_candidate_details(task["candidate_list"], tool, preferences)
+            timings.append(time.perf_counter() - start)
+            kept.append(len(details))
+            tokens += mygo.estimate_tokens(agent._format_venues_for_screening(details))
+        removed = ", ".join(f"{rule} {count / len(tasks):.2f}" for rule, count in agent.prefilter_stats.items() if rule != "guarded") or "-"
+        print(f"{name:>13}: kept {statistics.mean(kept):5.2f}/task (min {min(kept)})  screening tokens {tokens / len(tasks):7.0f}  "
+              f"removed/task: {removed}  guarded {agent.prefilter_stats.get('guarded', 0)}  build {_summary(timings)}")
+
+
+def bench_reviews(args):
+    """评论撰写微批：不同批大小下review_writing任务的吞吐量、LLM调用次数与回退到单独调用的条目数"""
+    tool = SyntheticUIRTool(reviews_per_item=args.reviews_per_item)
+    tasks = tool.make_review_tasks(args.tasks)
+    print(f"\n== review batching ({args.tasks} tasks, concurrency {args.concurrency}, {args.llm_concurrency} concurrent LLM requests, llm latency {args.llm_latency * 1000:.0f}ms "
+          f"+ {args.char_latency * 1000:.2f}ms/char, batch drop {args.batch_drop:.0%}) ==")
+    outputs = {}
+    for size in args.batch_sizes:
+        llm = SyntheticLLM(latency=args.llm_latency, char_latency=args.char_latency, batch_drop=args.batch_drop)
+        agent = BenchAgent(tool, llm, review_batch_size=size, review_batch_window=args.window)
+        start = time.perf_counter()
+        outputs[size] = asyncio.run(agent.run_tasks(tasks, concurrency=args.concurrency, llm_concurrency=args.llm_concurrency))
+        elapsed = time.perf_counter() - start
+        stats = agent._review_batcher.stats if agent._review_batcher else {}
+        print(f"batch {size:>3}: {len(tasks) / elapsed:7.2f} tasks/s  llm calls {llm.calls:>4}  batches {stats.get('batches', 0):>4}  "
+              f"singles {stats.get('singles', 0):>3}  fallbacks {stats.get('fallbacks', 0):>3}")
+    print(f"same outputs across batch sizes: {len({json.dumps(o, sort_keys=True) for o in outputs.values()}) == 1}")
+
+
+SUITE_STAGES = ["task.recommendation", "task.review_writing", "db.user_reviews", "db.prefetch", "db.item", "profile", "candidates.build",
+                "mention_scan", "llm.intent", "llm.screening", "llm.final", "llm.secondary", "llm.review", "json.parse"]
+
+
+def _reset_shared_state(review_cache_mb: int):
+    """每个规模开始前清空进程级缓存与指标，避免上一规模的数据影响结果"""
+    mygo.SHARED_VENUE_CACHE.items.clear()
+    mygo.SHARED_VENUE_CACHE.reviews.clear()
+    mygo.SHARED_VENUE_CACHE.reviews.evictions = 0
+    mygo.SHARED_VENUE_CACHE.configure(review_max_bytes=review_cache_mb * 1024 * 1024)
+    mygo.MENTION_INDEX = mygo.MentionIndex()
+    mygo.VENUE_RANKER = mygo.VenueRanker()
+    mygo.VENUE_SUMMARY_CACHE.clear()
+    mygo.METRICS.reset()
+
+
+def run_suite_scale(args, reviews_per_item: int) -> Dict[str, Any]:
+    """在一个评论规模下通过forward执行一批任务：吞吐量、各阶段耗时、数据库调用次数与峰值内存"""
+    # 评论总量受review_budget限制：评论越多场所越少（至少覆盖候选数）
+    n_items = max(args.candidates, min(args.items, args.review_budget // reviews_per_item))
+    text_pool = 2000 if reviews_per_item >= 1000 else 0
+    # 大规模时不常驻合成评论，读取时重新生成（计入数据库耗时，与真实数据库反序列化相当）
+    cache_reviews = reviews_per_item < 10000
+    tool = SyntheticUIRTool(n_users=args.users, n_items=n_items, reviews_per_item=reviews_per_item,
+                            db_latency=args.db_latency, text_pool=text_pool, cache_reviews=cache_reviews)
+    n_review = int(args.tasks * args.review_ratio)
+    tasks = tool.make_tasks(args.tasks - n_review, args.candidates) + tool.make_review_tasks(n_review)
+    random.Random(3).shuffle(tasks)
+    if cache_reviews:
+        for item_id in {i for task in tasks for i in task.get("candidate_list", [task.get("item_id")])}:
+            tool._load_item_reviews(item_id)  # 合成数据的生成不计入测量
+
+    async def run(trace_memory: bool):
+        _reset_shared_state(args.review_cache_mb)
+        tool.calls.clear()
+        agent = BenchAgent(tool, SyntheticLLM(latency=args.llm_latency))
+        if trace_memory: tracemalloc.start()
+        start = time.perf_counter()
+        results = await agent.run_tasks(tasks, concurrency=args.concurrency)
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else 0
+        if trace_memory: tracemalloc.stop()
+        return results, elapsed, peak
+
+    results, elapsed, _ = asyncio.run(run(False))
+    metrics = mygo.METRICS.summary()
+    calls = {kind: round(count / len(tasks), 2) for kind, count in sorted(tool.calls.items())}
+    review_evictions = mygo.SHARED_VENUE_CACHE.reviews.evictions
+    _, _, peak = asyncio.run(run(True))
+    return {
+        "reviews_per_item": reviews_per_item, "items": n_items, "tasks": len(tasks),
+        "errors": sum(1 for r in results if isinstance(r, dict) and "error" in r),
+        "tasks_per_sec": round(len(tasks) / elapsed, 2), "elapsed_s": round(elapsed, 3),
+        "db_calls_per_task": calls, "peak_memory_mb": round(peak / 1024 / 1024, 2),
+        # 进程启动以来的峰值RSS（规模按从小到大执行时即为截至该规模的峰值）
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1) if resource else None,
+        "review_cache_evictions": review_evictions,
+        "stages_ms": {name: metrics["samples"][f"{name}.ms"] for name in SUITE_STAGES if f"{name}.ms" in metrics["samples"]},
+        "prompt_tokens": {name: metrics["samples"][name]["p50"] for name in metrics["samples"] if name.endswith(".prompt_tokens")},
+    }
+
+
+def bench_suite(args):
+    """在多个评论规模下端到端运行forward，输出吞吐量、各阶段p50/p95/p99耗时、数据库调用次数与峰值内存"""
+    report = []
+    for scale in args.scales:
+        print(f"\n== suite: {scale} reviews/item ==")
+        result = run_suite_scale(args, scale)
+        report.append(result)
+        print(f"{result['tasks']} tasks over {result['items']} items: {result['tasks_per_sec']} tasks/s, "
+              f"errors {result['errors']}, peak traced memory {result['peak_memory_mb']}MB, peak RSS {result['peak_rss_mb']}MB, "
+              f"review cache evictions {result['review_cache_evictions']}")
+        print(f"db calls/task: {result['db_calls_per_task']}")
+        print(f"{'stage':<22} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+        for name, stats in result["stages_ms"].items():
+            print(f"{name:<22} {stats['count']:>6} {stats['p50']:>9.2f} {stats['p95']:>9.2f} {stats['p99']:>9.2f}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args) | {"func": None}, "results": report}, f, ensure_ascii=False, indent=2)
+        print(f"\nreport written to {args.output}")
+
+
+async def _chunks(text: str, size: int):
+    for k in range(0, len(text), size):
+        yield text[k:k + size]
+
+
+def check_stream_parse():
+    """流式提前终止与整段解析结果一致：格式示例对象缺少必需键时继续读取，```json围栏之前的内容被丢弃"""
+    agent = BenchAgent(SyntheticUIRTool(n_items=5), stream_llm=True)
+    keys = mygo.STAGE_REQUIRED_KEYS["screening"]
+    venues = '{"selected_venues": [{"venue_id": "item_1", "venue_name": "Venue 1", "selection_reason": "符合"}]}'
+    for response in ('我先按{"类别": 1}格式思考。\n```json\n' + venues + '```\n之后的推理',
+                     '示例{"类别": 1}，结果如下 ' + venues + ' 之后的推理'):
+        expected = agent._parse_json(response, keys)
+        assert expected.get("selected_venues"), expected
+        for size in (1, 3, 7, len(response)):
+            streamed = asyncio.run(agent._consume_stream(_chunks(response, size), keys, {}))
+            assert agent._parse_json(streamed, keys) == expected, (size, streamed)
+
+
+def check_compact_reviews():
+    """CompactReviewList逐条还原的评论dict与原评论完全相同（日期字符串、整数时间戳、浮点评分、相同取值的列）"""
+    tool = SyntheticUIRTool(n_items=3, reviews_per_item=40)
+    sources = [tool.get_reviews(item_id=item_id) for item_id in tool.items]
+    sources.append([{**r, "date": 1546300800 + k * 86400} for k, r in enumerate(sources[0])])
+    sources.append([{**r, "stars": r["stars"] + 0.5, "date": "2020-01-01 08:30:00"} for r in sources[1]])
+    for reviews in sources:
+        compact = mygo.CompactReviewList.from_reviews(reviews)
+        assert compact is not None
+        assert list(compact) == reviews, next((c, r) for c, r in zip(compact, reviews) if c != r)
+        assert compact[3:7] == reviews[3:7] and compact[-1] == reviews[-1]
+
+
+def check_mention_index():
+    """用户名提及：倒排索引与逐条分词（mode='scan'）结果相同，普通与紧凑评论列表、评论列表被淘汰后重新加载时均成立"""
+    tool = SyntheticUIRTool(n_items=40, reviews_per_item=200)
+    tasks = tool.make_tasks(10, 20)
+    names = [name.capitalize() for name in NAMES] + ["Zoe", "service"]
+    for compact in (False, True):
+        agent = BenchAgent(tool, compact_reviews=compact)
+        for round_ in range(2):
+            for task in tasks:
+                task_tool = agent._get_task_tool()
+                for name in names:
+                    scan = agent._check_user_mentioned_in_reviews(name, task["candidate_list"], task_tool, mode="scan")
+                    index = agent._check_user_mentioned_in_reviews(name, task["candidate_list"], task_tool, mode="index")
+                    assert scan == index, (compact, name, task["candidate_list"])
+                    assert name == "Zoe" or scan["venue_count"], name
+            mygo.SHARED_VENUE_CACHE.reviews.clear()
+
+
+class _FailingLLM(SyntheticLLM):
+    """提示词包含marker的请求直接失败，用于模拟某个阶段的LLM故障"""
+
+    def __init__(self, marker: str, **kwargs):
+        super().__init__(**kwargs)
+        self.marker = marker
+
+    async def atext_request(self, messages: List[Dict], **kwargs) -> str:
+        if any(self.marker in m["content"] for m in messages): raise RuntimeError("stage unavailable")
+        return await super().atext_request(messages, **kwargs)
+
+
+def check_speculative_partial():
+    """第四阶段失败时，推测执行与顺序执行一样把第三阶段的最终主要推荐排在启发式结果之前"""
+    tool = SyntheticUIRTool(reviews_per_item=20)
+    for task in tool.make_tasks(5, 20):
+        outputs = {}
+        for speculative in (False, True):
+            recorder = _PromptRecorder(_FailingLLM('"recommended_venues"', final_from_end=True))
+            agent = BenchAgent(tool, recorder, speculative_stage4=speculative)
+            outputs[speculative] = asyncio.run(agent.forward(task))
+            assert agent.heuristic_stats["stage_failure"] == 1, agent.heuristic_stats
+            final_prompt = next(m for m in recorder.requests if '"final_recommendations"' in m[-1]["content"])
+            final_ids = list(dict.fromkeys(re.findall(r"\(ID: ([^)]+)\)", "\n".join(m["content"] for m in final_prompt))))[-5:]
+            assert outputs[speculative]["item_list"] == final_ids, (speculative, outputs[speculative], final_ids)
+
+
+def check_profile_store():
+    """画像存储：按数据集用户文件全量预计算（重复执行时不再写入），预计算不在任务级缓存中累积各用户的评论；
+    画像结构版本变化前写入的画像读取时重新计算"""
+    tool = SyntheticUIRTool(n_users=30, n_items=100, reviews_per_item=5)
+    with tempfile.TemporaryDirectory() as tmp:
+        users_path = os.path.join(tmp, "user.json")
+        with open(users_path, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(user) + "\n" for user in tool.users.values())
+        agent = BenchAgent(tool, profile_store_path=os.path.join(tmp, "profiles.db"), profile_users_path=users_path)
+        task_tools = []
+        get_task_tool = agent._get_task_tool
+        agent._get_task_tool = lambda *args: task_tools.append(get_task_tool(*args)) or task_tools[-1]
+        assert agent.precompute_user_profiles() == len(tool.users)
+        assert agent.precompute_user_profiles() == 0
+        del agent._get_task_tool
+        assert max(sum(key[0] is not None for key in t._reviews) for t in task_tools) == 1
+
+        user_id = "user_0"
+        reviews = tool.get_reviews(user_id=user_id)
+        legacy = agent._build_user_profile(reviews, tool)
+        del legacy["city_counts"]
+        latest = max(r["date"] for r in reviews)
+        agent._profile_store.put(user_id, f"{len(reviews)}:{latest}", legacy)  # 加入city_counts之前的版本号格式
+        profile = agent._get_user_profile(reviews, tool, user_id)
+        assert profile.get("city_counts"), profile
+        mygo._USER_PROFILE_STORES.clear()
+        agent._profile_store._conn.close()
+
+
+class _ScriptedLLM:
+    """按顺序返回预设响应的LLM"""
+
+    def __init__(self, responses: List[str]):
+        self.responses = list(responses)
+        self.calls = 0
+
+    async def atext_request(self, messages: List[Dict], **kwargs) -> str:
+        self.calls += 1
+        return self.responses.pop(0)
+
+
+def check_llm_cache_validation():
+    """LLM响应缓存：无法解析出阶段必需键的响应不写入；此前已缓存的无法解析的响应视为未命中并被新响应覆盖；
+    写入攒够commit_every条才提交，关闭时提交其余写入"""
+    messages = [{"role": "user", "content": '请输出{"selected_venues": []}'}]
+    bad, good = "抱歉，我无法完成这个请求。", '```json\n{"selected_venues": [{"venue_id": "item_1"}]}\n```'
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "llm.db")
+        def committed():
+            conn = sqlite3.connect(path)
+            try:
+                return conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+            finally:
+                conn.close()
+        llm = _ScriptedLLM([bad, good, good])
+        agent = BenchAgent(SyntheticUIRTool(n_items=5), llm, llm_cache_path=path, llm_model="fake")
+        for expected in (bad, good, good):
+            assert asyncio.run(agent._llm_request(messages, "screening")) == expected
+        assert llm.calls == 2, llm.calls
+
+        key = agent._llm_cache.make_key(messages, "fake")
+        agent._llm_cache.put(key, "fake", bad)
+        llm.responses = [good]
+        assert asyncio.run(agent._llm_request(messages, "screening")) == good and llm.calls == 3
+        assert agent._llm_cache.get(key) == good
+        assert committed() == 0
+        mygo.close_llm_response_caches()
+        assert committed() == 1
+
+
+# (LLM输出, 必需键, 期望结果, 期望的error前缀；None表示无错误)
+JSON_PARSE_CASES = [
+    ('{"url": "http://example.com/a//b", "pattern": "/* not a comment */"}', (),
+     {"url": "http://example.com/a//b", "pattern": "/* not a comment */"}, None),
+    ('{"a": 1, // 行注释\n "b": /* 块注释 */ 2}', (), {"a": 1, "b": 2}, None),
+    ('{"a": [1, 2,], "b": {"c": 3,},}', (), {"a": [1, 2], "b": {"c": 3}}, None),
+    ('{"text": "he said \\"}{\\" ok", "n": 1}', (), {"text": 'he said "}{" ok', "n": 1}, None),
+    ('{"a": 1, "b": [1, 2', (), {"a": 1}, "truncated"),
+    ('{"a": "unterminated', (), {}, "truncated"),
+    ('{"x": 1} 然后 {"a": 2}', (), {"x": 1}, None),
+    ('{"x": 1} 然后 {"a": 2}', ("a",), {"a": 2}, None),
+    ('{"x": 1} 没有其他对象', ("a",), {"x": 1}, "missing_keys"),
+    ('{bad json} {"a": 1}', (), {"a": 1}, None),
+    ('{"a": 1, "b": 2, "c": [', ("a", "b"), {"a": 1, "b": 2}, None),
+    ('示例{"b": 0}\n```json\n{"a": 1}\n```', ("a",), {"a": 1}, None),
+    ("no json here", (), {}, "no_json_object"),
+]
+
+
+def check_json_parse():
+    """JSON提取器：字符串中的URL与注释符号、注释、尾随逗号、截断、多个对象；逐字符喂入与整段喂入结果相同"""
+    for text, keys, expected, error in JSON_PARSE_CASES:
+        for size in (1, 5, len(text)):
+            extractor = mygo.IncrementalJSONExtractor(keys, fence="```json")
+            for k in range(0, len(text), size):
+                if extractor.feed(text[k:k + size]): break
+            result = extractor.finish()
+            assert result == expected, (text, size, result)
+            assert (extractor.error or "").startswith(error or "") and (error is not None or extractor.error is None), (text, size, extractor.error)
+
+
+class _InflightLLM(SyntheticLLM):
+    """按所属批量执行（资源限额）分别统计同时进行的LLM调用数的峰值"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.inflight, self.peak = Counter(), Counter()
+
+    async def atext_request(self, messages: List[Dict], **kwargs) -> str:
+        run = id(mygo._RUN_LIMITS.get())
+        self.inflight[run] += 1
+        self.peak[run] = max(self.peak[run], self.inflight[run])
+        try:
+            return await super().atext_request(messages, **kwargs)
+        finally:
+            self.inflight[run] -= 1
+
+
+def check_overlapping_runs():
+    """同一智能体上重叠的两次批量执行各自遵守自己的LLM并发限额；先结束的一次不影响另一次的数据准备仍在线程中执行"""
+    tool = SyntheticUIRTool(reviews_per_item=20)
+    llm = _InflightLLM(latency=0.01)
+    agent = BenchAgent(tool, llm)
+    on_loop = []
+    load = agent._load_recommendation_data
+    def recording_load(*args):
+        on_loop.append(threading.current_thread() is threading.main_thread())
+        return load(*args)
+    agent._load_recommendation_data = recording_load
+
+    async def run():
+        short = agent.run_tasks(tool.make_tasks(4, 20, seed=1), concurrency=8, llm_concurrency=1)
+        long = agent.run_tasks(tool.make_tasks(24, 20, seed=2), concurrency=8, llm_concurrency=3)
+        return await asyncio.gather(short, long)
+
+    short, long = asyncio.run(run())
+    assert len(short) == 4 and len(long) == 24 and not any("error" in r for r in short + long)
+    assert sorted(llm.peak.values()) == [1, 3], llm.peak
+    assert len(on_loop) == 28 and not any(on_loop), on_loop
+
+
+def check_review_profile_off_loop():
+    """批量执行的评论撰写任务在数据准备线程中读取/计算用户画像，不占用事件循环"""
+    tool = SyntheticUIRTool(reviews_per_item=20)
+    agent = BenchAgent(tool, SyntheticLLM())
+    on_loop = []
+    get_profile = agent._get_user_profile
+    def recording_profile(*args):
+        on_loop.append(threading.current_thread() is threading.main_thread())
+        return get_profile(*args)
+    agent._get_user_profile = recording_profile
+    results = asyncio.run(agent.run_tasks(tool.make_review_tasks(12), concurrency=4))
+    assert not any("error" in r for r in results), results
+    assert len(on_loop) == 12 and not any(on_loop), on_loop
+
+
+class _SlowReadDict(dict):
+    """读取后让出线程，放大读-改-写之间的竞争窗口"""
+
+    def get(self, key, default=None):
+        value = super().get(key, default)
+        time.sleep(0.0005)
+        return value
+
+
+def check_prefilter_stats_threads():
+    """预筛选统计在多个数据准备线程中并发累加时不丢失计数"""
+    tool = SyntheticUIRTool(reviews_per_item=5)
+    tasks = tool.make_tasks(40, 40)
+    rules = [{"rule": "category", "min_history": 1}]
+
+    def build_all(workers):
+        agent = BenchAgent(tool, prefilter_rules=rules, prefilter_min_keep=30)
+        agent.prefilter_stats = _SlowReadDict()
+        def build(task):
+            task_tool = agent._get_task_tool()
+            preferences = agent._analyze_user_preferences(task_tool.get_reviews(user_id=task["user_id"]), task_tool)
+            agent._build_candidate_details(task["candidate_list"], task_tool, preferences)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(build, tasks))
+        return dict(agent.prefilter_stats)
+
+    expected = build_all(1)
+    assert expected.get("category") and expected.get("guarded"), expected
+    concurrent = build_all(8)
+    assert concurrent == expected, (concurrent, expected)
+
+
+class _SlowFirstLLM:
+    """第一次调用延迟delay秒后返回slow，其余调用立即返回fast"""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.calls = 0
+
+    async def atext_request(self, messages: List[Dict], **kwargs) -> str:
+        self.calls += 1
+        if self.calls == 1:
+            await asyncio.sleep(self.delay)
+            return "slow"
+        return "fast"
+
+
+def check_hedged_spans():
+    """对冲请求各自记录子span：被取消的慢请求不覆盖先返回的对冲请求的耗时，父span记录胜出的请求"""
+    agent = BenchAgent(SyntheticUIRTool(n_items=5), _SlowFirstLLM(0.2), llm_policy={"llm": {"hedge_after": 0.02}})
+    trace = mygo.TaskTrace("check")
+
+    async def run():
+        token = mygo._CURRENT_TRACE.set(trace)
+        try:
+            return await agent._llm_request([{"role": "user", "content": "hi"}], "llm")
+        finally:
+            mygo._CURRENT_TRACE.reset(token)
+
+    assert asyncio.run(run()) == "fast"
+    attempts = {span["hedge"]: span for span in trace.spans if span["name"] == "llm.llm.attempt"}
+    parent = next(span for span in trace.spans if span["name"] == "llm.llm")
+    assert set(attempts) == {False, True}, trace.spans
+    assert attempts[False].get("error") == "CancelledError" and "error" not in attempts[True], attempts
+    assert attempts[True]["duration_ms"] < 100 and parent["hedged"] and parent["hedge_won"] and parent["winning_attempt"] == 0, parent
+
+
+def check_log_flush():
+    """缓冲日志：不足buffer_size条的INFO记录在空闲或持续输出时都在flush_interval左右写出，而不是等到退出"""
+    def written_within(stream, text, seconds):
+        deadline = time.monotonic() + seconds
+        while text not in stream.getvalue() and time.monotonic() < deadline: time.sleep(0.01)
+        return text in stream.getvalue()
+
+    stream = io.StringIO()
+    mygo.configure_logging(logging.INFO, stream=stream, buffer_size=64, flush_interval=0.1)
+    try:
+        mygo.logger.info("idle progress")
+        assert written_within(stream, "idle progress", 1.0), stream.getvalue()
+        for i in range(20):
+            mygo.logger.info("busy progress %d", i)
+            time.sleep(0.02)
+        assert "busy progress 0" in stream.getvalue(), stream.getvalue()
+    finally:
+        mygo.shutdown_logging()
+        mygo.logger.setLevel(logging.ERROR)
+
+
+def check_review_batch_traces():
+    """评论微批：合并后的LLM调用记录在每个参与任务的trace中，带同一批次ID，均摊耗时之和等于调用耗时"""
+    tool = SyntheticUIRTool(reviews_per_item=20)
+    agent = BenchAgent(tool, SyntheticLLM(latency=0.02), review_batch_size=4, review_batch_window=0.05, collect_metrics=True)
+    records = []
+    agent._finish_trace = lambda trace: records.append(trace.to_dict())
+    results = asyncio.run(agent.run_tasks(tool.make_review_tasks(8), concurrency=8))
+    assert not any("error" in r for r in results) and agent._review_batcher.stats["batched"] == 8, agent._review_batcher.stats
+    batches: Dict[str, List[Dict]] = {}
+    for record in records:
+        spans = [span for span in record["spans"] if span["name"] == "llm.review_batch"]
+        assert len(spans) == 1 and spans[0]["offset_ms"] >= 0, record["spans"]
+        batches.setdefault(spans[0]["batch_id"], []).append(spans[0])
+    assert sorted(len(spans) for spans in batches.values()) == [4, 4], batches
+    for spans in batches.values():
+        assert len({span["duration_ms"] for span in spans}) == 1
+        assert abs(sum(span["share_ms"] for span in spans) - spans[0]["duration_ms"]) < 0.01, spans
+
+
+# 正确性检查：优化路径与参考实现/整段处理的结果必须一致
+CHECKS = [check_json_parse, check_stream_parse, check_compact_reviews, check_mention_index, check_speculative_partial, check_profile_store,
+          check_llm_cache_validation, check_overlapping_runs, check_review_profile_off_loop,
+          check_prefilter_stats_threads, check_hedged_spans, check_log_flush,
+          check_review_batch_traces]
+
+
+def bench_check(args):
+    """运行正确性检查，有失败时以非零状态退出"""
+    mygo.logger.setLevel(logging.ERROR)  # 检查中故意制造的阶段失败不输出告警
+    failed = 0
+    for check in CHECKS:
+        if args.only and check.__name__ not in args.only: continue
+        try:
+            check()
+            print(f"ok    {check.__name__}")
+        except AssertionError as e:
+            failed += 1
+            print(f"FAIL  {check.__name__}: {e!r}"[:500])
+    if failed: raise SystemExit(f"{failed} check(s) failed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MyGO offline benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    bulk = sub.add_parser("bulk", help="per-id vs bulk candidate fetch")
+    bulk.add_argument("--tasks", type=int, default=50)
+    bulk.add_argument("--candidates", type=int, default=20)
+    bulk.add_argument("--reviews-per-item", type=int, default=50)
+    bulk.add_argument("--db-latency", type=float, default=0.002)
+    bulk.add_argument("--workers", type=int, default=8)
+    bulk.set_defaults(func=bench_bulk)
+
+    prerank = sub.add_parser("prerank", help="BM25 pre-ranking recall for Chinese primary needs and prompt savings")
+    prerank.add_argument("--tasks", type=int, default=200)
+    prerank.add_argument("--candidates", type=int, default=40)
+    prerank.add_argument("--reviews-per-item", type=int, default=50)
+    prerank.add_argument("--top-k", type=int, nargs="+", default=[10, 20, 30])
+    prerank.set_defaults(func=bench_prerank)
+
+    stream = sub.add_parser("stream", help="full responses vs streaming with early termination against a fake SSE server")
+    stream.add_argument("--tasks", type=int, default=10)
+    stream.add_argument("--candidates", type=int, default=20)
+    stream.add_argument("--reviews-per-item", type=int, default=50)
+    stream.add_argument("--token-delay", type=float, default=0.002)
+    stream.add_argument("--chunk-chars", type=int, default=4)
+    stream.add_argument("--tail-chars", type=int, default=1500)
+    stream.set_defaults(func=bench_stream)
+
+    prefix = sub.add_parser("prefix", help="token-level prompt prefix overlap across a task batch for each message layout")
+    prefix.add_argument("--tasks", type=int, default=40)
+    prefix.add_argument("--review-ratio", type=float, default=0.25, help="share of review_writing tasks")
+    prefix.add_argument("--candidates", type=int, default=20)
+    prefix.add_argument("--candidate-sets", type=int, default=4, help="distinct candidate lists shared by tasks (0: random per task)")
+    prefix.add_argument("--reviews-per-item", type=int, default=50)
+    prefix.add_argument("--block-size", type=int, default=16, help="cache block size in tokens")
+    prefix.set_defaults(func=bench_prefix)
+
+    prefilter = sub.add_parser("prefilter", help="candidates removed per pre-filter rule and the resulting screening prompt size")
+    prefilter.add_argument("--tasks", type=int, default=200)
+    prefilter.add_argument("--candidates", type=int, default=20)
+    prefilter.add_argument("--reviews-per-item", type=int, default=50)
+    prefilter.set_defaults(func=bench_prefilter)
+
+    reviews = sub.add_parser("reviews", help="review_writing throughput with micro-batched LLM calls")
+    reviews.add_argument("--tasks", type=int, default=200)
+    reviews.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8])
+    reviews.add_argument("--window", type=float, default=0.02, help="batching window in seconds")
+    reviews.add_argument("--concurrency", type=int, default=32)
+    reviews.add_argument("--llm-concurrency", type=int, default=4, help="concurrent LLM requests allowed (provider rate limit)")
+    reviews.add_argument("--reviews-per-item", type=int, default=50)
+    reviews.add_argument("--llm-latency", type=float, default=0.3, help="fixed per-call latency")
+    reviews.add_argument("--char-latency", type=float, default=0.0005, help="generation latency per output char")
+    reviews.add_argument("--batch-drop", type=float, default=0.0, help="chance that the fake LLM omits an entry from a batch")
+    reviews.set_defaults(func=bench_reviews)
+
+    suite = sub.add_parser("suite", help="end-to-end forward() throughput, stage latency, DB calls and peak memory at several scales")
+    suite.add_argument("--scales", type=int, nargs="+", default=[10, 1000, 100000], help="reviews per item")
+    suite.add_argument("--tasks", type=int, default=40)
+    suite.add_argument("--review-ratio", type=float, default=0.25, help="share of review_writing tasks")
+    suite.add_argument("--candidates", type=int, default=20)
+    suite.add_argument("--users", type=int, default=200)
+    suite.add_argument("--items", type=int, default=500)
+    suite.add_argument("--review-budget", type=int, default=2_000_000, help="cap on total synthetic item reviews per scale")
+    suite.add_argument("--llm-latency", type=float, default=0.05)
+    suite.add_argument("--db-latency", type=float, default=0.0)
+    suite.add_argument("--concurrency", type=int, default=16)
+    # 100000条/场所时20个场所的紧凑评论约800MB，默认的512MB上限会使各任务互相淘汰、反复加载
+    suite.add_argument("--review-cache-mb", type=int, default=1024, help="shared review-list cache cap")
+    suite.add_argument("--output", help="write the report as JSON")
+    suite.set_defaults(func=bench_suite)
+
+    check = sub.add_parser("check", help="correctness checks: optimized paths must match the reference behaviour")
+    check.add_argument("--only", nargs="+", help="run only the named checks")
+    check.set_defaults(func=bench_check)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()